@@ -1,72 +1,165 @@
 import asyncio
-import json
+import logging
+from functools import partial
 import forta_agent
-from forta_agent import get_json_rpc_url
+from forta_agent import get_json_rpc_url, create_transaction_event
 from web3 import Web3
-from src.const import UNISWAP_CONTRACT_ADDRESS, GOVERNOR_BRAVO_CONTRACT_ADDRESS
-from src.db.config import config
-from src.db.controller import init_async_db
 from src.utils import extract_argument
-from src.config import BLOCKS_LEADING_UP_TO_THE_PROPOSAL, BLOCKS_AFTER_VOTE_CAST, VOTING_POWER_TH_LOW
+from src.config import BLOCK_BATCH_MODE, RESUME_MAX_BLOCKS, SHARDS
+from src.rpc import HttpRpcClient
+from src.rpc_cache import rpc_cache
+from src.dao import Dao, registry
 from src.findings import InfluencingGovernanceProposalsFindings
+from src.runtime import runtime
+from src.dispatcher import LogDispatcher, EventDecoder
+from src.metrics import metrics
+from src.deferred import deferred
+from src.signatures import signatures
 
-inited = False  # Initialization Pattern
-web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
-with open("./src/ABI/governor_bravo_abi.json", 'r') as abi_file:  # get abi from the file
-    governor_bravo_abi = json.load(abi_file)
+logger = logging.getLogger(__name__)
 
-with open("./src/ABI/uniswap_abi.json", 'r') as abi_file:  # get abi from the file
-    uniswap_abi = json.load(abi_file)
+inited = False  # Initialization Pattern
+resumed = False  # the blocks missed since the last processed block are replayed once after the start
+prefetched = False  # the snapshots of the stored proposals are requested once after the start
+last_block = None  # block of the last handled transaction, the DAOs without the events are visited once per block
+rpc = HttpRpcClient(get_json_rpc_url)  # the url is resolved when the client is bound to the loop
 
 # "event VoteCast(address indexed voter, uint proposalId, uint8 support, uint votes, string reason)" in the json format
-vote_cast_abi = next((x for x in governor_bravo_abi if x.get('name', "") == "VoteCast"), None)
+vote_cast_abi = signatures['events']['VoteCast']['abi']
 # "event ProposalCreated(uint id, address proposer, address[] targets, uint[] values, string[] signatures,
 # bytes[] calldatas, uint startBlock, uint endBlock, string description)" in the json format
-proposal_created_abi = next((x for x in governor_bravo_abi if x.get('name', "") == "ProposalCreated"), None)
-# "function checkpoints(address account, uint32 index) external view returns (uint32, uint96)" in the json format
-checkpoints_abi = next((x for x in uniswap_abi if x.get('name', "") == "checkpoints"), None)
-# "function numCheckpoints(address account) external view returns (uint32)" in the json format
-num_checkpoints_abi = next((x for x in uniswap_abi if x.get('name', "") == "numCheckpoints"), None)
+proposal_created_abi = signatures['events']['ProposalCreated']['abi']
 # "event DelegateVotesChanged(address indexed delegate, uint previousBalance, uint newBalance)" in the json format
-delegate_votes_changed_abi = next((x for x in uniswap_abi if x.get('name', "") == "DelegateVotesChanged"), None)
+delegate_votes_changed_abi = signatures['events']['DelegateVotesChanged']['abi']
+# event name -> decoder precompiled from the artifact, the decoders are shared by the routes of all the DAOs
+decoders = {name: EventDecoder(event['abi'], event['topic']) for name, event in signatures['events'].items()}
+
+
+def get_routes(dao: Dao) -> list:
+    """
+    :param dao: Dao
+    :return: routes of the monitored events of the DAO: list of (contract address, EventDecoder)
+    """
+    return [(dao.governor, decoders['ProposalCreated']), (dao.governor, decoders['VoteCast']),
+            (dao.token, decoders['DelegateVotesChanged'])]
+
+
+# routes the logs of the known events of all the DAOs to the detectors in one pass over the receipt
+dispatcher = LogDispatcher([route for dao in registry.daos for route in get_routes(dao)])
+
+
+def register_dao(dao: Dao):
+    """
+    This function starts monitoring the DAO, its tables are created by the next initialization
+    :param dao: Dao
+    """
+    registry.add(dao)
+    dispatcher.add(get_routes(dao))
+
 
+def unregister_dao(dao: Dao):
+    registry.remove(dao)
+    dispatcher.remove([dao.governor, dao.token])
 
-async def detect_proposal_initialization(transaction_event: forta_agent.transaction_event.TransactionEvent):
+
+async def detect_proposal_initialization(transaction_event: forta_agent.transaction_event.TransactionEvent,
+                                         events: list, dao: Dao = None, lookup=None):
     """
     This function detects when a new proposal was created.
     :param transaction_event: forta_agent.transaction_event.TransactionEvent
+    :param events: list of the decoded ProposalCreated events
+    :param dao: Dao which emitted the events, the default DAO if it is not set
+    :param lookup: CheckpointLookup, the snapshots of the windows of the new proposals are prefetched with it if it is
+    set
     :return: findings: list
     """
+    dao = dao or registry.default
     findings = []
-    proposals = config.get_proposals()  # get proposals table from the db
+    new_proposals = []
+    proposals = dao.db.get_proposals()  # get proposals table from the db
     # get all proposal created events from the log
-    for event in transaction_event.filter_log(json.dumps(proposal_created_abi), GOVERNOR_BRAVO_CONTRACT_ADDRESS):
+    for event in events:
         id_ = extract_argument(event, 'id')
         start = extract_argument(event, 'startBlock')
         end = extract_argument(event, 'endBlock')
-        # add the proposal to the db
-        await proposals.paste_row({
-            'proposal_id': id_, 'start_block': start, 'end_block': end,
-        })
-        findings.append(InfluencingGovernanceProposalsFindings.new_proposal(id_))
-    await proposals.commit()
+        new_proposals.append({'proposal_id': id_, 'start_block': start, 'end_block': end})
+        findings.append(InfluencingGovernanceProposalsFindings.new_proposal(id_, dao))
+    # add the proposals to the db in one batch
+    if new_proposals:
+        await proposals.paste_rows(new_proposals)
+    # the windows which are not covered by the ledger are requested in the background before the votes come
+    targets = {proposal['start_block'] - dao.blocks_before for proposal in new_proposals} if lookup is not None else ()
+    for target_block in targets:
+        if not dao.ledger.covers(target_block):
+            dao.snapshots.schedule(lookup, get_known_delegates(dao), target_block, transaction_event.block_number)
     return findings
 
 
-async def detect_cast_vote(transaction_event: forta_agent.transaction_event.TransactionEvent, w3):
+def get_known_delegates(dao: Dao) -> set:
+    """
+    :param dao: Dao
+    :return: 20-byte keys of the delegates whose voting power changed or who voted since the start: set
+    """
+    return set(dao.ledger.delegates()) | set(dao.db.get_votes().index.keys())
+
+
+def get_window_requests(events: list, dao: Dao = None) -> list:
+    """
+    This function finds the proposals of the VoteCast events and the windows which have to be requested by RPC
+    :param events: list of the decoded VoteCast events
+    :param dao: Dao which emitted the events, the default DAO if it is not set
+    :return: list of (event, target block) for the votes of the known proposals and list of (voter, target block) for
+    the windows which are not covered by the ledger
+    """
+    dao = dao or registry.default
+    proposals = dao.db.get_proposals()  # get proposals table from the db
+    known_votes = []
+    for event in events:
+        # get information about this proposal from the in-memory interval index
+        proposal = proposals.get_proposal(extract_argument(event, "proposalId"))
+        if not proposal:
+            continue  # skip if it is unknown
+        known_votes.append((event, proposal.start_block - dao.blocks_before))  # the minimal block
+    requests = [(extract_argument(event, "voter"), target_block) for event, target_block in known_votes
+                if not dao.ledger.covers(target_block)
+                and not dao.snapshots.covers(extract_argument(event, "voter"), target_block, dao.ledger)]
+    return known_votes, requests
+
+
+async def detect_cast_vote(transaction_event: forta_agent.transaction_event.TransactionEvent, events: list, lookup,
+                           windows: dict = None, dao: Dao = None):
     """
     This function detects CastVote events in the logs and emit an alert if there is an influencing before
     :param transaction_event: forta_agent.transaction_event.TransactionEvent
-    :param w3: web3 object, it was added here to be able to insert web3 mock and test the function
+    :param events: list of the decoded VoteCast events
+    :param lookup: CheckpointLookup, it was added here to be able to insert the rpc stand-in and test the function
+    :param windows: windows prefetched for the whole block, (voter, target block) -> window: dict
+    :param dao: Dao which emitted the events, the default DAO if it is not set
     :return: findings: list
     """
+    dao = dao or registry.default
     findings = []
-    proposals = config.get_proposals()  # get proposals table from the db
-    votes = config.get_votes()  # get votes table from the db
-    contract = w3.eth.contract(address=Web3.toChecksumAddress(UNISWAP_CONTRACT_ADDRESS),
-                               abi=[checkpoints_abi, num_checkpoints_abi])
-    # get all CastVote events from the log
-    for event in transaction_event.filter_log(json.dumps(vote_cast_abi), GOVERNOR_BRAVO_CONTRACT_ADDRESS):
+    new_votes = []
+    votes = dao.db.get_votes()  # get votes table from the db
+    known_votes, requests = get_window_requests(events, dao)
+
+    # get the last voting power and all checkpoints which are bigger than minimal block of all the voters at once
+    windows = dict(windows or {})
+    requests = [request for request in requests if request not in windows]
+    if requests:
+        fetch = asyncio.ensure_future(lookup.get_windows(requests, transaction_event.block_number))
+        if await deferred.wait(fetch):
+            windows |= fetch.result()
+        else:  # the deep lookups outlast the budget of the invocation, these votes are checked in the background
+            late = set(requests)
+            deferred.defer('detect_cast_vote', check_deferred_votes(
+                transaction_event, [event for event, target_block in known_votes
+                                    if (extract_argument(event, "voter"), target_block) in late], fetch, lookup, dao),
+                transaction_event.block_number)
+            known_votes = [(event, target_block) for event, target_block in known_votes
+                           if (extract_argument(event, "voter"), target_block) not in late]
+
+    for event, target_block in known_votes:
         voter = extract_argument(event, "voter")
         proposal_id = extract_argument(event, "proposalId")
         support = extract_argument(event, "support")
@@ -74,137 +167,460 @@ async def detect_cast_vote(transaction_event: forta_agent.transaction_event.Tran
         reason = extract_argument(event, "reason")
         influencing = False
 
-        # get the amount of checkpoints of the current voter
-        num_checkpoints = contract.functions.numCheckpoints(account=voter).call(transaction_event.block_number)
-        if num_checkpoints == 0 or not num_checkpoints:
-            continue
-
-        # get his last voting power
-        last_check_block, current_voting_power = contract.functions.checkpoints(account=voter,
-                                                                                index=(num_checkpoints - 1)).call(
-            transaction_event.block_number)
-
-        # get information about this proposal from the db
-        proposal = await proposals.get_row_by_criteria({'proposal_id': proposal_id})
-        if not proposal:
-            continue  # skip if it is unknown
-
-        proposal_start_block = proposal.start_block
-
-        if last_check_block < proposal_start_block - BLOCKS_LEADING_UP_TO_THE_PROPOSAL:
-            continue  # skip if last checkpoint is too old
-
-        target_block = proposal_start_block - BLOCKS_LEADING_UP_TO_THE_PROPOSAL  # get the minimal block to check
-
-        # check all checkpoints which is bigger than minimal block
-        for i in range(num_checkpoints - 1, 0, -1):
-            block_at_i, voting_power_at_i = \
-                contract.functions.checkpoints(account=voter,
-                                               index=i).call(transaction_event.block_number)
-            if block_at_i < target_block:
-                break
+        if dao.ledger.covers(target_block):
+            window = dao.ledger.get_window(voter, target_block)  # the agent has seen every change in the window
+        elif dao.snapshots.covers(voter, target_block, dao.ledger):
+            window = dao.snapshots.get_window(voter, target_block, dao.ledger)  # prefetched with the proposal
+            metrics.inc('agent_snapshot_hits_total')
+        else:
+            window = windows[(voter, target_block)]
+        if window is None:
+            continue  # skip if there are no checkpoints or last checkpoint is too old
+        current_voting_power, checkpoints = window
+
+        for block_at_i, voting_power_at_i in checkpoints:
             # emit an alert if difference is bigger than th
             dif = current_voting_power - voting_power_at_i
-            if dif > VOTING_POWER_TH_LOW:
+            if dif > dao.th_low:
                 findings.append(InfluencingGovernanceProposalsFindings.influencing_before_voting(proposal_id, voter,
                                                                                                  support, votes_,
-                                                                                                 reason, dif))
+                                                                                                 reason, dif, dao))
                 influencing = True
                 break
 
-        # add this vote to the db
-        await votes.paste_row(
+        # (transaction hash, log index) is the natural key of the vote, the re-scanned vote is not stored twice
+        new_votes.append(
             {'voter': voter, 'block_number': transaction_event.block_number, 'proposal_id': proposal_id,
-             'support': support, 'votes': str(votes_), 'reason': reason, 'influencing': influencing})
-        await votes.commit()
+             'support': support, 'votes': votes_, 'reason': reason, 'influencing': influencing,
+             'transaction_hash': event['transactionHash'] or transaction_event.hash, 'log_index': event['logIndex']})
 
+    # add the votes to the db in one batch
+    if new_votes:
+        await votes.paste_rows(new_votes)
     return findings
 
 
-async def detect_voting_power_decrease_after_cast(transaction_event: forta_agent.transaction_event.TransactionEvent):
+async def check_deferred_votes(transaction_event: forta_agent.transaction_event.TransactionEvent, events: list,
+                               fetch: asyncio.Future, lookup, dao: Dao) -> list:
+    """
+    This function finishes the check of the votes whose windows were not fetched by the deadline of the invocation,
+    the votes are stored in its own unit of work
+    :param transaction_event: forta_agent.transaction_event.TransactionEvent
+    :param events: list of the decoded VoteCast events
+    :param fetch: asyncio.Future of the windows of the votes
+    :param lookup: CheckpointLookup
+    :param dao: Dao
+    :return: findings: list
+    """
+    windows = await fetch
+    async with dao.db.unit_of_work():
+        return await detect_cast_vote(transaction_event, events, lookup, windows, dao)
+
+
+def record_voting_power_changes(transaction_event: forta_agent.transaction_event.TransactionEvent, events: list,
+                                dao: Dao = None):
+    """
+    This function adds the DelegateVotesChanged events to the voting power ledger
+    :param transaction_event: forta_agent.transaction_event.TransactionEvent
+    :param events: list of the decoded DelegateVotesChanged events
+    :param dao: Dao which emitted the events, the default DAO if it is not set
+    """
+    dao = dao or registry.default
+    dao.ledger.observe_block(transaction_event.block_number)
+    for event in events:
+        dao.ledger.append(extract_argument(event, "delegate"), transaction_event.block_number,
+                          extract_argument(event, "newBalance"))
+
+
+async def detect_voting_power_decrease_after_cast(transaction_event: forta_agent.transaction_event.TransactionEvent,
+                                                  events: list, dao: Dao = None):
     """
     This function detects voting power decreasing after the VoteCast and emit an alert if there is an influencing
     :param transaction_event: forta_agent.transaction_event.TransactionEvent
+    :param events: list of the decoded DelegateVotesChanged events
+    :param dao: Dao which emitted the events, the default DAO if it is not set
     :return: findings: list
     """
+    dao = dao or registry.default
     findings = []
-    votes = config.get_votes()  # get votes from the db
+    votes = dao.db.get_votes()  # get votes from the db
 
     # get all DelegateVotesChanged events from the log
-    for event in transaction_event.filter_log(json.dumps(delegate_votes_changed_abi), UNISWAP_CONTRACT_ADDRESS):
+    for event in events:
         delegate = extract_argument(event, "delegate")  # delegate is an address whose balance has been changed
         new_balance = extract_argument(event, "newBalance")
-        known_votes = await votes.get_all_rows()
 
-        # check if this address exist in our db
-        if delegate in [known_vote.voter for known_vote in known_votes]:
-            vote = await votes.get_row_by_criteria({'voter': delegate})
-            if not vote:
-                continue
+        # all the votes of this address which are not older than the tracked period, one per open proposal
+        known_votes = votes.get_indexed_rows(delegate, since=transaction_event.block_number - dao.blocks_after)
 
-            # compare his voting power in the moment of the cast and current; emit an alert if the difference is bigger
-            # than th
-            dif = int(vote.votes) - new_balance
-            if dif > VOTING_POWER_TH_LOW:
-                findings.append(
-                    InfluencingGovernanceProposalsFindings.influencing_after_voting(vote.proposal_id, delegate,
-                                                                                    vote.support, vote.votes,
-                                                                                    vote.reason, dif)
-                    if not vote.influencing else InfluencingGovernanceProposalsFindings.influencing_full(
-                        vote.proposal_id,
-                        delegate, vote.support, vote.votes,
-                        vote.reason, dif))
+        # compare his voting power in the moment of every cast and current; emit an alert for every vote where the
+        # difference is bigger than th
+        for vote in known_votes:
+            dif = vote.votes - new_balance
+            if dif > dao.th_low:
+                finding = InfluencingGovernanceProposalsFindings.influencing_full if vote.influencing else \
+                    InfluencingGovernanceProposalsFindings.influencing_after_voting
+                # the stored values of the vote are reported as strings, as the db returned them before it stored ints
+                findings.append(finding(str(vote.proposal_id), delegate, str(vote.support), str(vote.votes),
+                                        vote.reason, dif, dao))
 
     return findings
 
 
-async def clear_db(transaction_event: forta_agent.transaction_event.TransactionEvent):
+async def clear_db(transaction_event: forta_agent.transaction_event.TransactionEvent, dao: Dao = None):
     """
-    This function deletes old proposal and votes from the db
+    This function deletes old proposal and votes from the db once per RETENTION_SWEEP_INTERVAL_BLOCKS blocks
     :param transaction_event: forta_agent.transaction_event.TransactionEvent
+    :param dao: Dao whose tables are swept, the default DAO if it is not set
     :return: []
     """
-    votes = config.get_votes()
-    proposals = config.get_proposals()
-    await votes.delete_old_votes(transaction_event.block_number, BLOCKS_AFTER_VOTE_CAST)
-    await proposals.delete_old_proposals(transaction_event.block_number, BLOCKS_AFTER_VOTE_CAST)
-    await votes.commit()
-    await proposals.commit()
+    dao = dao or registry.default
+    if dao.retention.is_due(transaction_event.block_number):
+        await sweep_or_defer(dao, transaction_event.block_number)
     return []
 
 
-async def main(transaction_event: forta_agent.transaction_event.TransactionEvent, w3, test):
+async def sweep_or_defer(dao: Dao, block: int):
     """
-    This function is used to start detect-functions in the different threads and then gather the findings
+    This function runs the retention sweep inline or, if the deadline of the invocation has passed, in the background
+    :param dao: Dao
+    :param block: int
+    """
+    if deferred.expired() and not deferred.full():
+        dao.retention.last_sweep_block = block  # the sweep is scheduled, the next transactions do not defer it again
+        deferred.defer('retention', sweep_in_unit_of_work(dao, block), block)
+    else:
+        await sweep(dao, block)
+
+
+async def sweep_in_unit_of_work(dao: Dao, block: int) -> list:
+    async with dao.db.unit_of_work():
+        await sweep(dao, block)
+    return []
+
+
+async def sweep(dao: Dao, block: int):
     """
+    This function deletes old proposals and votes of the DAO and drops the checkpoints of the ledger which are before
+    the windows of the remaining proposals and of the proposals which can be created from now on
+    :param dao: Dao
+    :param block: int
+    """
+    await dao.retention.sweep(block, dao.db.get_votes(), dao.db.get_proposals())
+    window = dao.db.get_proposals().get_active_window(block)
+    start = min(window[0], block) if window else block  # the proposals created later start after the block
+    dao.ledger.prune(start - dao.blocks_before)
+    dao.snapshots.prune(start - dao.blocks_before)
+
+
+async def init(test, name=None):
     global inited
     if not inited:
-        proposals_table, votes_table = await init_async_db(test)
-        config.set_tables(proposals_table, votes_table)
+        name = name or ("test" if test else "main")
+        from src.db.controller import init_async_db  # sqlalchemy is loaded by the initialization, not by the import
+        for dao in registry.daos:  # every DAO has its own db
+            proposals_table, votes_table = await init_async_db(test, dao.db_name(name), db=dao.db)
+            dao.db.set_tables(proposals_table, votes_table)
+        metrics.serve()
         inited = True
 
-    return await asyncio.gather(
-        detect_proposal_initialization(transaction_event),
-        detect_cast_vote(transaction_event, w3),
-        detect_voting_power_decrease_after_cast(transaction_event),
-        clear_db(transaction_event)
-    )
+
+async def process_transaction(transaction_event: forta_agent.transaction_event.TransactionEvent, events: dict, lookup,
+                              windows: dict = None, dao: Dao = None):
+    """
+    This function is used to start detect-functions in the different threads and then gather the findings
+    """
+    dao = dao or registry.default
+    with metrics.timer('agent_stage_seconds', stage='record_voting_power_changes'):
+        record_voting_power_changes(transaction_event, events.get('DelegateVotesChanged', []), dao)
+    tasks = [asyncio.ensure_future(x) for x in [
+        metrics.timed('agent_stage_seconds', detect_proposal_initialization(
+            transaction_event, events.get('ProposalCreated', []), dao, lookup),
+            stage='detect_proposal_initialization'),
+        metrics.timed('agent_stage_seconds', detect_cast_vote(
+            transaction_event, events.get('VoteCast', []), lookup, windows, dao), stage='detect_cast_vote'),
+        metrics.timed('agent_stage_seconds', detect_voting_power_decrease_after_cast(
+            transaction_event, events.get('DelegateVotesChanged', []), dao),
+            stage='detect_voting_power_decrease_after_cast'),
+        metrics.timed('agent_stage_seconds', clear_db(transaction_event, dao), stage='clear_db')
+    ]]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # the unit of work is rolled back only after the other detectors stopped using its session
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def main(transaction_event: forta_agent.transaction_event.TransactionEvent, rpc_client, test, events=None):
+    """
+    This function handles one transaction, only the DAOs whose contracts emitted the events are visited; the
+    retention and the storage backends of the other DAOs are handled on the first transaction of the block
+    """
+    global last_block
+    with deferred.deadline():  # the expensive checks which outlast the budget are finished in the background
+        await init(test)
+        missed = await resume(rpc_client, test, transaction_event.block_number)
+        prefetch_stored_proposals(rpc_client, transaction_event.block_number)
+        if events is None:
+            events = dispatcher.dispatch(transaction_event.logs)
+        events_by_dao = registry.split(events)
+        new_block = transaction_event.block_number != last_block
+        last_block = transaction_event.block_number
+        daos = registry.daos if new_block else [dao for dao in registry.daos if dao in events_by_dao]
+        findings = []
+        for dao in daos:
+            if dao not in events_by_dao and not dao.retention.is_due(transaction_event.block_number):
+                continue
+            # all the detectors of the DAO share one db session, which is committed once per transaction
+            with metrics.timer('agent_stage_seconds', stage='unit_of_work'):
+                async with dao.db.unit_of_work():
+                    findings.extend(await process_transaction(transaction_event, events_by_dao.get(dao, {}),
+                                                              dao.get_lookup(rpc_client), dao=dao))
+        # the block is not marked as processed before the changes of its deferred checks are made
+        deferred.hold(transaction_event.block_number, partial(block_processed, transaction_event.block_number,
+                                                              daos=daos))
+    return [deferred.drain()] + missed + findings
+
+
+async def main_batch(transaction_events: list, rpc_client, test, block_number: int):
+    """
+    This function handles the transactions of one block as one batch: the windows of all the voters of the DAO are
+    requested in one RPC batch, the transactions share one db session of the DAO and the retention runs once, the
+    findings are the same as if the transactions were handled one by one
+    """
+    with deferred.deadline():  # the expensive checks which outlast the budget are finished in the background
+        await init(test)
+        findings = [deferred.drain()] + await resume(rpc_client, test, block_number)
+        prefetch_stored_proposals(rpc_client, block_number)
+        events_by_dao = [registry.split(dispatcher.dispatch(transaction_event.logs))
+                         for transaction_event in transaction_events]
+        for dao in registry.daos:
+            transactions = [(transaction_event, events[dao]) for transaction_event, events
+                            in zip(transaction_events, events_by_dao) if dao in events]
+            if not transactions and not dao.retention.is_due(block_number):
+                continue
+            lookup = dao.get_lookup(rpc_client)
+            async with dao.db.unit_of_work():
+                if transactions:
+                    dao.ledger.observe_block(block_number)
+                    _, requests = get_window_requests(
+                        [event for _, events in transactions for event in events.get('VoteCast', [])], dao)
+                    fetch = asyncio.ensure_future(lookup.get_windows(requests, block_number))
+                    # after the deadline the votes of the missing windows are deferred by detect_cast_vote, the
+                    # lookup goes on and fills the rpc cache for them
+                    windows = fetch.result() if await deferred.wait(fetch) else {}
+                    for transaction_event, events in transactions:
+                        findings.extend(await process_transaction(transaction_event, events, lookup, windows, dao))
+                if dao.retention.is_due(block_number):
+                    await sweep_or_defer(dao, block_number)
+        deferred.hold(block_number, partial(block_processed, block_number, complete=True))
+    return findings
+
+
+def block_processed(block: int, complete: bool = False, daos: list = None):
+    """
+    This function tells the storage backends of the DAOs that the transactions of the block were handled
+    :param block: int
+    :param complete: True if all the transactions of the block were handled
+    :param daos: list of Dao, all the DAOs if it is not set
+    """
+    for dao in registry.daos if daos is None else daos:
+        dao.db.block_processed(block, complete)
+
+
+async def get_block_transactions(rpc_client, from_block: int, to_block: int, block: dict = None) -> dict:
+    """
+    This function requests the logs of the contracts of all the DAOs in the blocks and groups them into the
+    transactions
+    :param rpc_client: RpcClient
+    :param from_block: int
+    :param to_block: int
+    :param block: the block part of the transaction events, it is taken from the logs if it is not set
+    :return: block -> list of forta_agent.transaction_event.TransactionEvent: dict
+    """
+    logs = await rpc_client.get_logs({'fromBlock': from_block, 'toBlock': to_block,
+                                      'address': [Web3.toChecksumAddress(x) for x in registry.addresses()]})
+    logs_by_transaction = {}
+    for log in sorted(logs, key=lambda x: (x['blockNumber'], x['logIndex'])):
+        logs_by_transaction.setdefault((log['blockNumber'], log['transactionHash']), []).append(dict(log))
+    transactions = {}
+    for (block_number, transaction_hash), logs_ in logs_by_transaction.items():
+        transactions.setdefault(block_number, []).append(create_transaction_event({
+            'transaction': {'hash': transaction_hash},
+            'block': block or {'number': block_number, 'hash': logs_[0].get('blockHash')},
+            'receipt': {'logs': logs_}
+        }))
+    return transactions
+
+
+async def resume(rpc_client, test, block: int) -> list:
+    """
+    This function replays the blocks between the last processed block persisted by the storage backends and the
+    current block, it runs once after the start. Only the write-behind backend persists the marker, the DAOs resume
+    from the oldest one, the blocks which were already stored by the others are no-ops thanks to the natural keys
+    :param rpc_client: RpcClient, it requests the logs of the missed blocks
+    :param test: bool
+    :param block: the current block: int
+    :return: findings of the missed blocks: list
+    """
+    global resumed
+    if resumed:
+        return []
+    resumed = True
+    markers = [dao.db.last_processed_block() for dao in registry.daos]
+    last_processed_block = min((x for x in markers if x is not None), default=None)
+    if last_processed_block is None or block - last_processed_block <= 1:
+        return []
+    from_block = max(last_processed_block + 1, block - RESUME_MAX_BLOCKS)
+    if from_block > last_processed_block + 1:
+        logger.warning(f'resume skips the blocks {last_processed_block + 1}-{from_block - 1}: the gap is longer than '
+                       f'RESUME_MAX_BLOCKS = {RESUME_MAX_BLOCKS}')
+    findings = []
+    for block_number, transaction_events in sorted(
+            (await get_block_transactions(rpc_client, from_block, block - 1)).items()):
+        findings.extend(await main_batch(transaction_events, rpc_client, test, block_number))
+    return findings
 
 
-def provide_handle_transaction(w3, test=False):
+def prefetch_stored_proposals(rpc_client, block: int):
+    """
+    This function requests in the background the snapshots of the windows of the stored proposals which are not ended,
+    it runs once after the start. A proposal created while the agent runs has its window after the creation block, the
+    ledger covers it; the windows of the proposals created before the start begin before the ledger. The snapshots
+    are taken at the first handled block, the ledger sees every change after it
+    :param rpc_client: RpcClient
+    :param block: the first handled block: int
+    """
+    global prefetched
+    if prefetched:
+        return
+    prefetched = True
+    for dao in registry.daos:
+        dao.ledger.observe_block(block)
+        proposals = dao.db.get_proposals()
+        targets = {proposal.start_block - dao.blocks_before for proposal in proposals.get_open_proposals(block)}
+        for target_block in sorted(x for x in targets if not dao.ledger.covers(x)):
+            dao.snapshots.schedule(dao.get_lookup(rpc_client), get_known_delegates(dao), target_block, block)
+
+
+def count_findings(findings: list):
+    """
+    This function counts the findings by alert id and dumps the metrics if it is the time
+    :param findings: list
+    """
+    if not metrics.enabled:
+        return
+    for finding in findings:
+        metrics.inc('agent_findings_total', alert_id=finding.alert_id)
+    metrics.maybe_dump()
+
+
+def provide_handle_transaction(rpc_client, test=False):
     def handle_transaction(transaction_event: forta_agent.transaction_event.TransactionEvent) -> list:
-        return [finding for findings in asyncio.run(main(transaction_event, w3, test)) for finding in findings]
+        metrics.inc('agent_transactions_total')
+        with metrics.timer('agent_stage_seconds', stage='dispatch'):
+            events = dispatcher.dispatch(transaction_event.logs)
+        if inited and not events and transaction_event.block_number == last_block and not deferred.findings:
+            return []  # the transaction does not touch the contracts of the DAOs, the block was already visited
+        # the work is submitted to the persistent loop, so the db engine and its pool are reused between transactions
+        findings = [finding for findings in runtime.run(main(transaction_event, rpc_client, test, events))
+                    for finding in findings]
+        count_findings(findings)
+        return findings
 
     return handle_transaction
 
 
-real_handle_transaction = provide_handle_transaction(web3)
+def provide_handle_transactions(rpc_client, test=False):
+    def handle_transactions(transaction_events: list, block_number: int) -> list:
+        metrics.inc('agent_transactions_total', len(transaction_events))
+        findings = [finding for findings in runtime.run(main_batch(transaction_events, rpc_client, test, block_number))
+                    for finding in findings]
+        count_findings(findings)
+        return findings
+
+    return handle_transactions
+
+
+def provide_handle_block(rpc_client, test=False):
+    async def process_block(block_event: forta_agent.block_event.BlockEvent) -> list:
+        # the block event has no receipts, so the logs of the contracts of all the DAOs are requested in one call
+        transaction_events = (await get_block_transactions(rpc_client, block_event.block_number,
+                                                           block_event.block_number, {
+                                                               'number': block_event.block_number,
+                                                               'hash': block_event.block_hash,
+                                                               'timestamp': block_event.block.timestamp,
+                                                           })).get(block_event.block_number, [])
+        metrics.inc('agent_transactions_total', len(transaction_events))
+        return await main_batch(transaction_events, rpc_client, test, block_event.block_number)
+
+    def handle_block(block_event: forta_agent.block_event.BlockEvent) -> list:
+        findings = [finding for findings in runtime.run(process_block(block_event)) for finding in findings]
+        count_findings(findings)
+        return findings
+
+    return handle_block
+
+
+real_handle_transaction = provide_handle_transaction(rpc)
+real_handle_block = provide_handle_block(rpc)
+
+
+pool = None  # ShardPool of the sharded mode
+if SHARDS > 1:
+    from src.shards import ShardPool, provide_handle_transaction as provide_sharded_handle_transaction, \
+        provide_handle_block as provide_sharded_handle_block
+
+    pool = ShardPool(SHARDS, partial(HttpRpcClient, get_json_rpc_url))
+    real_handle_transaction = provide_sharded_handle_transaction(pool)
+    real_handle_block = provide_sharded_handle_block(pool, rpc)
+
+
+async def warm_up(rpc_client, test=False, name=None):
+    """
+    This function does the one-time work of the first transaction ahead of it: the db engines, the tables and the
+    in-memory indexes of all the DAOs are created and the rpc client is bound to the loop
+    :param rpc_client: RpcClient
+    :param test: bool
+    :param name: name of the db, see init
+    """
+    with metrics.timer('agent_stage_seconds', stage='warm_up'):
+        await init(test, name)
+        rpc_client.bind()
+
+
+def initialize():
+    # called by the SDK once before the first transaction, so the first transaction does not pay for the start
+    if pool is not None:
+        pool.start()  # every worker warms up its own tables
+        return
+    runtime.run(warm_up(rpc))
 
 
 def handle_transaction(transaction_event: forta_agent.transaction_event.TransactionEvent):
+    if BLOCK_BATCH_MODE:
+        return []  # the transactions are handled by handle_block
     return real_handle_transaction(transaction_event)
 
 
+def handle_block(block_event: forta_agent.block_event.BlockEvent):
+    if not BLOCK_BATCH_MODE:
+        return []
+    return real_handle_block(block_event)
+
+
 def reset_inited():
-    global inited
+    global inited, resumed, prefetched, last_block
     inited = False
+    resumed = False
+    prefetched = False
+    last_block = None
+    for dao in registry.daos:
+        dao.ledger.reset()
+        dao.retention.reset()
+        dao.snapshots.reset()
+    deferred.reset()
+    rpc_cache.reset()
@@ -0,0 +1,180 @@
+import asyncio
+
+import eth_abi
+from web3 import Web3
+from src.const import UNISWAP_CONTRACT_ADDRESS, MULTICALL_CONTRACT_ADDRESS
+from src.config import CHECKPOINTS_SEARCH_FANOUT, MULTICALL_CHUNK_SIZE
+from src.signatures import signatures
+
+# selector of "function checkpoints(address account, uint32 index) external view returns (uint32, uint96)"
+CHECKPOINTS_SELECTOR = bytes.fromhex(signatures['selectors']['checkpoints(address,uint32)'][2:])
+# selector of "function numCheckpoints(address account) external view returns (uint32)"
+NUM_CHECKPOINTS_SELECTOR = bytes.fromhex(signatures['selectors']['numCheckpoints(address)'][2:])
+# selector of "function aggregate((address target, bytes callData)[] calls) returns (uint256, bytes[])" of Multicall2
+AGGREGATE_SELECTOR = bytes.fromhex(signatures['selectors']['aggregate((address,bytes)[])'][2:])
+
+
+def split_range(lo: int, hi: int, fanout: int) -> list:
+    """
+    This function returns the indices that split [lo, hi) into fanout + 1 parts
+    :param lo: int
+    :param hi: int
+    :param fanout: int
+    :return: indices: list
+    """
+    if hi - lo <= fanout:
+        return list(range(lo, hi))
+    return sorted({lo + (hi - lo) * k // (fanout + 1) for k in range(1, fanout + 1)})
+
+
+class WindowSearch:
+    """
+    State of the k-ary search of the first checkpoint of one account made at or after the target block
+    """
+
+    def __init__(self, account: str, num_checkpoints: int, target_block: int, fanout: int):
+        self.account = account
+        self.target_block = target_block
+        self.fanout = fanout
+        self.last = num_checkpoints - 1
+        self.lo, self.hi = 0, self.last  # the first index with block >= target_block lies in [lo, hi]
+        self.too_old = False
+        # the last checkpoint goes to the first round, it holds the current voting power
+        self.probes = [self.last] + split_range(self.lo, self.hi, fanout)
+
+    def advance(self, known: dict):
+        """
+        This function narrows the search range with the fetched probes and prepares the probes of the next round
+        :param known: (account, index) -> checkpoint: dict
+        """
+        if known[(self.account, self.last)][0] < self.target_block:
+            self.too_old = True  # last checkpoint is too old
+            self.probes = []
+            return
+        for index in sorted(probe for probe in self.probes if self.lo <= probe < self.hi):
+            if known[(self.account, index)][0] >= self.target_block:
+                self.hi = index
+                break
+            self.lo = index + 1
+        self.probes = split_range(self.lo, self.hi, self.fanout)
+
+    def window(self, known: dict) -> tuple or None:
+        """
+        :param known: (account, index) -> checkpoint: dict
+        :return: (current voting power, checkpoints from the newest to the oldest) or None if the last checkpoint is
+        older than the target block
+        """
+        if self.too_old:
+            return None
+        return known[(self.account, self.last)][1], [known[(self.account, index)]
+                                                     for index in range(self.last, self.hi - 1, -1)]
+
+
+class CheckpointLookup:
+    """
+    This class searches the checkpoints array of the delegate for the window before the proposal start. The searches
+    of all the requested accounts run in lockstep: every round of the k-ary search and the final fetch of the windows
+    are sent as one Multicall aggregate, so a batch of votes costs O(log n) eth_calls instead of one call per
+    checkpoint. The big rounds are split into the chunks of chunk_size calls, which are sent concurrently through the
+    rpc client.
+    With the cache only the calls which were not answered before are sent
+    """
+
+    def __init__(self, rpc, fanout=CHECKPOINTS_SEARCH_FANOUT, chunk_size=MULTICALL_CHUNK_SIZE, cache=None,
+                 token=UNISWAP_CONTRACT_ADDRESS):
+        self.rpc = rpc
+        self.multicall = Web3.toChecksumAddress(MULTICALL_CONTRACT_ADDRESS)
+        self.token = Web3.toChecksumAddress(token)
+        self.fanout = fanout
+        self.chunk_size = chunk_size
+        self.cache = cache
+
+    async def aggregate_chunk(self, calls: list, block: int) -> list:
+        data = AGGREGATE_SELECTOR + eth_abi.encode_abi(['(address,bytes)[]'], [[(self.token, x) for x in calls]])
+        _, return_data = eth_abi.decode_abi(['uint256', 'bytes[]'], await self.rpc.eth_call(self.multicall, data,
+                                                                                             block))
+        return list(return_data)
+
+    async def aggregate(self, calls: list, block: int, pinned: list = None) -> list:
+        """
+        This function sends the calls to the token contract as aggregate calls of at most chunk_size calls
+        :param calls: list of call data
+        :param block: int
+        :param pinned: list of bool, True if the result of the call does not depend on the block
+        :return: list of return data
+        """
+        keys = [(self.token, data, None if pinned and pinned[i] else block) for i, data in enumerate(calls)]
+        results = await self.cache.get_many(keys) if self.cache is not None else [None] * len(calls)
+        missing = [i for i, result in enumerate(results) if result is None]
+        chunks = await asyncio.gather(*[self.aggregate_chunk([calls[i] for i in missing[j:j + self.chunk_size]], block)
+                                        for j in range(0, len(missing), self.chunk_size)])
+        for i, data in zip(missing, [data for chunk in chunks for data in chunk]):
+            results[i] = data
+        if self.cache is not None:
+            await self.cache.put_many([(keys[i], results[i]) for i in missing])
+        return results
+
+    async def get_num_checkpoints(self, accounts: list, block: int) -> list:
+        """
+        This function fetches the amount of checkpoints of the accounts in one aggregate call
+        :param accounts: list
+        :param block: int
+        :return: amounts of checkpoints: list
+        """
+        return_data = await self.aggregate(
+            [NUM_CHECKPOINTS_SELECTOR + eth_abi.encode_abi(['address'], [account]) for account in accounts], block)
+        return [eth_abi.decode_abi(['uint32'], data)[0] for data in return_data]
+
+    async def get_checkpoints(self, keys: list, block: int, num_checkpoints: dict = None) -> list:
+        """
+        This function fetches the checkpoints in one aggregate call
+        :param keys: list of (account, index)
+        :param block: int
+        :param num_checkpoints: account -> amount of checkpoints at the block: dict, only the last checkpoint can be
+        rewritten later, so the results of the older ones are cached independently of the block
+        :return: checkpoints: list of (block, voting power)
+        """
+        return_data = await self.aggregate(
+            [CHECKPOINTS_SELECTOR + eth_abi.encode_abi(['address', 'uint32'], [account, index])
+             for account, index in keys], block,
+            [index < num_checkpoints[account] - 1 for account, index in keys] if num_checkpoints else None)
+        return [tuple(eth_abi.decode_abi(['uint32', 'uint96'], data)) for data in return_data]
+
+    async def get_windows(self, requests: list, block: int) -> dict:
+        """
+        This function returns the current voting power of every account and its checkpoints made at or after the
+        target block
+        :param requests: list of (account, target block)
+        :param block: int
+        :return: (account, target block) -> (current voting power, checkpoints from the newest to the oldest) or None
+        if the account has no checkpoints or the last one is older than the target block: dict
+        """
+        requests = list(dict.fromkeys(requests))
+        accounts = list(dict.fromkeys(account for account, _ in requests))
+        num_checkpoints = dict(zip(accounts, await self.get_num_checkpoints(accounts, block)))
+        searches = {request: WindowSearch(request[0], num_checkpoints[request[0]], request[1], self.fanout)
+                    for request in requests if num_checkpoints[request[0]]}
+
+        known = {}
+        while pending := [search for search in searches.values() if search.probes]:
+            keys = list(dict.fromkeys((search.account, index) for search in pending for index in search.probes
+                                      if (search.account, index) not in known))
+            known.update(zip(keys, await self.get_checkpoints(keys, block, num_checkpoints)))
+            for search in pending:
+                search.advance(known)
+
+        keys = list(dict.fromkeys((search.account, index) for search in searches.values() if not search.too_old
+                                  for index in range(search.hi, search.last + 1)
+                                  if (search.account, index) not in known))
+        known.update(zip(keys, await self.get_checkpoints(keys, block, num_checkpoints)))
+        return {request: searches[request].window(known) if request in searches else None for request in requests}
+
+    async def get_window(self, account: str, target_block: int, block: int) -> tuple or None:
+        """
+        This function returns the window of one account, see get_windows
+        :param account: str
+        :param target_block: int
+        :param block: int
+        :return: (current voting power, checkpoints from the newest to the oldest) or None
+        """
+        return (await self.get_windows([(account, target_block)], block))[(account, target_block)]
@@ -1,5 +1,37 @@
+from src.const import UNISWAP_CONTRACT_ADDRESS, GOVERNOR_BRAVO_CONTRACT_ADDRESS
+
 BLOCKS_LEADING_UP_TO_THE_PROPOSAL = 100
 BLOCKS_AFTER_VOTE_CAST = 100
 VOTING_POWER_TH_HIGH = 10000
 VOTING_POWER_TH_MEDIUM = 5000
 VOTING_POWER_TH_LOW = 1000
+CHECKPOINTS_SEARCH_FANOUT = 16
+RETENTION_SWEEP_INTERVAL_BLOCKS = 1
+BLOCK_BATCH_MODE = False
+RPC_MAX_IN_FLIGHT = 8
+RPC_TIMEOUT_SECONDS = 10
+RPC_RETRIES = 3
+RPC_BACKOFF_SECONDS = 0.25
+MULTICALL_CHUNK_SIZE = 500
+RPC_CACHE_SIZE = 100000
+RPC_CACHE_PATH = None
+METRICS_ENABLED = False
+METRICS_PORT = None
+METRICS_DUMP_INTERVAL_SECONDS = 60
+STORAGE_BACKEND = 'sqlite'
+STORAGE_SNAPSHOT_INTERVAL_BLOCKS = 100
+WRITE_BEHIND_FLUSH_MS = 500
+WRITE_BEHIND_MAX_ROWS = 1000
+RESUME_MAX_BLOCKS = 1000
+SNAPSHOT_PREFETCH_RATE = 500
+SNAPSHOT_PREFETCH_BATCH = 100
+SHARDS = 0
+TX_BUDGET_MS = 0
+DEFERRED_QUEUE_SIZE = 100
+# monitored (governor, token) pairs; the thresholds and the windows which are not set are taken from the values above.
+# The first DAO keeps the db, the alert ids and the metrics of the single-DAO agent, the tables of the others are stored
+# in the separate dbs
+DAOS = [
+    {'name': 'uniswap', 'governor': GOVERNOR_BRAVO_CONTRACT_ADDRESS, 'token': UNISWAP_CONTRACT_ADDRESS,
+     'title': 'Uniswap', 'symbol': 'UNI', 'alert_prefix': 'UNI-GOV'},
+]
@@ -1,2 +1,3 @@
 UNISWAP_CONTRACT_ADDRESS = "0x1f9840a85d5af5bf1d1762f925bdaddc4201f984"
 GOVERNOR_BRAVO_CONTRACT_ADDRESS = "0x408ed6354d4973f66138c91495f2f2fcbd8724c3"
+MULTICALL_CONTRACT_ADDRESS = "0x5ba1e12693dc8f9c48aad8770482f4739beed696"
@@ -0,0 +1,130 @@
+from weakref import WeakKeyDictionary
+
+from src.config import DAOS, BLOCKS_LEADING_UP_TO_THE_PROPOSAL, BLOCKS_AFTER_VOTE_CAST, VOTING_POWER_TH_HIGH, \
+    VOTING_POWER_TH_MEDIUM, VOTING_POWER_TH_LOW
+from src.checkpoints import CheckpointLookup
+from src.db.config import Config, config
+from src.ledger import VotingPowerLedger, ledger
+from src.retention import RetentionScheduler, retention
+from src.rpc_cache import rpc_cache
+from src.snapshots import SnapshotPrefetcher
+
+
+class Dao:
+    """
+    One monitored DAO: the GovernorBravo-like governor, the Comp-like token and the thresholds of its alerts. Every DAO
+    has its own tables, voting power ledger, snapshots and retention schedule, so the DAOs never see the rows of each
+    other
+    """
+
+    def __init__(self, name: str, governor: str, token: str, title: str = None, symbol: str = None,
+                 alert_prefix: str = None, th_low=VOTING_POWER_TH_LOW, th_medium=VOTING_POWER_TH_MEDIUM,
+                 th_high=VOTING_POWER_TH_HIGH, blocks_before=BLOCKS_LEADING_UP_TO_THE_PROPOSAL,
+                 blocks_after=BLOCKS_AFTER_VOTE_CAST, partition: str = None, db: Config = None,
+                 ledger_: VotingPowerLedger = None, retention_: RetentionScheduler = None):
+        self.name = name
+        self.governor = governor.lower()
+        self.token = token.lower()
+        self.title = title or name.capitalize()
+        self.symbol = symbol or name.upper()
+        self.alert_prefix = alert_prefix or f'{self.symbol}-GOV'
+        self.th_low = th_low
+        self.th_medium = th_medium
+        self.th_high = th_high
+        self.blocks_before = blocks_before
+        self.blocks_after = blocks_after
+        self.partition = name if partition is None else partition  # suffix of the db name, '' keeps the db name
+        self.db = db or Config()
+        self.ledger = ledger_ or VotingPowerLedger()
+        self.retention = retention_ or RetentionScheduler(blocks_after=blocks_after,
+                                                          labels={'dao': name} if self.partition else {})
+        self.snapshots = SnapshotPrefetcher()
+        self.lookups = WeakKeyDictionary()  # rpc client -> CheckpointLookup of the token
+
+    def __repr__(self):
+        return f'Dao({self.name})'
+
+    def db_name(self, name: str) -> str:
+        """
+        :param name: name of the db of the agent: str
+        :return: name of the db of the DAO: str
+        """
+        return f'{name}_{self.partition}' if self.partition else name
+
+    def get_lookup(self, rpc_client) -> CheckpointLookup:
+        """
+        This function returns the checkpoint lookup of the token through the rpc client, the lookups of all the DAOs
+        share the rpc cache
+        :param rpc_client: RpcClient
+        :return: CheckpointLookup
+        """
+        if rpc_client not in self.lookups:
+            self.lookups[rpc_client] = CheckpointLookup(rpc_client, token=self.token, cache=rpc_cache)
+        return self.lookups[rpc_client]
+
+
+class DaoRegistry:
+    """
+    Registry of the monitored DAOs with the routing table contract address -> DAO, so the decoded events are grouped by
+    DAO in one pass whatever the amount of the DAOs is
+    """
+
+    def __init__(self, daos: list):
+        self.daos = []
+        self.by_address = {}  # lowercase address of the governor or the token -> Dao
+        for dao in daos:
+            self.add(dao)
+
+    @property
+    def default(self) -> Dao:
+        return self.daos[0]
+
+    def add(self, dao: Dao):
+        for address in [dao.governor, dao.token]:
+            if address in self.by_address:
+                raise ValueError(f'{address} is already monitored by {self.by_address[address]}')
+        self.daos.append(dao)
+        self.by_address[dao.governor] = dao
+        self.by_address[dao.token] = dao
+
+    def remove(self, dao: Dao):
+        self.daos.remove(dao)
+        del self.by_address[dao.governor]
+        del self.by_address[dao.token]
+
+    def addresses(self) -> list:
+        """
+        :return: addresses of all the monitored contracts: list
+        """
+        return list(self.by_address)
+
+    def split(self, events: dict) -> dict:
+        """
+        This function groups the decoded events by the DAO of the contract which emitted them
+        :param events: event name -> list of the decoded events: dict
+        :return: Dao -> event name -> list of the decoded events: dict
+        """
+        by_dao = {}
+        for name, events_ in events.items():
+            for event in events_:
+                by_dao.setdefault(self.by_address[event['address'].lower()], {}).setdefault(name, []).append(event)
+        return by_dao
+
+    def retention_due(self, block: int) -> bool:
+        return any(dao.retention.is_due(block) for dao in self.daos)
+
+
+def create_registry(daos: list) -> DaoRegistry:
+    """
+    This function creates the registry from the DAOS config, the first DAO keeps the db, the ledger and the retention
+    singletons of the single-DAO agent
+    :param daos: list of dict
+    :return: DaoRegistry
+    """
+    first, *rest = daos
+    retention.blocks_after = first.get('blocks_after', BLOCKS_AFTER_VOTE_CAST)
+    return DaoRegistry([Dao(**{'partition': ''} | first, db=config, ledger_=ledger, retention_=retention)] +
+                       [Dao(**params) for params in rest])
+
+
+registry = create_registry(DAOS)
@@ -3,6 +3,9 @@ class Config:
         self.proposals = None
         self.votes = None
         self.base = None
+        self.engine = None
+        self.session = None
+        self.storage = None  # MemoryStorage or None for the sqlite backend
 
     def get_proposals(self):
         return self.proposals
@@ -17,5 +20,39 @@ class Config:
     def set_base(self, base):
         self.base = base
 
+    def set_engine(self, engine):
+        self.engine = engine
+
+    def set_session(self, session):
+        self.session = session
+
+    def set_storage(self, storage):
+        self.storage = storage
+
+    def unit_of_work(self):
+        """
+        This function returns the context manager which shares one session between all the tables
+        """
+        if self.storage is not None:
+            return self.storage.unit_of_work()
+        from .methods import unit_of_work  # sqlalchemy is loaded by the initialization, not by the import
+        return unit_of_work(self.session)
+
+    def block_processed(self, block: int, complete: bool = False):
+        """
+        This function is called after the unit of work of the transaction or the block, the in-memory backends persist
+        their tables here
+        :param block: int
+        :param complete: True if all the transactions of the block were handled
+        """
+        if self.storage is not None:
+            self.storage.block_processed(block, complete)
+
+    def last_processed_block(self) -> int or None:
+        """
+        :return: the last fully processed block persisted by the storage backend or None if it is unknown
+        """
+        return self.storage.last_processed_block if self.storage is not None else None
+
 
 config = Config()
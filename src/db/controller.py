@@ -1,28 +1,101 @@
+import logging
+import os
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from .config import config
-from .models import wrapped_models as wrapped_models_func
+from .models import wrapped_models as wrapped_models_func, wrapped_state_model
 from .methods import wrapped_methods
+from .migrations import migrate, is_current, stamp
+from .memory import MemoryStorage
+from .write_behind import WriteBehindStorage
+from src.metrics import metrics
+from src.config import STORAGE_BACKEND, STORAGE_SNAPSHOT_INTERVAL_BLOCKS, WRITE_BEHIND_FLUSH_MS, WRITE_BEHIND_MAX_ROWS
+
+logger = logging.getLogger(__name__)
+
+
+async def init_async_db(test=False, name=None, backend=None, db=config):
+    """
+    This function creates the tables of the storage backend
+    :param test: bool, the tests start from the empty tables
+    :param name: name of the db: str
+    :param backend: 'sqlite', 'memory' or 'write_behind'
+    :param db: Config of the DAO which receives the engine and the storage
+    :return: proposals and votes tables
+    """
+    name = name or ("test" if test else "main")
+    backend = backend or STORAGE_BACKEND
+    if db.storage is not None:
+        await db.storage.close()  # the write-behind queue is flushed before its engine is disposed
+        db.set_storage(None)
+    if db.engine is not None:
+        await db.engine.dispose()  # the engine is long-lived, release the previous pool before re-initialization
+        db.set_engine(None)
+    if backend == 'memory':
+        return await init_memory_db(test, name, db)
+    if backend == 'write_behind':
+        return await init_write_behind_db(test, name, db)
+    if backend != 'sqlite':
+        logger.warning(f'unknown storage backend {backend}, sqlite is used')
+
+    session, wrapped_models = await init_sqlite_db(test, name, db=db)
+    proposals, votes = await wrapped_methods(wrapped_models, session)
+    return proposals, votes
 
 
-async def init_async_db(test=False):
-    name = "test" if test else "main"
+async def init_sqlite_db(test=False, name="main", wal=False, db=config):
     engine = create_async_engine(fr'sqlite+aiosqlite:///./{name}.db', future=True, echo=False)
+    if wal:
+        event.listen(engine.sync_engine, 'connect', set_wal_mode)
+    db.set_engine(engine)
+    metrics.instrument_engine(engine.sync_engine)
 
     session = sessionmaker(
         engine, expire_on_commit=False, class_=AsyncSession
     )
+    db.set_session(session)
 
     base = declarative_base()
-    config.set_base(base)
+    db.set_base(base)
     wrapped_models = await wrapped_models_func(base)
+    await wrapped_state_model(base)
 
     async with engine.begin() as conn:
         if test:
             await conn.run_sync(base.metadata.drop_all)
+        elif await conn.run_sync(is_current, base):
+            return session, wrapped_models  # the previous start left the current schema
+        await conn.run_sync(migrate, base)  # bring the db created by the previous versions to the current schema
         await conn.run_sync(base.metadata.create_all)
+        await conn.run_sync(stamp, base)
+    return session, wrapped_models
 
-    proposals, votes = await wrapped_methods(wrapped_models, session)
-    return proposals, votes
+
+def set_wal_mode(dbapi_connection, _):
+    # the readers do not wait for the background writer and the commits do not fsync the whole db
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+async def init_memory_db(test=False, name="main", db=config):
+    path = f'./{name}.snapshot.json'
+    if test and os.path.exists(path):
+        os.remove(path)  # the tests start from the empty tables as with the sqlite backend
+    storage = MemoryStorage(path, STORAGE_SNAPSHOT_INTERVAL_BLOCKS)
+    await storage.load()
+    db.set_storage(storage)
+    return storage.proposals, storage.votes
+
+
+async def init_write_behind_db(test=False, name="main", db=config):
+    await init_sqlite_db(test, name, wal=True, db=db)
+    storage = WriteBehindStorage(db.engine, db.base, WRITE_BEHIND_FLUSH_MS / 1000, WRITE_BEHIND_MAX_ROWS)
+    await storage.load()
+    db.set_storage(storage)
+    return storage.proposals, storage.votes
@@ -0,0 +1,191 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+
+class RowIndex:
+    """
+    In-memory index of the rows of the table by the key column. The rows of every key are kept in the order of the
+    block column next to the array of their blocks, so the rows of the key since a block are found by bisection. All the
+    rows are also kept in the order of the block column, so the rows removed by the retention are dropped from the index
+    without a scan
+    """
+
+    def __init__(self, key_column: str, block_column: str, key=None):
+        """
+        :param key_column: str
+        :param block_column: str
+        :param key: function which converts the looked up value to the value of the key column, e.g. the address to
+        the 20-byte key
+        """
+        self.key_column = key_column
+        self.block_column = block_column
+        self.key = key
+        self._rows = {}  # key -> list of the rows in the order of the block column
+        self._blocks = {}  # key -> array of the block column of the rows
+        self._by_block = deque()  # rows in the order of the block column
+
+    def __contains__(self, key) -> bool:
+        return (self.key(key) if self.key else key) in self._rows
+
+    def __len__(self) -> int:
+        return len(self._by_block)
+
+    def keys(self):
+        return self._rows.keys()
+
+    def get(self, key, since: int = None) -> list:
+        """
+        This function returns the indexed rows with the given key
+        :param key: value of the key column
+        :param since: the minimal block of the rows, all the rows of the key are returned if it is not set
+        :return: rows in the order of the block column: list
+        """
+        key = self.key(key) if self.key else key
+        rows = self._rows.get(key, [])
+        if since is None or not rows:
+            return rows
+        return rows[bisect_left(self._blocks[key], since):]
+
+    def add(self, row):
+        """
+        This function adds the row to the index
+        :param row: Record or model instance
+        """
+        key, block = getattr(row, self.key_column), getattr(row, self.block_column)
+        rows, blocks = self._rows.setdefault(key, []), self._blocks.setdefault(key, array('Q'))
+        position = bisect_right(blocks, block)  # the rows are appended unless they come out of order
+        rows.insert(position, row)
+        blocks.insert(position, block)
+        if self._by_block and getattr(self._by_block[-1], self.block_column) > getattr(row, self.block_column):
+            self._by_block = deque(sorted([*self._by_block, row], key=lambda x: getattr(x, self.block_column)))
+        else:
+            self._by_block.append(row)
+
+    def remove(self, row):
+        """
+        This function removes the row from the index, it is used to undo the rolled back changes
+        :param row: the indexed row
+        """
+        self._by_block.remove(row)  # the records are compared by identity
+        self._drop(row)
+
+    def _drop(self, row):
+        key = getattr(row, self.key_column)
+        rows, blocks = self._rows[key], self._blocks[key]
+        position = next(i for i, x in enumerate(rows) if x is row)
+        del rows[position]
+        del blocks[position]
+        if not rows:
+            del self._rows[key]
+            del self._blocks[key]
+
+    def expire(self, block: int) -> list:
+        """
+        This function removes the rows whose block column is less than the block, it mirrors the retention query
+        :param block: int
+        :return: removed rows: list
+        """
+        removed = []
+        while self._by_block and getattr(self._by_block[0], self.block_column) < block:
+            row = self._by_block.popleft()
+            self._drop(row)  # it is one of the first rows of the key
+            removed.append(row)
+        return removed
+
+
+class ProposalIndex:
+    """
+    In-memory interval index of the proposals over [start_block, end_block]. The proposals are kept by id and in the
+    order of the end block next to the array of the end blocks, so the proposals ended before a block are a prefix found
+    by bisection and the active ones are looked up among the rest, the retention drops the prefix
+    """
+    block_column = 'end_block'
+
+    def __init__(self):
+        self._by_id = {}  # proposal id -> row
+        self._rows = []  # rows in the order of the end block
+        self._ends = array('Q')  # end blocks of the rows
+
+    def __contains__(self, proposal_id) -> bool:
+        return proposal_id in self._by_id
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get(self, proposal_id, since: int = None) -> list:
+        """
+        This function returns the proposal with the given id, it has the same format as RowIndex.get
+        :param proposal_id: int
+        :param since: not used, the proposal ids are unique
+        :return: list of one row or empty list
+        """
+        row = self._by_id.get(proposal_id)
+        return [] if row is None else [row]
+
+    def add(self, row):
+        """
+        This function adds the proposal to the index, the updated proposal replaces the stored one
+        :param row: Record or model instance
+        """
+        if row.proposal_id in self._by_id:
+            self.remove(self._by_id[row.proposal_id])
+        position = bisect_right(self._ends, row.end_block)
+        self._rows.insert(position, row)
+        self._ends.insert(position, row.end_block)
+        self._by_id[row.proposal_id] = row
+
+    def remove(self, row):
+        position = bisect_left(self._ends, row.end_block)
+        while self._rows[position] is not row:
+            position += 1
+        del self._rows[position]
+        del self._ends[position]
+        del self._by_id[row.proposal_id]
+
+    def ended_before(self, block: int) -> list:
+        """
+        :param block: int
+        :return: proposals whose end block is less than the block: list
+        """
+        return self._rows[:bisect_left(self._ends, block)]
+
+    def active(self, block: int) -> list:
+        """
+        :param block: int
+        :return: proposals whose [start_block, end_block] contains the block: list
+        """
+        return [row for row in self._rows[bisect_left(self._ends, block):] if row.start_block <= block]
+
+    def open(self, block: int) -> list:
+        """
+        :param block: int
+        :return: proposals whose end block is not less than the block, they are active or pending: list
+        """
+        return self._rows[bisect_left(self._ends, block):]
+
+    def window(self, block: int) -> tuple or None:
+        """
+        This function returns the boundaries of the blocks covered by the proposals which are not ended before the
+        block, they are active or pending
+        :param block: int
+        :return: (the minimal start block, the maximal end block) or None if there are no such proposals
+        """
+        position = bisect_left(self._ends, block)
+        if position == len(self._rows):
+            return None
+        return min(row.start_block for row in self._rows[position:]), self._ends[-1]
+
+    def expire(self, block: int) -> list:
+        """
+        This function removes the proposals whose end block is less than the block, it mirrors the retention query
+        :param block: int
+        :return: removed proposals: list
+        """
+        position = bisect_left(self._ends, block)
+        removed = self._rows[:position]
+        for row in removed:
+            del self._by_id[row.proposal_id]
+        del self._rows[:position]
+        del self._ends[:position]
+        return removed
@@ -0,0 +1,225 @@
+import json
+import os
+from contextlib import asynccontextmanager
+
+from .methods import NATURAL_KEYS, create_index
+from .records import RECORDS, Record
+
+# columns of the tables of src/db/models.py
+COLUMNS = {
+    'proposals': ('proposal_id', 'start_block', 'end_block'),
+    'votes': ('proposal_id', 'voter', 'support', 'block_number', 'votes', 'reason', 'influencing', 'transaction_hash',
+              'log_index'),
+}
+# columns looked up by get_row_by_criteria, they are kept in the hash indexes
+LOOKUP_COLUMNS = {'proposals': ('proposal_id',), 'votes': ('proposal_id',)}
+
+
+class MemoryMethods:
+    """
+    In-memory implementation of the async API of Methods: the rows are the compact records of src/db/records.py, they
+    live in a dict by id with the hash indexes of the looked up columns, so no call leaves the process
+    """
+
+    def __init__(self, table: str, index=None):
+        self.table = table
+        self.columns = COLUMNS[table]
+        self.record = RECORDS[table]
+        self.natural_key, self.update_on_conflict = NATURAL_KEYS.get(table, ((), False))
+        self.rows = {}  # id -> row in the order of insertion
+        self.keys = {}  # natural key -> row, the rows with NULL in the key are not unique as in sqlite
+        self.lookup = {column: {} for column in LOOKUP_COLUMNS.get(table, ())}  # column -> value -> list of rows
+        self.next_id = 1
+        self.index = index  # RowIndex, ProposalIndex or None
+        self.journal = None  # list which receives the changes, it is set by the write-behind storage
+
+    def get_indexed_rows(self, key, since: int = None) -> list:
+        """
+        This function returns the rows with the given key from the in-memory index
+        :param key: value of the key column
+        :param since: the minimal block of the rows, all the rows of the key are returned if it is not set
+        :return: rows in the order of the block column: list
+        """
+        return self.index.get(key, since)
+
+    async def build_index(self):
+        """
+        This function fills the index with the rows loaded from the snapshot
+        """
+        if self.index is None:
+            return
+        for row in sorted(self.rows.values(), key=lambda x: getattr(x, self.index.block_column)):
+            self.index.add(row)
+
+    def natural_key_of(self, values) -> tuple or None:
+        key = tuple(values.get(column) for column in self.natural_key)
+        return key if key and None not in key else None
+
+    def insert(self, kwargs: dict, row_id: int = None) -> Record or None:
+        """
+        This function inserts the row, the row whose natural key is already stored updates the stored row or is skipped
+        :param kwargs: values of the columns: dict
+        :param row_id: id of the row loaded from the db or the snapshot
+        :return: inserted or updated row or None if it was skipped
+        """
+        key = self.natural_key_of(kwargs)
+        if key is not None and key in self.keys:
+            if not self.update_on_conflict:
+                return None
+            stored = self.keys[key]
+            self.remove(stored)
+            return self.insert(kwargs, stored.id)
+        row = self.record(id=row_id or self.next_id, **{column: kwargs.get(column) for column in self.columns})
+        self.next_id = max(self.next_id, row.id + 1)
+        self.rows[row.id] = row
+        if key is not None:
+            self.keys[key] = row
+        for column, values in self.lookup.items():
+            values.setdefault(getattr(row, column), []).append(row)
+        if self.journal is not None:
+            self.journal.append(('insert', self.table, row.as_dict()))
+        return row
+
+    def remove(self, row: Record):
+        del self.rows[row.id]
+        self.keys.pop(self.natural_key_of(row.as_dict()), None)
+        for column, values in self.lookup.items():
+            rows = values[getattr(row, column)]
+            rows.remove(row)
+            if not rows:
+                del values[getattr(row, column)]
+
+    async def commit(self):
+        pass  # the changes are applied immediately, the snapshots persist them
+
+    async def paste_row(self, kwargs):
+        row = self.insert(kwargs)
+        if row is not None and self.index is not None:
+            self.index.add(row)
+
+    async def paste_rows(self, rows: list):
+        for kwargs in rows:
+            await self.paste_row(kwargs)
+
+    async def delete_where_less(self, column: str, bound: int, rows: list = None) -> int:
+        """
+        This function deletes the rows whose column is less than the bound
+        :param column: str
+        :param bound: int
+        :param rows: the rows to delete found by the index, the table is scanned if it is not set
+        :return: amount of the deleted rows: int
+        """
+        if rows is None:
+            rows = [row for row in self.rows.values() if getattr(row, column) < bound]
+        for row in rows:
+            self.remove(row)
+        if self.journal is not None:
+            self.journal.append(('delete', self.table, column, bound))
+        return len(rows)
+
+    async def delete_old_votes(self, block, th) -> int:
+        # the index finds the expired rows without the scan of the table
+        expired = self.index.expire(block - th) if self.index is not None else None
+        return await self.delete_where_less('block_number', block - th, expired)
+
+    def get_proposal(self, proposal_id) -> Record or None:
+        return next(iter(self.index.get(proposal_id)), None)
+
+    def get_active_proposals(self, block) -> list:
+        return self.index.active(block)
+
+    def get_open_proposals(self, block) -> list:
+        return self.index.open(block)
+
+    def get_active_window(self, block) -> tuple or None:
+        return self.index.window(block)
+
+    async def delete_old_proposals(self, block, th) -> int:
+        # the index finds the expired rows without the scan of the table
+        expired = self.index.expire(block - th) if self.index is not None else None
+        return await self.delete_where_less('end_block', block - th, expired)
+
+    async def count_rows(self) -> int:
+        return len(self.rows)
+
+    async def get_all_rows(self) -> list:
+        return list(self.rows.values())
+
+    async def get_row_by_criteria(self, criteria: dict) -> Record or None:
+        column, value = next(iter(criteria.items()))
+        if column in self.lookup:
+            rows = self.lookup[column].get(value)
+            return rows[0] if rows else None
+        return next((row for row in self.rows.values() if getattr(row, column) == value), None)
+
+    async def get_ended_proposals_rows(self, block) -> list:
+        if self.index is not None:
+            return self.index.ended_before(block)
+        return [row for row in self.rows.values() if row.end_block < block]
+
+    def dump(self) -> list:
+        return [row.as_dict() for row in self.rows.values()]
+
+    def load(self, rows: list):
+        for row in rows:
+            self.insert(row, row['id'])
+
+
+class MemoryStorage:
+    """
+    Storage backend which keeps the tables in memory and writes their snapshot to the disk once per snapshot_interval
+    blocks. The snapshot is replaced atomically, so after a crash the agent restarts from the last complete one
+    """
+
+    def __init__(self, path: str, snapshot_interval: int):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.proposals = MemoryMethods('proposals', create_index('proposals'))
+        self.votes = MemoryMethods('votes', create_index('votes'))
+        self.last_snapshot_block = None
+
+    @asynccontextmanager
+    async def unit_of_work(self):
+        yield self
+
+    @property
+    def last_processed_block(self):
+        return None  # the snapshot may hold a part of the block, so the agent does not resume from it
+
+    async def close(self):
+        pass
+
+    async def load(self):
+        """
+        This function restores the tables from the snapshot if it exists
+        """
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                snapshot = json.load(file)
+            self.proposals.load(snapshot['proposals'])
+            self.votes.load(snapshot['votes'])
+            self.last_snapshot_block = snapshot['block']
+        for table in [self.proposals, self.votes]:
+            await table.build_index()
+
+    def snapshot(self, block: int):
+        """
+        This function writes the tables to the temporary file and moves it over the previous snapshot
+        :param block: the last block whose changes are in the tables: int
+        """
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'block': block, 'proposals': self.proposals.dump(), 'votes': self.votes.dump()}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_snapshot_block = block
+
+    def block_processed(self, block: int, complete: bool = False):
+        """
+        This function writes the snapshot if snapshot_interval blocks have passed since the last one
+        :param block: int
+        :param complete: True if all the transactions of the block were handled
+        """
+        if self.last_snapshot_block is None or block - self.last_snapshot_block >= self.snapshot_interval:
+            self.snapshot(block)
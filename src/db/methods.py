@@ -1,46 +1,233 @@
-from sqlalchemy import delete
+import asyncio
+from functools import partial
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import delete, func
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.future import select
 
+from .index import RowIndex, ProposalIndex
+from .records import RECORDS, address_key
+from src.metrics import metrics, current_db_operation
+
+# in-memory indexes of the tables: table name -> function which creates the index; the indexes hold the compact records
+# of src/db/records.py
+INDEXES = {
+    'votes': partial(RowIndex, 'voter_key', 'block_number', address_key),  # by the 20-byte key of the voter
+    'proposals': ProposalIndex,  # by id and by [start_block, end_block]
+}
+# natural keys of the tables: table name -> (key columns, True if the stored row is updated on conflict, False if the
+# new row is skipped), so the re-scans of the same transactions are no-ops
+NATURAL_KEYS = {'proposals': (('proposal_id',), True), 'votes': (('transaction_hash', 'log_index'), False)}
+
+
+def create_index(table: str):
+    return INDEXES[table]() if table in INDEXES else None
+
 
 async def wrapped_methods(wrapped_models: tuple, async_session) -> list:
-    return [Methods(model, async_session) for model in wrapped_models]
+    methods = [Methods(model, async_session, create_index(model.__tablename__), NATURAL_KEYS.get(model.__tablename__))
+               for model in wrapped_models]
+    for table in methods:
+        await table.build_index()
+    return methods
+
+
+class UnitOfWork:
+    """
+    One session and one db transaction shared by all the methods called inside unit_of_work()
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.lock = asyncio.Lock()  # the detectors are gathered concurrently, but the session is not concurrency-safe
+        self.undo = []  # functions which revert the changes of the in-memory indexes, in the order of the changes
+
+    def on_rollback(self, undo):
+        """
+        This function registers the function which reverts the change of the in-memory index, it is called if the db
+        transaction is rolled back. The change itself is applied at once, so the later detectors of the unit of work
+        see it as they see the flushed rows
+        :param undo: function
+        """
+        self.undo.append(undo)
+
+    def rollback(self):
+        for undo in reversed(self.undo):
+            undo()
+        self.undo.clear()
+
+
+current_unit_of_work = ContextVar('current_unit_of_work', default=None)
+
+
+@asynccontextmanager
+async def unit_of_work(async_session):
+    """
+    This function opens one session for all the db methods called inside the context and commits it once at the end
+    :param async_session: sessionmaker
+    """
+    if current_unit_of_work.get() is not None:  # nested units of work join the outer one
+        yield current_unit_of_work.get()
+        return
+    async with async_session() as session:
+        uow = UnitOfWork(session)
+        token = current_unit_of_work.set(uow)
+        try:
+            async with session.begin():
+                yield uow
+        except BaseException:
+            uow.rollback()  # the db transaction is rolled back, the in-memory indexes follow it
+            raise
+        finally:
+            current_unit_of_work.reset(token)
 
 
 def wrap_async(func):
     async def wrapper(*args, **kwargs):
-        async with args[0]._session() as session:
-            async with session.begin():
-                kwargs |= {'session': session}
-                result = await func(*args, **kwargs)
-                return result
+        token = current_db_operation.set(func.__name__)  # the statements are counted by the operation
+        try:
+            with metrics.timer('agent_db_operation_seconds', operation=func.__name__):
+                return await run_in_session(func, *args, **kwargs)
+        finally:
+            current_db_operation.reset(token)
 
     return wrapper
 
 
+async def run_in_session(func, *args, **kwargs):
+    uow = current_unit_of_work.get()
+    if uow is None:  # the method called outside of the unit of work runs in its own one
+        async with unit_of_work(args[0]._session):
+            return await run_in_session(func, *args, **kwargs)
+    async with uow.lock:
+        kwargs |= {'session': uow.session}
+        return await func(*args, **kwargs)
+
+
 class Methods:
 
-    def __init__(self, model: object(), session):
+    def __init__(self, model: object(), session, index=None, natural_key: tuple = None):
         self.__model = model
         self._session = session
+        self.index = index  # RowIndex, ProposalIndex or None
+        self.natural_key = natural_key
+
+    def get_indexed_rows(self, key, since: int = None) -> list:
+        """
+        This function returns the rows with the given key from the in-memory index without touching the db
+        :param key: value of the key column
+        :param since: the minimal block of the rows, all the rows of the key are returned if it is not set
+        :return: rows in the order of the block column: list
+        """
+        return self.index.get(key, since)
+
+    async def build_index(self):
+        """
+        This function fills the in-memory index with the rows which are already stored in the db
+        """
+        if self.index is None:
+            return
+        record = RECORDS[self.__model.__tablename__]
+        for row in sorted(await self.get_all_rows(), key=lambda x: getattr(x, self.index.block_column)):
+            self.index.add(record.of(row))
 
     @wrap_async
     async def commit(self, session):
+        if current_unit_of_work.get() is not None:
+            await session.flush()  # the unit of work commits once at the end
+            return
         await session.commit()
 
+    async def paste_row(self, kwargs):
+        await self.paste_rows([kwargs])
+
     @wrap_async
-    async def paste_row(self, kwargs, session):
-        session.add(self.__model(**kwargs))
-        await session.flush()
+    async def paste_rows(self, rows: list, session):
+        """
+        This function inserts the rows in one statement. The rows whose natural key is already stored update the stored
+        row or are skipped, so the same transaction can be handled again
+        :param rows: list of dict
+        """
+        if not rows:
+            return
+        table = self.__model.__table__
+        statement = insert(table)
+        if self.natural_key is not None:
+            columns, update = self.natural_key
+            statement = statement.on_conflict_do_update(index_elements=list(columns), set_={
+                column.name: statement.excluded[column.name] for column in table.columns
+                if column.name not in columns and not column.primary_key}) if update else \
+                statement.on_conflict_do_nothing(index_elements=list(columns))
+        # only the inserted and the updated rows are returned
+        q = await session.execute(statement.values(rows).returning(*table.columns))
+        if self.index is not None:
+            for row in q.mappings().all():
+                self.index_row(RECORDS[table.name].of(dict(row)))
+
+    def index_row(self, row):
+        """
+        This function adds the inserted or updated row to the in-memory index, the change is reverted if the unit of
+        work is rolled back
+        :param row: Record
+        """
+        replaced = self.index.get(row.proposal_id) if isinstance(self.index, ProposalIndex) else []
+        self.index.add(row)
+
+        def undo():
+            self.index.remove(row)
+            for stored in replaced:
+                self.index.add(stored)
+
+        current_unit_of_work.get().on_rollback(undo)
+
+    def expire_index(self, block: int):
+        """
+        This function drops the rows removed by the retention from the in-memory index, they are restored if the unit
+        of work is rolled back
+        :param block: int
+        """
+        if self.index is None:
+            return
+        removed = self.index.expire(block)
+        current_unit_of_work.get().on_rollback(lambda: [self.index.add(row) for row in removed])
 
     @wrap_async
     async def delete_old_votes(self, block, th, session) -> int:
-        return await session.execute(
+        self.expire_index(block - th)
+        q = await session.execute(
             delete(self.__model).where(getattr(self.__model, 'block_number') < block - th))
+        return q.rowcount
+
+    def get_proposal(self, proposal_id) -> object or None:
+        """
+        This function returns the proposal from the in-memory interval index without touching the db
+        :param proposal_id: int
+        :return: ProposalRecord or None
+        """
+        return next(iter(self.index.get(proposal_id)), None)
+
+    def get_active_proposals(self, block) -> list:
+        return self.index.active(block)
+
+    def get_open_proposals(self, block) -> list:
+        return self.index.open(block)
+
+    def get_active_window(self, block) -> tuple or None:
+        return self.index.window(block)
 
     @wrap_async
     async def delete_old_proposals(self, block, th, session) -> int:
-        return await session.execute(
+        self.expire_index(block - th)
+        q = await session.execute(
             delete(self.__model).where(getattr(self.__model, 'end_block') < block - th))
+        return q.rowcount
+
+    @wrap_async
+    async def count_rows(self, session) -> int:
+        q = await session.execute(select(func.count()).select_from(self.__model))
+        return q.scalar()
 
     @wrap_async
     async def get_all_rows(self, session) -> tuple or None:
@@ -54,7 +241,12 @@ class Methods:
             select(self.__model).where(getattr(self.__model, list(criteria.keys())[0]) == list(criteria.values())[0]))
         return q.scalars().first()
 
+    async def get_ended_proposals_rows(self, block) -> list:
+        if self.index is not None:
+            return self.index.ended_before(block)
+        return await self.select_ended_proposals_rows(block)
+
     @wrap_async
-    async def get_ended_proposals_rows(self, block, session) -> object or None:
+    async def select_ended_proposals_rows(self, block, session) -> object or None:
         q = await session.execute(select(self.__model).where(self.__model.end_block < block))
         return q.scalars().all()
@@ -0,0 +1,89 @@
+import zlib
+
+from sqlalchemy import inspect
+
+
+def is_legacy(connection, table) -> bool:
+    """
+    This function checks if the stored table has other columns or column types than the model
+    :param connection: sqlalchemy.engine.Connection
+    :param table: sqlalchemy.Table
+    :return: bool
+    """
+    stored = {column['name']: str(column['type']) for column in inspect(connection).get_columns(table.name)}
+    expected = {column.name: str(column.type.compile(connection.dialect)) for column in table.columns}
+    return stored != expected
+
+
+def convert(column, value):
+    """
+    This function converts the value stored by the legacy schema to the type of the column
+    :param column: sqlalchemy.Column
+    :param value: stored value
+    :return: converted value
+    """
+    if isinstance(value, str) and column.type.python_type is int:
+        return int(value) if value else None
+    return value
+
+
+def migrate(connection, base):
+    """
+    This function moves the rows of the tables created by the previous versions of the agent to the current schema
+    and creates the missing indexes; it is called before create_all
+    :param connection: sqlalchemy.engine.Connection
+    :param base: declarative_base
+    """
+    for table in base.metadata.sorted_tables:
+        if not inspect(connection).has_table(table.name):
+            continue
+        if not is_legacy(connection, table):
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+            continue
+
+        legacy_name = f'{table.name}_legacy'
+        connection.exec_driver_sql(f'ALTER TABLE {table.name} RENAME TO {legacy_name}')
+        for index in inspect(connection).get_indexes(legacy_name):  # the index names are not freed by the rename
+            connection.exec_driver_sql(f'DROP INDEX {index["name"]}')
+        table.create(connection)
+        rows = connection.exec_driver_sql(f'SELECT * FROM {legacy_name}').mappings().all()
+        if rows:
+            connection.execute(table.insert(), [
+                {column.name: convert(column, row[column.name]) for column in table.columns if column.name in row}
+                for row in rows])
+        connection.exec_driver_sql(f'DROP TABLE {legacy_name}')
+
+
+def schema_version(connection, base) -> int:
+    """
+    This function fingerprints the tables, the columns and the indexes of the models
+    :param connection: sqlalchemy.engine.Connection
+    :param base: declarative_base
+    :return: positive 31-bit int, it fits PRAGMA user_version
+    """
+    schema = [(table.name, [(column.name, str(column.type.compile(connection.dialect)), column.nullable,
+                             column.primary_key) for column in table.columns],
+               sorted((index.name, [column.name for column in index.columns]) for index in table.indexes))
+              for table in base.metadata.sorted_tables]
+    return zlib.crc32(repr(schema).encode()) & 0x7fffffff or 1
+
+
+def is_current(connection, base) -> bool:
+    """
+    This function checks if the db was brought to the current schema by the previous start, so the start skips the
+    inspection of migrate and create_all
+    :param connection: sqlalchemy.engine.Connection
+    :param base: declarative_base
+    :return: bool
+    """
+    return connection.exec_driver_sql('PRAGMA user_version').scalar() == schema_version(connection, base)
+
+
+def stamp(connection, base):
+    """
+    This function stores the fingerprint of the current schema in the db, it is called after create_all
+    :param connection: sqlalchemy.engine.Connection
+    :param base: declarative_base
+    """
+    connection.exec_driver_sql(f'PRAGMA user_version = {schema_version(connection, base)}')
@@ -1,5 +1,25 @@
-from sqlalchemy import Column, String, Integer, Boolean
+from sqlalchemy import Column, String, Integer, Boolean, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import TypeDecorator
+
+
+class Uint256(TypeDecorator):
+    """
+    Unsigned integer which does not fit into the 64-bit INTEGER of SQLite (e.g. uint96 amount of votes). It is stored
+    as a zero-padded decimal string, so the comparisons and the ordering in SQL stay numeric
+    """
+    impl = String(78)
+    cache_ok = True
+
+    @property
+    def python_type(self):
+        return int
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else f'{int(value):078d}'
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else int(value)
 
 
 async def wrapped_models(Base: declarative_base):
@@ -7,20 +27,33 @@ async def wrapped_models(Base: declarative_base):
         __tablename__ = 'proposals'
 
         id = Column(Integer, primary_key=True, autoincrement=True)
-        proposal_id = Column(String, unique=True)
+        proposal_id = Column(Integer, unique=True)
         start_block = Column(Integer)
-        end_block = Column(Integer)
+        end_block = Column(Integer, index=True)
 
     class Votes(Base):
         __tablename__ = 'votes'
+        __table_args__ = (UniqueConstraint('transaction_hash', 'log_index'),)  # one row per VoteCast log
 
         id = Column(Integer, primary_key=True, autoincrement=True)
-        proposal_id = Column(String)
-        voter = Column(String)
-        support = Column(String)
-        block_number = Column(Integer)
-        votes = Column(String)
+        proposal_id = Column(Integer, index=True)
+        voter = Column(String, index=True)
+        support = Column(Integer)
+        block_number = Column(Integer, index=True)
+        votes = Column(Uint256)
         reason = Column(String)
         influencing = Column(Boolean)
+        transaction_hash = Column(String)
+        log_index = Column(Integer)
 
     return Proposals, Votes
+
+
+async def wrapped_state_model(Base: declarative_base):
+    class State(Base):
+        __tablename__ = 'agent_state'
+
+        key = Column(String, primary_key=True)
+        value = Column(Integer)
+
+    return State
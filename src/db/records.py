@@ -0,0 +1,72 @@
+from eth_utils import to_checksum_address
+
+
+def address_key(address) -> bytes:
+    """
+    This function converts the address to the 20-byte key, the keys of the same address in any case are equal
+    :param address: hex str or 20-byte key
+    :return: bytes
+    """
+    return address if isinstance(address, bytes) else bytes.fromhex(address[2:])
+
+
+class Record:
+    """
+    Compact row of the hot state: the attributes live in __slots__ instead of the instance dict, so a tracked row costs
+    a fraction of the ORM instance. The amounts are kept as native ints, so the detectors compare them without parsing
+    """
+    __slots__ = ()
+    columns = ()
+
+    def __init__(self, **kwargs):
+        for column in self.__slots__:
+            setattr(self, column, None)
+        for column, value in kwargs.items():
+            setattr(self, column, value)
+
+    @classmethod
+    def of(cls, row):
+        """
+        This function copies the model instance or the mapping of the row into the record
+        :param row: model instance or dict
+        :return: Record
+        """
+        if isinstance(row, dict):
+            return cls(**{column: row.get(column) for column in cls.columns})
+        return cls(**{column: getattr(row, column) for column in cls.columns})
+
+    def as_dict(self) -> dict:
+        """
+        :return: values of the columns in the format of the db: dict
+        """
+        return {column: getattr(self, column) for column in self.columns}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.as_dict()})'
+
+
+class ProposalRecord(Record):
+    __slots__ = ('id', 'proposal_id', 'start_block', 'end_block')
+    columns = __slots__
+
+
+class VoteRecord(Record):
+    """
+    The voter is stored as the 20-byte key, the checksum address is built only when the row leaves the hot state
+    """
+    __slots__ = ('id', 'proposal_id', 'voter_key', 'support', 'block_number', 'votes', 'reason', 'influencing',
+                 'transaction_hash', 'log_index')
+    columns = ('id', 'proposal_id', 'voter', 'support', 'block_number', 'votes', 'reason', 'influencing',
+               'transaction_hash', 'log_index')
+
+    @property
+    def voter(self) -> str or None:
+        return None if self.voter_key is None else to_checksum_address(self.voter_key)
+
+    @voter.setter
+    def voter(self, value):
+        self.voter_key = None if value is None else address_key(value)
+
+
+# table name -> record of its rows
+RECORDS = {'proposals': ProposalRecord, 'votes': VoteRecord}
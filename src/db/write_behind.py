@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+
+from .memory import MemoryMethods
+from .methods import create_index
+
+logger = logging.getLogger(__name__)
+
+LAST_PROCESSED_BLOCK = 'last_processed_block'
+
+
+class WriteBehindStorage:
+    """
+    Storage backend which serves the detectors from the in-memory tables and writes their changes to sqlite in the
+    background. The changes are journaled by block; once the block is fully processed its changes go to the queue,
+    which is flushed every flush_interval seconds or as soon as it holds max_rows changes. The marker of the last
+    fully processed block is written in the same db transaction as the changes, so after a crash the db holds exactly
+    the blocks up to the marker and the agent resumes from the next block
+    """
+
+    def __init__(self, engine, base, flush_interval: float, max_rows: int):
+        self.engine = engine
+        self.tables = base.metadata.tables
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.proposals = MemoryMethods('proposals', create_index('proposals'))
+        self.votes = MemoryMethods('votes', create_index('votes'))
+        self.pending = []  # changes of the transactions of the blocks which are not finished yet
+        self.blocks = {}  # block -> changes made by its transactions
+        self.ready = []  # changes of the fully processed blocks, waiting for the writer
+        self.ready_block = None  # the last fully processed block
+        self.last_processed_block = None  # the last fully processed block persisted to the db
+        self.wake = asyncio.Event()
+        self.task = None
+
+    @asynccontextmanager
+    async def unit_of_work(self):
+        yield self
+
+    async def load(self):
+        """
+        This function loads the tables and the marker from the db and starts the writer on the running loop
+        """
+        async with self.engine.connect() as conn:
+            for table in [self.proposals, self.votes]:
+                rows = (await conn.execute(select(self.tables[table.table]))).mappings().all()
+                table.load([dict(row) for row in rows])
+                await table.build_index()
+            self.last_processed_block = (await conn.execute(select(self.tables['agent_state'].c.value).where(
+                self.tables['agent_state'].c.key == LAST_PROCESSED_BLOCK))).scalar()
+        self.ready_block = self.last_processed_block
+        for table in [self.proposals, self.votes]:
+            table.journal = self.pending
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def block_processed(self, block: int, complete: bool = False):
+        """
+        This function assigns the journaled changes to the block and queues the changes of the finished blocks
+        :param block: the block of the handled transaction or batch: int
+        :param complete: True if all the transactions of the block were handled (block batch mode)
+        """
+        self.blocks.setdefault(block, []).extend(self.pending)
+        self.pending.clear()
+        finished = [x for x in sorted(self.blocks) if x < block or complete and x == block]
+        for finished_block in finished:
+            self.ready.extend(self.blocks.pop(finished_block))
+        last = block if complete else block - 1
+        if self.ready_block is None or last > self.ready_block:
+            self.ready_block = last
+        if len(self.ready) >= self.max_rows:
+            self.wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:  # the changes stay in the queue and go with the next flush
+                logger.error(f'write-behind flush failed: {e}')
+
+    async def flush(self):
+        """
+        This function writes the queued changes and the marker of the last fully processed block in one db transaction
+        """
+        block = self.ready_block
+        if block is None or block == self.last_processed_block and not self.ready:
+            return
+        changes, self.ready = self.ready, []
+        try:
+            async with self.engine.begin() as conn:
+                inserts = []  # the consecutive inserts into one table go as one executemany
+                for change in changes + [None]:
+                    if inserts and (change is None or change[0] != 'insert' or change[1] != inserts[0][1]):
+                        await conn.execute(self.upsert(inserts[0][1]), [x[2] for x in inserts])
+                        inserts = []
+                    if change is None:
+                        continue
+                    if change[0] == 'insert':
+                        inserts.append(change)
+                    else:
+                        _, table, column, bound = change
+                        await conn.execute(delete(self.tables[table]).where(self.tables[table].c[column] < bound))
+                state = self.tables['agent_state']
+                await conn.execute(insert(state).values(key=LAST_PROCESSED_BLOCK, value=block).on_conflict_do_update(
+                    index_elements=[state.c.key], set_={'value': block}))
+        except BaseException:  # including the cancellation of the writer
+            self.ready = changes + self.ready
+            raise
+        self.last_processed_block = block
+
+    def upsert(self, table: str):
+        # the rows updated by the upserts of the in-memory table are written again with the same id
+        statement = insert(self.tables[table])
+        return statement.on_conflict_do_update(index_elements=['id'], set_={
+            column.name: statement.excluded[column.name] for column in self.tables[table].columns
+            if not column.primary_key})
+
+    async def close(self):
+        """
+        This function stops the writer and flushes the queue
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
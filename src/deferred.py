@@ -0,0 +1,138 @@
+import asyncio
+import contextvars
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+from src.config import TX_BUDGET_MS, DEFERRED_QUEUE_SIZE
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# loop time by which the current handler invocation has to return, None if it has no budget
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class DeferredChecks:
+    """
+    This class keeps the handler invocation within its time budget: the cheap checks run inline, the expensive work
+    (the RPC lookups of the deep checkpoint histories, the retention sweeps) which is not finished by the deadline
+    continues in the background and its findings are emitted by a later invocation. At most max_pending checks are
+    in the background, when the queue is full the check is awaited inline, so the queue never grows without a bound.
+    The storage backends are told that a block is processed only after its deferred checks have finished
+    """
+
+    def __init__(self, budget: float = TX_BUDGET_MS / 1000, max_pending: int = DEFERRED_QUEUE_SIZE):
+        self.budget = budget
+        self.max_pending = max_pending
+        self.pending = {}  # background task of the deferred check -> its block
+        self.held = []  # (block, function) which wait for the deferred checks of the block and of the earlier ones
+        self.findings = []  # findings of the finished deferred checks, waiting for the next invocation
+        self.deferred = Counter()  # check -> amount of the deferrals since start
+        self.queue_full = 0  # amount of the checks which were awaited inline because the queue was full
+
+    def reset(self):
+        for task in self.pending:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+        self.__init__(self.budget, self.max_pending)
+
+    @contextmanager
+    def deadline(self):
+        """
+        This function sets the deadline of the handler invocation for the code inside the context
+        """
+        if not self.budget:
+            yield
+            return
+        token = current_deadline.set(asyncio.get_running_loop().time() + self.budget)
+        try:
+            yield
+        finally:
+            current_deadline.reset(token)
+
+    @staticmethod
+    def expired() -> bool:
+        deadline = current_deadline.get()
+        return deadline is not None and asyncio.get_running_loop().time() >= deadline
+
+    def full(self) -> bool:
+        return len(self.pending) >= self.max_pending
+
+    async def wait(self, future: asyncio.Future) -> bool:
+        """
+        This function waits for the future until the deadline of the invocation
+        :param future: asyncio.Future of the expensive work
+        :return: True if it is done, False if the deadline has passed and the queue has room for the work
+        """
+        deadline = current_deadline.get()
+        if deadline is not None:
+            done, _ = await asyncio.wait([future], timeout=max(0.0, deadline - asyncio.get_running_loop().time()))
+            if done or not self.full():
+                return bool(done)
+            self.queue_full += 1
+            metrics.inc('agent_deferred_queue_full_total')
+        await future
+        return True
+
+    def defer(self, check: str, coro, block: int):
+        """
+        This function continues the check in the background. It runs in the fresh context: it has no deadline and
+        opens its own unit of work
+        :param check: name of the check: str
+        :param coro: coroutine which returns the findings of the check
+        :param block: the block whose transaction deferred the check: int
+        """
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task, coro)  # the task copies this context
+        self.pending[task] = block
+        task.add_done_callback(self.done)
+        self.deferred[check] += 1
+        metrics.inc('agent_deferred_checks_total', check=check)
+        metrics.set('agent_deferred_queue_depth', len(self.pending))
+
+    def done(self, task: asyncio.Task):
+        self.pending.pop(task, None)
+        metrics.set('agent_deferred_queue_depth', len(self.pending))
+        if task.cancelled():
+            pass
+        elif task.exception() is not None:
+            logger.error(f'deferred check failed: {task.exception()}')
+        else:
+            self.findings.extend(task.result() or [])
+        self.release()
+
+    def hold(self, block: int, function):
+        """
+        This function calls the function once the deferred checks of the block and of the earlier blocks have finished,
+        the held functions are called in the order of the calls
+        :param block: int
+        :param function: function without arguments, e.g. it marks the block as processed in the storage backends
+        """
+        self.held.append((block, function))
+        self.release()
+
+    def release(self):
+        oldest = min(self.pending.values(), default=None)  # the oldest block with the deferred checks in the background
+        while self.held and (oldest is None or self.held[0][0] < oldest):
+            _, function = self.held.pop(0)
+            function()
+
+    def drain(self) -> list:
+        """
+        :return: findings of the deferred checks finished since the last call: list
+        """
+        findings, self.findings = self.findings, []
+        return findings
+
+    async def join(self):
+        """
+        This function waits until the deferred checks are finished
+        """
+        while self.pending:
+            await asyncio.wait(list(self.pending))
+
+    def stats(self) -> dict:
+        return {'depth': len(self.pending), 'deferred': dict(self.deferred), 'queue_full': self.queue_full,
+                'waiting_findings': len(self.findings), 'held_blocks': len(self.held)}
+
+
+deferred = DeferredChecks()
@@ -0,0 +1,112 @@
+import eth_abi
+from eth_abi.exceptions import DecodingError
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+from hexbytes import HexBytes
+
+
+def to_hex(value) -> str:
+    """
+    This function converts the topic or the address to the lowercase hex string
+    :param value: str or bytes
+    :return: str
+    """
+    return value.lower() if isinstance(value, str) else '0x' + bytes(value).hex()
+
+
+def normalize(type_: str, value):
+    """
+    This function converts the decoded value like web3 does it: checksum addresses and lists instead of tuples
+    :param type_: str
+    :param value: decoded value
+    :return: normalized value
+    """
+    if type_.endswith(']'):
+        return [normalize(type_[:type_.rindex('[')], x) for x in value]
+    return to_checksum_address(value) if type_ == 'address' else value
+
+
+class EventDecoder:
+    """
+    Decoder of one event precompiled from its abi
+    """
+
+    def __init__(self, abi: dict, topic: str = None):
+        """
+        :param abi: event abi: dict
+        :param topic: precompiled topic0 of the event (src/signatures.py), it is hashed from the abi if it is not set
+        """
+        self.name = abi['name']
+        self.topic = topic.lower() if topic else to_hex(event_abi_to_log_topic(abi))
+        self.topic_inputs = [(x['name'], x['type']) for x in abi['inputs'] if x.get('indexed')]
+        self.data_inputs = [(x['name'], x['type']) for x in abi['inputs'] if not x.get('indexed')]
+        self.data_types = [type_ for _, type_ in self.data_inputs]
+
+    def decode(self, log) -> dict or None:
+        """
+        This function decodes the log in the same format as filter_log does
+        :param log: forta_agent.receipt.Log
+        :return: event: dict or None if the log does not match the abi
+        """
+        if len(log.topics) != len(self.topic_inputs) + 1:
+            return None
+        args = {name: normalize(type_, eth_abi.decode_single(type_, HexBytes(topic)))
+                for (name, type_), topic in zip(self.topic_inputs, log.topics[1:])}
+        data = eth_abi.decode_abi(self.data_types, HexBytes(log.data))
+        args |= {name: normalize(type_, value) for (name, type_), value in zip(self.data_inputs, data)}
+        return {'event': self.name, 'args': args, 'address': log.address, 'logIndex': log.log_index,
+                'transactionHash': log.transaction_hash, 'blockNumber': log.block_number}
+
+
+class LogDispatcher:
+    """
+    This class routes the logs of the transaction to the events by (address, topic0) in one pass. Only the logs of the
+    known events are decoded, the rest of the logs cost one dict lookup
+    """
+
+    def __init__(self, routes: list):
+        """
+        :param routes: list of (contract address, event abi or EventDecoder)
+        """
+        self.decoders = {}
+        self.add(routes)
+
+    def add(self, routes: list):
+        """
+        This function adds the routes of the contracts, the cost of the dispatch does not depend on their amount
+        :param routes: list of (contract address, event abi or EventDecoder)
+        """
+        for address, abi in routes:
+            decoder = abi if isinstance(abi, EventDecoder) else EventDecoder(abi)  # the decoders are shared by the DAOs
+            self.decoders[(address.lower(), decoder.topic)] = decoder
+        self.names = sorted({decoder.name for decoder in self.decoders.values()})
+
+    def remove(self, addresses: list):
+        """
+        This function removes the routes of the contracts
+        :param addresses: list of str
+        """
+        addresses = {address.lower() for address in addresses}
+        self.decoders = {key: decoder for key, decoder in self.decoders.items() if key[0] not in addresses}
+        self.names = sorted({decoder.name for decoder in self.decoders.values()})
+
+    def dispatch(self, logs: list) -> dict:
+        """
+        This function decodes the known events of the logs
+        :param logs: list of forta_agent.receipt.Log
+        :return: event name -> list of the decoded events in the order of the logs: dict; empty if there are no known
+        events
+        """
+        events = {}
+        for log in logs:
+            if not log.topics or not log.address:
+                continue
+            decoder = self.decoders.get((log.address.lower(), to_hex(log.topics[0])))
+            if decoder is None:
+                continue
+            try:
+                event = decoder.decode(log)
+            except (DecodingError, ValueError):
+                continue  # the log has the topic of the known event, but another layout
+            if event is not None:
+                events.setdefault(decoder.name, []).append(event)
+        return events
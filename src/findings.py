@@ -1,12 +1,11 @@
 from forta_agent import Finding, FindingType, FindingSeverity
-from src.config import BLOCKS_LEADING_UP_TO_THE_PROPOSAL, BLOCKS_AFTER_VOTE_CAST, VOTING_POWER_TH_HIGH, \
-    VOTING_POWER_TH_MEDIUM
+from src.dao import registry
 
 
-def get_severity(dif):
-    if dif < VOTING_POWER_TH_MEDIUM:
+def get_severity(dif, dao):
+    if dif < dao.th_medium:
         return FindingSeverity.Low
-    elif dif < VOTING_POWER_TH_HIGH:
+    elif dif < dao.th_high:
         return FindingSeverity.Medium
     else:
         return FindingSeverity.High
@@ -15,15 +14,16 @@ def get_severity(dif):
 class InfluencingGovernanceProposalsFindings:
 
     @staticmethod
-    def influencing_before_voting(proposal_id: str, voter: str, support, votes_, reason, dif) -> Finding:
+    def influencing_before_voting(proposal_id: str, voter: str, support, votes_, reason, dif, dao=None) -> Finding:
+        dao = dao or registry.default
         return Finding({
-            'name': 'Uniswap Influencing Governance Proposals Alert',
-            'description': f'Address {voter} casting a vote had a significant change in UNI balance '
-                           f'in the {BLOCKS_LEADING_UP_TO_THE_PROPOSAL} blocks leading up '
+            'name': f'{dao.title} Influencing Governance Proposals Alert',
+            'description': f'Address {voter} casting a vote had a significant change in {dao.symbol} balance '
+                           f'in the {dao.blocks_before} blocks leading up '
                            f'to the proposal starting block number',
-            'alert_id': 'UNI-GOV-INC',
+            'alert_id': f'{dao.alert_prefix}-INC',
             'type': FindingType.Suspicious,
-            'severity': get_severity(dif),
+            'severity': get_severity(dif, dao),
             'metadata': {
                 'proposalId': proposal_id,
                 'voter': voter,
@@ -35,14 +35,15 @@ class InfluencingGovernanceProposalsFindings:
         })
 
     @staticmethod
-    def influencing_after_voting(proposal_id: str, voter: str, support, votes_, reason, dif) -> Finding:
+    def influencing_after_voting(proposal_id: str, voter: str, support, votes_, reason, dif, dao=None) -> Finding:
+        dao = dao or registry.default
         return Finding({
-            'name': 'Uniswap Influencing Governance Proposals Alert',
-            'description': f'Address {voter} casting a vote had a significant change in UNI balance '
-                           f'in the {BLOCKS_AFTER_VOTE_CAST} blocks after the vote is cast',
-            'alert_id': 'UNI-GOV-DEC',
+            'name': f'{dao.title} Influencing Governance Proposals Alert',
+            'description': f'Address {voter} casting a vote had a significant change in {dao.symbol} balance '
+                           f'in the {dao.blocks_after} blocks after the vote is cast',
+            'alert_id': f'{dao.alert_prefix}-DEC',
             'type': FindingType.Suspicious,
-            'severity': get_severity(dif),
+            'severity': get_severity(dif, dao),
             'metadata': {
                 'proposalId': proposal_id,
                 'voter': voter,
@@ -54,13 +55,14 @@ class InfluencingGovernanceProposalsFindings:
         })
 
     @staticmethod
-    def influencing_full(proposal_id: str, voter: str, support, votes_, reason, dif) -> Finding:
+    def influencing_full(proposal_id: str, voter: str, support, votes_, reason, dif, dao=None) -> Finding:
+        dao = dao or registry.default
         return Finding({
-            'name': 'Uniswap Influencing Governance Proposals Alert',
-            'description': f'Address {voter} casting a vote had a significant increase in UNI balance '
-                           f'in the {BLOCKS_AFTER_VOTE_CAST} blocks after the vote is cast and significant decrease '
+            'name': f'{dao.title} Influencing Governance Proposals Alert',
+            'description': f'Address {voter} casting a vote had a significant increase in {dao.symbol} balance '
+                           f'in the {dao.blocks_after} blocks after the vote is cast and significant decrease '
                            f'after',
-            'alert_id': 'UNI-GOV-FULL',
+            'alert_id': f'{dao.alert_prefix}-FULL',
             'type': FindingType.Suspicious,
             'severity': FindingSeverity.Critical,
             'metadata': {
@@ -74,11 +76,12 @@ class InfluencingGovernanceProposalsFindings:
         })
 
     @staticmethod
-    def new_proposal(proposal_id: str) -> Finding:
+    def new_proposal(proposal_id: str, dao=None) -> Finding:
+        dao = dao or registry.default
         return Finding({
-            'name': 'Uniswap Proposal Created',
+            'name': f'{dao.title} Proposal Created',
             'description': f'A new proposal with the id {proposal_id} was created.',
-            'alert_id': 'UNI-GOV-INFO',
+            'alert_id': f'{dao.alert_prefix}-INFO',
             'type': FindingType.Info,
             'severity': FindingSeverity.Low,
             'metadata': {
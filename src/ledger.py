@@ -0,0 +1,102 @@
+from array import array
+from bisect import bisect_left
+
+from src.db.records import address_key
+
+
+class VotingPowerLedger:
+    """
+    This class keeps an append-only history of (block, new balance) for every delegate, it is fed from the
+    DelegateVotesChanged events, so the voting power changes which happened while the agent is running are answered
+    from memory
+    """
+
+    def __init__(self):
+        self.start_block = None  # the first block the agent has seen, the history is complete only after it
+        self._blocks = {}  # 20-byte key of the delegate -> array of the blocks of the checkpoints
+        self._balances = {}  # 20-byte key of the delegate -> list of the voting powers of the checkpoints
+
+    def reset(self):
+        self.__init__()
+
+    def observe_block(self, block: int):
+        """
+        This function remembers the first block seen by the agent
+        :param block: int
+        """
+        if self.start_block is None:
+            self.start_block = block
+
+    def append(self, delegate: str, block: int, balance: int):
+        """
+        This function adds the new balance of the delegate, several changes in the same block are merged into one
+        checkpoint like the token contract does it
+        :param delegate: str
+        :param block: int
+        :param balance: int
+        """
+        key = address_key(delegate)
+        blocks = self._blocks.setdefault(key, array('L'))
+        balances = self._balances.setdefault(key, [])
+        if blocks and blocks[-1] >= block:
+            balances[-1] = balance
+            return
+        blocks.append(block)
+        balances.append(balance)
+
+    def prune(self, block: int) -> int:
+        """
+        This function drops the checkpoints made before the block, the windows which start before it are requested by
+        RPC again
+        :param block: int
+        :return: amount of removed checkpoints: int
+        """
+        if self.start_block is None or block <= self.start_block + 1:
+            return 0
+        self.start_block = block - 1  # the history is complete only for the windows starting at or after the block
+        removed = 0
+        for key in list(self._blocks):
+            blocks = self._blocks[key]
+            position = bisect_left(blocks, block)
+            if position == len(blocks):
+                del self._blocks[key]
+                del self._balances[key]
+            else:
+                del blocks[:position]
+                del self._balances[key][:position]
+            removed += position
+        return removed
+
+    def delegates(self):
+        """
+        :return: 20-byte keys of the delegates whose voting power changed since the start
+        """
+        return self._blocks.keys()
+
+    def covers(self, block: int) -> bool:
+        """
+        This function checks if every checkpoint made at or after the block has been seen by the agent
+        :param block: int
+        :return: bool
+        """
+        return self.start_block is not None and self.start_block < block
+
+    def get_window(self, delegate: str, target_block: int) -> tuple or None:
+        """
+        This function returns the current voting power of the delegate and his checkpoints made at or after the
+        target block, the result has the same format as CheckpointLookup.get_window
+        :param delegate: str
+        :param target_block: int
+        :return: (current voting power, checkpoints from the newest to the oldest) or None if there are no checkpoints
+        in the window
+        """
+        key = address_key(delegate)
+        blocks = self._blocks.get(key)
+        if not blocks or blocks[-1] < target_block:
+            return None
+        balances = self._balances[key]
+        first = bisect_left(blocks, target_block)
+        return balances[-1], [(blocks[i], balances[i]) for i in range(len(blocks) - 1, first - 1, -1)]
+
+
+ledger = VotingPowerLedger()
@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.config import METRICS_ENABLED, METRICS_PORT, METRICS_DUMP_INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HELP = {
+    'agent_stage_seconds': 'Time spent in the stages of the transaction handler',
+    'agent_rpc_request_seconds': 'Latency of the RPC requests by method',
+    'agent_rpc_errors_total': 'Failed RPC attempts by method, including the retried ones',
+    'agent_db_operation_seconds': 'Latency of the db operations by Methods operation',
+    'agent_db_statements_total': 'SQL statements by Methods operation',
+    'agent_db_statement_seconds': 'Latency of the SQL statements by Methods operation',
+    'agent_findings_total': 'Findings by alert id',
+    'agent_table_rows': 'Rows in the table after the last retention sweep',
+    'agent_transactions_total': 'Handled transactions',
+    'agent_snapshots_scheduled_total': 'Voting power snapshots scheduled by the prefetcher',
+    'agent_snapshot_hits_total': 'VoteCast windows answered by the prefetched snapshots',
+    'agent_deferred_checks_total': 'Checks moved to the background after the deadline of the invocation by check',
+    'agent_deferred_queue_depth': 'Deferred checks running in the background',
+    'agent_deferred_queue_full_total': 'Checks awaited inline after the deadline because the deferred queue was full',
+}
+
+# Methods operation which runs the current SQL statements, the statements of the final commit have none
+current_db_operation = ContextVar('current_db_operation', default='unit_of_work')
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+NOOP_TIMER = NoopTimer()
+
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms of the agent, rendered in the Prometheus text format. When it is
+    disabled every call returns immediately, so the instrumentation costs one attribute check
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.lock = threading.Lock()  # the handlers, the runtime loop and the http server use it from their threads
+        self.last_dump = time.monotonic()
+        self.server = None
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def timer(self, name: str, **labels):
+        """
+        This function returns the context manager which observes the time spent inside it
+        :param name: name of the histogram
+        :param labels: labels of the histogram
+        :return: context manager
+        """
+        if not self.enabled:
+            return NOOP_TIMER
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name: str, labels: dict):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    async def timed(self, name: str, coro, **labels):
+        """
+        This function awaits the coroutine and observes its duration
+        :param name: name of the histogram
+        :param coro: coroutine
+        :param labels: labels of the histogram
+        :return: result of the coroutine
+        """
+        with self.timer(name, **labels):
+            return await coro
+
+    def instrument_engine(self, engine):
+        """
+        This function counts and times the SQL statements of the engine by the Methods operation which runs them
+        :param engine: sqlalchemy.engine.Engine, the sync engine of the async one
+        """
+        if not self.enabled:
+            return
+        from sqlalchemy import event
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, *_):
+            conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, *_):
+            operation = current_db_operation.get()
+            self.inc('agent_db_statements_total', operation=operation)
+            self.observe('agent_db_statement_seconds', time.perf_counter() - conn.info['metrics_start'].pop(),
+                         operation=operation)
+
+    @staticmethod
+    def format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def render(self) -> str:
+        """
+        This function renders all the metrics in the Prometheus text format
+        :return: str
+        """
+        with self.lock:
+            counters, gauges = dict(self.counters), dict(self.gauges)
+            histograms = {key: (list(x.buckets), x.sum, x.count) for key, x in self.histograms.items()}
+        lines = []
+        for metrics, kind in [(counters, 'counter'), (gauges, 'gauge'), (histograms, 'histogram')]:
+            for name in sorted({name for name, _ in metrics}):
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {kind}')
+                for (name_, labels), value in sorted(metrics.items(), key=lambda x: x[0][1]):
+                    if name_ != name:
+                        continue
+                    if kind != 'histogram':
+                        lines.append(f'{name}{self.format_labels(labels)} {value}')
+                        continue
+                    buckets, sum_, count = value
+                    cumulative = 0
+                    for le, amount in zip([*BUCKETS, '+Inf'], buckets):
+                        cumulative += amount
+                        lines.append(f'{name}_bucket{self.format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{self.format_labels(labels)} {sum_}')
+                    lines.append(f'{name}_count{self.format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = METRICS_PORT):
+        """
+        This function starts the http endpoint with the metrics in a daemon thread
+        :param port: int
+        """
+        if not self.enabled or port is None or self.server is not None:
+            return
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self.server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='agent-metrics', daemon=True).start()
+
+    def maybe_dump(self, interval: float = METRICS_DUMP_INTERVAL_SECONDS):
+        """
+        This function logs all the metrics once per interval seconds
+        :param interval: float, 0 disables the dump
+        """
+        if not self.enabled or not interval or time.monotonic() - self.last_dump < interval:
+            return
+        self.last_dump = time.monotonic()
+        logger.info('metrics\n' + self.render())
+
+
+metrics = Metrics()
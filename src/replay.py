@@ -0,0 +1,221 @@
+"""
+Offline replay of the recorded transactions through the detectors, used to backtest the values of src/config.py:
+
+    python -m src.replay --transactions transactions.jsonl --rpc-store rpc.jsonl --params params.json --workers 4
+
+transactions.jsonl holds one transaction event per line in the format of create_transaction_event, rpc.jsonl holds the
+recorded eth_call responses (it is filled by the same command with --record <json rpc url>), params.json is a list of
+the parameter sets, every set overrides the values of src/config.py, e.g. [{"VOTING_POWER_TH_LOW": 500}]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from collections import Counter
+
+import eth_abi
+from eth_utils import keccak
+
+# the selector of the Multicall2 aggregate, src/checkpoints.py is not imported here before the parameter set is applied
+AGGREGATE_SELECTOR = keccak(text="aggregate((address,bytes)[])")[:4]
+
+
+class RpcStore:
+    """
+    Recorded eth_call responses: (contract, call data, block) -> return data
+    """
+
+    def __init__(self, responses: dict = None):
+        self.responses = responses or {}
+        self.updated = False
+
+    @staticmethod
+    def key(to: str, data: bytes, block: int) -> tuple:
+        return to.lower(), '0x' + bytes(data).hex(), int(block)
+
+    @classmethod
+    def load(cls, path: str):
+        responses = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        responses[(record['to'], record['data'], record['block'])] = record['result']
+        return cls(responses)
+
+    def save(self, path: str):
+        with open(path, 'w') as file:
+            for (to, data, block), result in self.responses.items():
+                file.write(json.dumps({'to': to, 'data': data, 'block': block, 'result': result}) + '\n')
+
+    def get(self, to: str, data: bytes, block: int) -> bytes or None:
+        result = self.responses.get(self.key(to, data, block))
+        return None if result is None else bytes.fromhex(result[2:])
+
+    def put(self, to: str, data: bytes, block: int, result: bytes):
+        self.responses[self.key(to, data, block)] = '0x' + bytes(result).hex()
+        self.updated = True
+
+
+class ReplayWeb3:
+    """
+    Offline stand-in of Web3 which answers the Multicall aggregate calls of CheckpointLookup from the RpcStore. With
+    the upstream Web3 the missing responses are requested and recorded
+    """
+
+    def __init__(self, store: RpcStore, upstream=None):
+        self.store = store
+        self.upstream = upstream
+        self.eth = self
+
+    def call(self, transaction: dict, block_identifier='latest') -> bytes:
+        calls, = eth_abi.decode_abi(['(address,bytes)[]'], transaction['data'][len(AGGREGATE_SELECTOR):])
+        missing = [(to, data) for to, data in calls if self.store.get(to, data, block_identifier) is None]
+        if missing and self.upstream is None:
+            raise LookupError(f'{len(missing)} eth_call responses at block {block_identifier} are not recorded')
+        if missing:
+            result = self.upstream.eth.call({'to': transaction['to'], 'data': AGGREGATE_SELECTOR + eth_abi.encode_abi(
+                ['(address,bytes)[]'], [missing])}, block_identifier)
+            _, return_data = eth_abi.decode_abi(['uint256', 'bytes[]'], result)
+            for (to, data), result in zip(missing, return_data):
+                self.store.put(to, data, block_identifier, result)
+        return eth_abi.encode_abi(['uint256', 'bytes[]'], [block_identifier, [
+            self.store.get(to, data, block_identifier) for to, data in calls]])
+
+
+def read_transactions(path: str):
+    """
+    This function reads the recorded transaction events
+    :param path: str
+    :return: generator of forta_agent.transaction_event.TransactionEvent
+    """
+    from forta_agent import create_transaction_event
+    with open(path, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield create_transaction_event(json.loads(line))
+
+
+def replay(transactions_path: str, w3, name: str) -> dict:
+    """
+    This function drives the recorded transactions through the transaction handler of src/agent.py, so the replay runs
+    the same routing, bookkeeping, prefetch and deferred checks as the agent. The time spent in every stage is taken
+    from the agent_stage_seconds metrics of the handler
+    :param transactions_path: str
+    :param w3: ReplayWeb3
+    :param name: name of the db file of this replay
+    :return: report: dict
+    """
+    from src import agent  # imported here, so the parameter set is applied to src/config.py before
+    from src.deferred import deferred
+    from src.metrics import metrics
+    from src.rpc import Web3RpcClient
+    from src.runtime import runtime
+
+    async def dispose_engines():
+        for dao in agent.registry.daos:
+            if dao.db.engine is not None:
+                await dao.db.engine.dispose()
+
+    agent.reset_inited()
+    rpc_client = Web3RpcClient(w3)
+    enabled, metrics.enabled = metrics.enabled, True  # the stages are timed by the metrics of the handler
+    metrics.reset()
+    findings = Counter()
+    transactions = 0
+    try:
+        runtime.run(agent.warm_up(rpc_client, True, name))
+        handle_transaction = agent.provide_handle_transaction(rpc_client, test=True)
+        started = time.perf_counter()
+        for transaction_event in read_transactions(transactions_path):
+            transactions += 1
+            findings.update(finding.alert_id for finding in handle_transaction(transaction_event))
+        runtime.run(deferred.join())  # the checks which outlasted the budget of the last transactions
+        findings.update(finding.alert_id for finding in deferred.drain())
+        seconds = time.perf_counter() - started
+        stages = {dict(labels)['stage']: histogram.sum for (metric, labels), histogram in metrics.histograms.items()
+                  if metric == 'agent_stage_seconds'}
+    finally:
+        metrics.enabled = enabled
+        metrics.reset()
+        agent.reset_inited()
+        runtime.run(dispose_engines())
+    return {
+        'transactions': transactions,
+        'seconds': seconds,
+        'tx_per_second': transactions / seconds if seconds else 0.0,
+        'findings': dict(findings),
+        'stages': stages,
+    }
+
+
+def remove_dbs(name: str):
+    """
+    This function removes the db files of all the DAOs created by the replay
+    :param name: name of the db of the replay: str
+    """
+    from src.dao import registry
+    for dao in registry.daos:
+        if os.path.exists(f'./{dao.db_name(name)}.db'):
+            os.remove(f'./{dao.db_name(name)}.db')
+
+
+def run_parameter_set(params: dict, transactions_path: str, store_path: str, rpc_url: str = None) -> dict:
+    """
+    This function replays the transactions with one parameter set. It has to run in a fresh process, because the
+    values of src/config.py are imported by the other modules once
+    :param params: values of src/config.py to override: dict
+    :param transactions_path: str
+    :param store_path: str
+    :param rpc_url: json rpc url to record the missing responses or None to replay offline
+    :return: report: dict
+    """
+    import src.config
+    for name, value in params.items():
+        if not hasattr(src.config, name):
+            raise AttributeError(f'src/config.py has no {name}')
+        setattr(src.config, name, value)
+
+    upstream = None
+    if rpc_url:
+        from web3 import Web3
+        upstream = Web3(Web3.HTTPProvider(rpc_url))
+    store = RpcStore.load(store_path)
+    name = f'replay_{os.getpid()}'
+    try:
+        report = replay(transactions_path, ReplayWeb3(store, upstream), name)
+    finally:
+        remove_dbs(name)
+    if store.updated:
+        store.save(store_path)
+    return {'params': params, **report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the recorded transactions through the agent')
+    parser.add_argument('--transactions', required=True, help='jsonl file with the transaction events')
+    parser.add_argument('--rpc-store', required=True, help='jsonl file with the recorded eth_call responses')
+    parser.add_argument('--params', help='json file with the list of the parameter sets')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='amount of the parallel processes')
+    parser.add_argument('--record', metavar='RPC_URL', help='request and record the missing eth_call responses')
+    args = parser.parse_args()
+
+    param_sets = [{}]
+    if args.params:
+        with open(args.params, 'r') as file:
+            param_sets = json.load(file)
+    if args.record:
+        args.workers = 1  # the recording processes would overwrite the store of each other
+
+    # every parameter set gets a fresh process, so its values are applied before src/agent.py is imported
+    with multiprocessing.get_context('spawn').Pool(max(1, min(args.workers, len(param_sets))),
+                                                   maxtasksperchild=1) as pool:
+        reports = pool.starmap(run_parameter_set, [(params, args.transactions, args.rpc_store, args.record)
+                                                   for params in param_sets])
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import logging
+from collections import Counter
+
+from src.config import BLOCKS_AFTER_VOTE_CAST, RETENTION_SWEEP_INTERVAL_BLOCKS
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionScheduler:
+    """
+    This class runs the deletion of obsolete proposals and votes once per RETENTION_SWEEP_INTERVAL_BLOCKS blocks
+    instead of on every transaction
+    """
+
+    def __init__(self, interval: int = RETENTION_SWEEP_INTERVAL_BLOCKS, blocks_after: int = BLOCKS_AFTER_VOTE_CAST,
+                 labels: dict = None):
+        self.interval = interval
+        self.blocks_after = blocks_after
+        self.labels = labels or {}  # labels of the table rows metrics, they tell the DAOs apart
+        self.last_sweep_block = None
+        self.last_sweep = {}  # table -> amount of rows removed by the last sweep
+        self.removed = Counter()  # table -> amount of rows removed since start
+
+    def reset(self):
+        self.__init__(self.interval, self.blocks_after, self.labels)
+
+    def is_due(self, block: int) -> bool:
+        """
+        This function checks if the block is far enough from the last sweep
+        :param block: int
+        :return: bool
+        """
+        return self.last_sweep_block is None or block - self.last_sweep_block >= self.interval
+
+    async def sweep(self, block: int, votes, proposals) -> dict:
+        """
+        This function deletes the votes and the proposals which are older than blocks_after
+        :param block: int
+        :param votes: votes table
+        :param proposals: proposals table
+        :return: amount of removed rows by table: dict
+        """
+        self.last_sweep_block = block
+        self.last_sweep = {
+            'votes': await votes.delete_old_votes(block, self.blocks_after),
+            'proposals': await proposals.delete_old_proposals(block, self.blocks_after),
+        }
+        self.removed.update(self.last_sweep)
+        if metrics.enabled:
+            metrics.set('agent_table_rows', await votes.count_rows(), table='votes', **self.labels)
+            metrics.set('agent_table_rows', await proposals.count_rows(), table='proposals', **self.labels)
+        if any(self.last_sweep.values()):
+            logger.info(f'retention sweep at block {block} removed {self.last_sweep}')
+        return self.last_sweep
+
+
+retention = RetentionScheduler()
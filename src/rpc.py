@@ -0,0 +1,157 @@
+import asyncio
+import itertools
+
+from src.config import RPC_MAX_IN_FLIGHT, RPC_TIMEOUT_SECONDS, RPC_RETRIES, RPC_BACKOFF_SECONDS
+from src.metrics import metrics
+
+
+class RpcError(Exception):
+    """
+    JSON-RPC error returned by the node
+    """
+
+
+class RpcClient:
+    """
+    Async RPC layer of the agent. Every request waits for a free slot of the in-flight limit, is cancelled after the
+    timeout and is retried with the exponential backoff, so the lookups of the different voters run concurrently without
+    flooding the node. The subclasses implement the transport in _eth_call and _get_logs
+    """
+
+    def __init__(self, max_in_flight=RPC_MAX_IN_FLIGHT, timeout=RPC_TIMEOUT_SECONDS, retries=RPC_RETRIES,
+                 backoff=RPC_BACKOFF_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._loop = None
+        self._semaphore = None
+
+    def bind(self):
+        """
+        This function creates the loop-bound state on the first use in the running loop, the tests and the replay run
+        the client in the short-lived loops
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self.on_bind()
+
+    def on_bind(self):
+        pass
+
+    async def request(self, name: str, method, *args):
+        """
+        This function runs one request within the in-flight limit, the timeout and the retries
+        :param name: name of the RPC method: str
+        :param method: coroutine function of the transport
+        :return: result of the request
+        """
+        self.bind()
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    with metrics.timer('agent_rpc_request_seconds', method=name):
+                        return await asyncio.wait_for(method(*args), self.timeout)
+            except (asyncio.TimeoutError, OSError, RpcError):
+                metrics.inc('agent_rpc_errors_total', method=name)
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def eth_call(self, to: str, data: bytes, block: int) -> bytes:
+        """
+        This function calls the view function of the contract at the block
+        :param to: address of the contract: str
+        :param data: call data: bytes
+        :param block: int
+        :return: return data: bytes
+        """
+        return await self.request('eth_call', self._eth_call, to, data, block)
+
+    async def get_logs(self, filter_params: dict) -> list:
+        """
+        This function returns the logs which match the filter
+        :param filter_params: dict in the format of eth_getLogs
+        :return: logs: list
+        """
+        return await self.request('eth_getLogs', self._get_logs, filter_params)
+
+    async def _eth_call(self, to: str, data: bytes, block: int) -> bytes:
+        raise NotImplementedError
+
+    async def _get_logs(self, filter_params: dict) -> list:
+        raise NotImplementedError
+
+
+class HttpRpcClient(RpcClient):
+    """
+    JSON-RPC client over one aiohttp session, the connections of its pool are kept alive between the requests
+    """
+
+    def __init__(self, url, **kwargs):
+        """
+        :param url: str or function which returns it, the function is called when the client is bound to the loop
+        """
+        super().__init__(**kwargs)
+        self.url = url
+        self.ids = itertools.count()
+        self.session = None
+
+    def on_bind(self):
+        import aiohttp  # the session has to be created in the loop it is used in
+        if callable(self.url):
+            self.url = self.url()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_in_flight,
+                                                                            keepalive_timeout=60))
+
+    async def post(self, method: str, params: list):
+        import aiohttp
+        try:
+            async with self.session.post(self.url, json={'jsonrpc': '2.0', 'id': next(self.ids), 'method': method,
+                                                         'params': params}) as response:
+                response.raise_for_status()
+                body = await response.json(content_type=None)
+        except aiohttp.ClientError as e:
+            # stale keep-alive connection, cut payload, HTTP 429/5xx: the request is retried
+            raise RpcError(f'{method}: {e!r}') from e
+        if 'error' in body:
+            raise RpcError(body['error'])
+        return body['result']
+
+    async def _eth_call(self, to: str, data: bytes, block: int) -> bytes:
+        result = await self.post('eth_call', [{'to': to, 'data': '0x' + bytes(data).hex()}, hex(block)])
+        return bytes.fromhex(result[2:])
+
+    async def _get_logs(self, filter_params: dict) -> list:
+        params = {key: hex(value) if isinstance(value, int) else value for key, value in filter_params.items()}
+        logs = await self.post('eth_getLogs', [params])
+        for log in logs:
+            for key in ['blockNumber', 'logIndex', 'transactionIndex']:
+                if isinstance(log.get(key), str):
+                    log[key] = int(log[key], 16)
+        return logs
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class Web3RpcClient(RpcClient):
+    """
+    Stand-in of HttpRpcClient backed by the synchronous Web3 compatible object (the Web3 mock in the tests, the
+    recorded responses in the replay). Its calls run in the executor, so they do not block the event loop either
+    """
+
+    def __init__(self, w3, **kwargs):
+        super().__init__(**kwargs)
+        self.w3 = w3
+
+    async def _eth_call(self, to: str, data: bytes, block: int) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: bytes(self.w3.eth.call({'to': to, 'data': data}, block)))
+
+    async def _get_logs(self, filter_params: dict) -> list:
+        return await asyncio.get_running_loop().run_in_executor(None, self.w3.eth.get_logs, filter_params)
@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from src.config import RPC_CACHE_SIZE, RPC_CACHE_PATH
+
+
+# amount of the keys in one disk query, below the limit of the host parameters of old sqlite versions
+DISK_BATCH_SIZE = 500
+
+
+class RpcCache:
+    """
+    Read-through cache of the eth_call results pinned to a block, the result of a view call at a fixed block never
+    changes. The memory tier is an LRU of at most size entries, the optional disk tier in the sqlite file at path keeps
+    the results between the restarts. The key is (contract, call data, block); block is None for the results which do
+    not depend on the block, e.g. the checkpoints below the latest one, which are never rewritten. The disk tier is
+    read and written in batches by its own thread, so the event loop never waits for the disk
+    """
+
+    def __init__(self, size: int = RPC_CACHE_SIZE, path: str = RPC_CACHE_PATH):
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._disk = None
+        self._executor = None
+
+    def reset(self):
+        self.close()
+        self.__init__(self.size, self.path)
+
+    @property
+    def disk(self) -> sqlite3.Connection:
+        if self._disk is None:
+            self._disk = sqlite3.connect(self.path, check_same_thread=False)  # it is closed by the caller of close
+            self._disk.execute('CREATE TABLE IF NOT EXISTS rpc_cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        return self._disk
+
+    async def run_on_disk(self, function, *args):
+        """
+        This function runs the function of the disk tier in the thread of the cache, one at a time
+        :param function: read or write
+        :return: result of the function
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='agent-rpc-cache')
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    @staticmethod
+    def serialize(key: tuple) -> str:
+        to, data, block = key
+        return f'{to.lower()}:{bytes(data).hex()}:{"*" if block is None else block}'
+
+    async def get_many(self, keys: list) -> list:
+        """
+        This function returns the cached results and counts the hits and the misses, the keys which are missing in
+        the memory tier are read from the disk tier at once
+        :param keys: list of (contract, call data, block or None)
+        :return: list of return data: bytes or None
+        """
+        keys = [self.serialize(key) for key in keys]
+        values = [self.entries.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing and self.path:
+            found = await self.run_on_disk(self.read, missing)
+            self.disk_hits += len(found)
+            for key, value in found.items():
+                self.remember(key, value)
+            values = [found.get(key) if value is None else value for key, value in zip(keys, values)]
+        for key, value in zip(keys, values):
+            if value is None:
+                self.misses += 1
+                continue
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return values
+
+    def remember(self, key: str, value: bytes):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)  # evict the least recently used entry
+
+    async def put_many(self, items: list):
+        """
+        This function adds the results to the memory tier and writes them to the disk tier in one transaction
+        :param items: list of (key, return data)
+        """
+        items = [(self.serialize(key), bytes(value)) for key, value in items]
+        for key, value in items:
+            self.remember(key, value)
+        if items and self.path:
+            await self.run_on_disk(self.write, items)
+
+    def read(self, keys: list) -> dict:
+        """
+        This function runs in the thread of the cache
+        :param keys: list of the serialized keys
+        :return: serialized key -> return data of the keys found on the disk: dict
+        """
+        found = {}
+        for i in range(0, len(keys), DISK_BATCH_SIZE):
+            chunk = keys[i:i + DISK_BATCH_SIZE]
+            found.update((key, bytes(value)) for key, value in self.disk.execute(
+                f'SELECT key, value FROM rpc_cache WHERE key IN ({", ".join("?" * len(chunk))})', chunk))
+        return found
+
+    def write(self, items: list):
+        # runs in the thread of the cache
+        with self.disk:
+            self.disk.executemany('INSERT OR REPLACE INTO rpc_cache (key, value) VALUES (?, ?)', items)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits, 'entries': len(self.entries)}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)  # the queued writes are finished
+            self._executor = None
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+
+rpc_cache = RpcCache()
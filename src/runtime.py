@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+
+class Runtime:
+    """
+    Persistent event loop that lives in a daemon thread for the whole agent process. The handlers submit their work
+    to this loop instead of creating a new one for every transaction, so the db engine, its connection pool and any
+    in-memory state bound to the loop survive between transactions.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """
+        This property starts the loop on the first use and returns it
+        :return: loop: asyncio.AbstractEventLoop
+        """
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='agent-runtime', daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def submit(self, coro):
+        """
+        This function schedules the coroutine on the persistent loop
+        :param coro: coroutine
+        :return: future: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        This function schedules the coroutine on the persistent loop and waits for the result
+        :param coro: coroutine
+        :param timeout: float or None
+        :return: result of the coroutine
+        """
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        """
+        This function stops the loop and waits for its thread
+        """
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+
+runtime = Runtime()
@@ -0,0 +1,250 @@
+"""
+Sharded execution of the detectors. The agent process decodes the logs and routes every VoteCast and
+DelegateVotesChanged event to one of SHARDS worker processes by the hash of the voter or the delegate, so the votes,
+the ledger checkpoints and the snapshots of a delegate live in one worker. The ProposalCreated events are broadcast,
+every worker keeps the whole proposal table and only the first one reports the finding. The findings of the workers
+are merged back in the order of the logs.
+
+The workers do not resume the missed blocks and do not serve the metrics, the agent process counts the transactions
+and the findings
+"""
+import atexit
+import logging
+import multiprocessing
+import zlib
+
+import forta_agent
+from forta_agent import create_transaction_event
+
+from src import agent
+from src.dao import Dao, registry
+from src.db.records import address_key
+from src.metrics import metrics
+from src.runtime import runtime
+from src.utils import extract_argument
+
+logger = logging.getLogger(__name__)
+
+# event name -> argument whose address picks the shard, the other events are broadcast to every shard
+SHARD_ARGUMENTS = {'VoteCast': 'voter', 'DelegateVotesChanged': 'delegate'}
+
+
+def shard_of(address, shards: int) -> int:
+    """
+    This function picks the shard of the address, crc32 is used because hash() is salted per process
+    :param address: hex str or 20-byte key
+    :param shards: amount of the shards: int
+    :return: int
+    """
+    return zlib.crc32(address_key(address)) % shards
+
+
+def route(transaction_events: list, events: list, shards: int) -> list:
+    """
+    This function splits the decoded events of the transactions between the shards. Every event gets its position in
+    the transaction: the log index or the position in the order of the dispatcher if the log has no index
+    :param transaction_events: list of forta_agent.transaction_event.TransactionEvent
+    :param events: event name -> list of the decoded events of every transaction: list of dict
+    :param shards: amount of the shards: int
+    :return: list of (position of the transaction, its hash, DAO name -> list of (order, event name, event)) of every
+    shard: list
+    """
+    routed = [[] for _ in range(shards)]
+    for position, (transaction_event, events_) in enumerate(zip(transaction_events, events)):
+        by_shard = [{} for _ in range(shards)]
+        sequence = 0
+        for name, events__ in events_.items():
+            for event in events__:
+                order = event['logIndex'] if event['logIndex'] is not None else sequence
+                sequence += 1
+                dao = registry.by_address[event['address'].lower()]
+                targets = [shard_of(extract_argument(event, SHARD_ARGUMENTS[name]), shards)] \
+                    if name in SHARD_ARGUMENTS else range(shards)
+                for shard in targets:
+                    by_shard[shard].setdefault(dao.name, []).append((order, name, event))
+        for shard, items in enumerate(by_shard):
+            if items:
+                routed[shard].append((position, transaction_event.hash, items))
+    return routed
+
+
+async def detect_event(transaction_event: forta_agent.transaction_event.TransactionEvent, name: str, event: dict,
+                       dao: Dao, lookup, windows: dict) -> list:
+    """
+    This function runs the detector of one event
+    :return: findings: list
+    """
+    if name == 'ProposalCreated':
+        return await agent.detect_proposal_initialization(transaction_event, [event], dao, lookup)
+    if name == 'VoteCast':
+        return await agent.detect_cast_vote(transaction_event, [event], lookup, windows, dao)
+    return await agent.detect_voting_power_decrease_after_cast(transaction_event, [event], dao)
+
+
+async def detect(transactions: list, block_number: int, complete: bool, rpc_client, first: bool) -> list:
+    """
+    This function handles the routed events of the shard like main_batch does: the windows of the votes are requested
+    in one RPC batch per DAO, then the events of every transaction go through their detectors in the order of the logs
+    :param transactions: routed transactions of the shard, see route
+    :param block_number: int
+    :param complete: True if all the transactions of the block were routed
+    :param rpc_client: RpcClient of the worker
+    :param first: True in the first worker, it reports the findings of the broadcast events
+    :return: list of ((position of the transaction, order of the event), finding)
+    """
+    findings = []
+    agent.prefetch_stored_proposals(rpc_client, block_number)
+    for dao in registry.daos:
+        transactions_ = [(position, create_transaction_event({'transaction': {'hash': hash_},
+                                                              'block': {'number': block_number}}), items[dao.name])
+                         for position, hash_, items in transactions if dao.name in items]
+        if not transactions_ and not dao.retention.is_due(block_number):
+            continue
+        lookup = dao.get_lookup(rpc_client)
+        async with dao.db.unit_of_work():
+            if transactions_:
+                dao.ledger.observe_block(block_number)
+                _, requests = agent.get_window_requests(
+                    [event for _, _, items in transactions_ for _, name, event in items if name == 'VoteCast'], dao)
+                windows = await lookup.get_windows(requests, block_number)
+                for position, transaction_event, items in transactions_:
+                    agent.record_voting_power_changes(
+                        transaction_event, [event for _, name, event in items if name == 'DelegateVotesChanged'], dao)
+                    for order, name, event in sorted(items, key=lambda x: x[0]):
+                        findings_ = await detect_event(transaction_event, name, event, dao, lookup, windows)
+                        if first or name in SHARD_ARGUMENTS:
+                            findings.extend(((position, order), finding) for finding in findings_)
+            if dao.retention.is_due(block_number):
+                await agent.sweep(dao, block_number)
+    for dao in registry.daos:
+        dao.db.block_processed(block_number, complete)
+    return findings
+
+
+async def close_storage():
+    for dao in registry.daos:
+        if dao.db.storage is not None:
+            await dao.db.storage.close()  # the write-behind queue is flushed before the worker exits
+
+
+def serve(connection, index: int, rpc_factory, test: bool):
+    """
+    This function is the main loop of the worker process: it receives (routed transactions, block, complete) and
+    sends back ('ok', findings) or ('error', description) until it receives None
+    :param connection: multiprocessing.connection.Connection
+    :param index: index of the shard: int
+    :param rpc_factory: function which creates the RpcClient of the worker, it is pickled to the worker
+    :param test: bool
+    """
+    metrics.enabled = False  # the port of the metrics endpoint belongs to the agent process
+    rpc_client = rpc_factory()
+    runtime.run(agent.warm_up(rpc_client, test, f'{"test" if test else "main"}_shard{index}'))
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        try:
+            connection.send(('ok', runtime.run(detect(*message, rpc_client, index == 0))))
+        except Exception as e:  # the agent process raises it for the handled transactions
+            logger.exception(f'shard {index} failed')
+            connection.send(('error', repr(e)))
+    runtime.run(close_storage())
+    connection.close()
+
+
+class ShardPool:
+    """
+    Worker processes of the sharded mode and the routing of the events between them. The workers are spawned on the
+    first use, so the import of the agent does not start them
+    """
+
+    def __init__(self, shards: int, rpc_factory, test: bool = False):
+        """
+        :param shards: amount of the worker processes: int
+        :param rpc_factory: picklable function which creates the RpcClient of a worker
+        :param test: bool, the workers start from the empty tables
+        """
+        self.shards = shards
+        self.rpc_factory = rpc_factory
+        self.test = test
+        self.processes = []
+        self.connections = []
+        self.last_block = None
+
+    def start(self):
+        if self.processes:
+            return
+        context = multiprocessing.get_context('spawn')  # the agent process runs the threads of the loop and metrics
+        for index in range(self.shards):
+            connection, child_connection = context.Pipe()
+            process = context.Process(target=serve, args=(child_connection, index, self.rpc_factory, self.test),
+                                      name=f'agent-shard-{index}', daemon=True)
+            process.start()
+            child_connection.close()
+            self.processes.append(process)
+            self.connections.append(connection)
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        This function stops the workers, their storage backends are flushed before
+        """
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.processes, self.connections, self.last_block = [], [], None
+        atexit.unregister(self.close)
+
+    def run(self, transaction_events: list, block_number: int, complete: bool = False) -> list:
+        """
+        This function routes the events of the transactions of the block to the workers and merges their findings
+        :param transaction_events: list of forta_agent.transaction_event.TransactionEvent
+        :param block_number: int
+        :param complete: True if these are all the transactions of the block
+        :return: findings in the order of the transactions and their logs: list
+        """
+        self.start()
+        with metrics.timer('agent_stage_seconds', stage='dispatch'):
+            events = [agent.dispatcher.dispatch(transaction_event.logs) for transaction_event in transaction_events]
+        routed = route(transaction_events, events, self.shards)
+        # the retention of every worker is checked on the first transaction of the block
+        new_block = block_number != self.last_block
+        self.last_block = block_number
+        busy = [shard for shard in range(self.shards) if routed[shard] or new_block]
+        for shard in busy:
+            self.connections[shard].send((routed[shard], block_number, complete))
+        findings = []
+        for shard in busy:
+            status, result = self.connections[shard].recv()
+            if status != 'ok':
+                raise RuntimeError(f'shard {shard} failed: {result}')
+            findings.extend(result)
+        return [finding for _, finding in sorted(findings, key=lambda x: x[0])]
+
+
+def provide_handle_transaction(pool: ShardPool):
+    def handle_transaction(transaction_event: forta_agent.transaction_event.TransactionEvent) -> list:
+        metrics.inc('agent_transactions_total')
+        findings = pool.run([transaction_event], transaction_event.block_number)
+        agent.count_findings(findings)
+        return findings
+
+    return handle_transaction
+
+
+def provide_handle_block(pool: ShardPool, rpc_client):
+    def handle_block(block_event: forta_agent.block_event.BlockEvent) -> list:
+        # the logs of the contracts of all the DAOs are requested by the agent process and routed as one batch
+        transaction_events = runtime.run(agent.get_block_transactions(rpc_client, block_event.block_number,
+                                                                      block_event.block_number, {
+                                                                          'number': block_event.block_number,
+                                                                          'hash': block_event.block_hash,
+                                                                          'timestamp': block_event.block.timestamp,
+                                                                      })).get(block_event.block_number, [])
+        metrics.inc('agent_transactions_total', len(transaction_events))
+        findings = pool.run(transaction_events, block_event.block_number, complete=True)
+        agent.count_findings(findings)
+        return findings
+
+    return handle_block
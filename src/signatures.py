@@ -0,0 +1,61 @@
+"""
+Precompiled signatures of the monitored events and the called functions. The agent needs 3 events of the full ABI
+files and 3 function selectors, so they are extracted once into the small artifact src/ABI/signatures.json with their
+topics and selectors already hashed:
+
+    python -m src.signatures
+
+The artifact is rebuilt from the full ABI files if it is missing
+"""
+import json
+import os
+
+from eth_utils import event_abi_to_log_topic, keccak
+
+ARTIFACT_PATH = './src/ABI/signatures.json'
+# full abi file -> names of the monitored events declared in it
+EVENT_SOURCES = {
+    './src/ABI/governor_bravo_abi.json': ['ProposalCreated', 'VoteCast'],
+    './src/ABI/uniswap_abi.json': ['DelegateVotesChanged'],
+}
+# functions of the token and of Multicall2 called by the checkpoint lookup
+FUNCTIONS = ['checkpoints(address,uint32)', 'numCheckpoints(address)', 'aggregate((address,bytes)[])']
+
+
+def build() -> dict:
+    """
+    This function extracts the monitored events from the full ABI files and hashes the topics and the selectors
+    :return: {'events': name -> {'abi': event abi, 'topic': hex str}, 'selectors': signature -> hex str}: dict
+    """
+    events = {}
+    for path, names in EVENT_SOURCES.items():
+        with open(path, 'r') as abi_file:
+            abi = json.load(abi_file)
+        for name in names:
+            event_abi = next(x for x in abi if x.get('type') == 'event' and x.get('name') == name)
+            events[name] = {'abi': event_abi, 'topic': '0x' + event_abi_to_log_topic(event_abi).hex()}
+    return {'events': events, 'selectors': {x: '0x' + keccak(text=x)[:4].hex() for x in FUNCTIONS}}
+
+
+def load(path: str = ARTIFACT_PATH) -> dict:
+    """
+    This function reads the artifact, it is built from the full ABI files if it is missing
+    :param path: str
+    :return: dict in the format of build
+    """
+    if not os.path.exists(path):
+        return build()
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def write(path: str = ARTIFACT_PATH):
+    with open(path, 'w') as file:
+        json.dump(build(), file, indent=2)
+        file.write('\n')
+
+
+signatures = load()
+
+if __name__ == '__main__':
+    write()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from collections import deque
+
+from eth_utils import to_checksum_address
+
+from src.config import SNAPSHOT_PREFETCH_RATE, SNAPSHOT_PREFETCH_BATCH
+from src.db.records import address_key
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotPrefetcher:
+    """
+    This class requests the voting power windows of the known delegates in the background as soon as the proposal is
+    created: its start block, and so the window every later VoteCast is checked against, is already known. The
+    requests are sent in batches of batch_size delegates at most rate delegates per second, so the RPC load moves out
+    of the burst of the votes. At vote time the snapshot is joined with the changes seen by the ledger after it
+    """
+
+    def __init__(self, rate: float = SNAPSHOT_PREFETCH_RATE, batch_size: int = SNAPSHOT_PREFETCH_BATCH):
+        self.rate = rate
+        self.batch_size = batch_size
+        self.snapshots = {}  # (20-byte key of the delegate, target block) -> (block of the snapshot, window)
+        self.queue = deque()  # (lookup, delegate, target block, block of the snapshot)
+        self.task = None
+
+    def reset(self):
+        if self.task is not None:
+            self.task.get_loop().call_soon_threadsafe(self.task.cancel)
+        self.__init__(self.rate, self.batch_size)
+
+    def schedule(self, lookup, delegates, target_block: int, block: int) -> int:
+        """
+        This function queues the snapshots of the delegates and starts the worker on the running loop
+        :param lookup: CheckpointLookup of the token
+        :param delegates: iterable of the 20-byte keys of the delegates
+        :param target_block: the first block of the window: int
+        :param block: the block the snapshots are taken at: int
+        :return: amount of the queued snapshots: int
+        """
+        if not self.rate:
+            return 0
+        queued = 0
+        for delegate in delegates:
+            if (delegate, target_block) not in self.snapshots:
+                self.queue.append((lookup, delegate, target_block, block))
+                queued += 1
+        metrics.inc('agent_snapshots_scheduled_total', queued)
+        if self.queue and (self.task is None or self.task.done()):
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return queued
+
+    async def run(self):
+        while self.queue:
+            lookup, _, _, block = self.queue[0]
+            batch = []  # the consecutive snapshots of the same lookup and block go as one get_windows
+            while self.queue and len(batch) < self.batch_size and self.queue[0][0] is lookup and \
+                    self.queue[0][3] == block:
+                _, delegate, target_block, _ = self.queue.popleft()
+                batch.append((to_checksum_address(delegate), target_block))
+            try:
+                windows = await lookup.get_windows(batch, block)
+            except Exception as e:  # the votes of these delegates fall back to the lookup at vote time
+                logger.error(f'snapshot prefetch failed: {e}')
+            else:
+                for (delegate, target_block), window in windows.items():
+                    self.snapshots[(address_key(delegate), target_block)] = (block, window)
+            await asyncio.sleep(len(batch) / self.rate)
+
+    async def join(self):
+        """
+        This function waits until the queued snapshots are taken
+        """
+        while self.task is not None and not self.task.done():
+            await asyncio.wait([self.task])
+
+    def covers(self, delegate: str, target_block: int, ledger) -> bool:
+        """
+        This function checks if the window is answered by the snapshot and the changes the ledger has seen after it
+        :param delegate: str
+        :param target_block: int
+        :param ledger: VotingPowerLedger of the DAO
+        :return: bool
+        """
+        snapshot = self.snapshots.get((address_key(delegate), target_block))
+        return snapshot is not None and ledger.covers(snapshot[0] + 1)
+
+    def get_window(self, delegate: str, target_block: int, ledger) -> tuple or None:
+        """
+        This function joins the snapshot of the window with the checkpoints made after it, the result has the same
+        format as CheckpointLookup.get_window
+        :param delegate: str
+        :param target_block: int
+        :param ledger: VotingPowerLedger of the DAO
+        :return: (current voting power, checkpoints from the newest to the oldest) or None
+        """
+        block, window = self.snapshots[(address_key(delegate), target_block)]
+        recent = ledger.get_window(delegate, block + 1)
+        if recent is None or window is None:
+            return recent or window
+        return recent[0], recent[1] + window[1]
+
+    def prune(self, block: int):
+        """
+        This function drops the snapshots of the windows which start before the block
+        :param block: int
+        """
+        self.snapshots = {key: snapshot for key, snapshot in self.snapshots.items() if key[1] >= block}
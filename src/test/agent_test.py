@@ -1,10 +1,24 @@
 import eth_abi
 from eth_utils import keccak, encode_hex
-from forta_agent import create_transaction_event, get_json_rpc_url
-from src.agent import provide_handle_transaction, reset_inited
+from forta_agent import create_transaction_event, create_block_event, get_json_rpc_url
+import json
+import logging
+import os
+from src.agent import provide_handle_transaction, provide_handle_transactions, provide_handle_block, reset_inited, \
+    dispatcher, vote_cast_abi, proposal_created_abi, delegate_votes_changed_abi, register_dao, unregister_dao
+from src import agent
+from src.dao import Dao, registry
+from src.ledger import ledger
+from src.runtime import runtime
+from sqlalchemy import event
+from src.db.config import config
+from src.retention import retention
 from web3 import Web3
 from src.const import GOVERNOR_BRAVO_CONTRACT_ADDRESS, UNISWAP_CONTRACT_ADDRESS
 from src.test.web3_mock import Web3Mock
+from src.rpc import Web3RpcClient
+from src.signatures import signatures, build
+from src.deferred import deferred
 
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
 
@@ -60,6 +74,11 @@ def delegate_votes_changed(old_power, new_power, address_=UNISWAP_CONTRACT_ADDRE
             'address': address_}
 
 
+def transaction_event(block, logs, hash_="0"):
+    return create_transaction_event({'transaction': {'from': VOTER, 'to': UNISWAP_CONTRACT_ADDRESS, 'hash': hash_},
+                                     'block': {'number': block}, 'receipt': {'logs': logs}})
+
+
 class TestInfluencingGovernanceProposals:
     def test_returns_influencing_before_finding(self):
         reset_inited()
@@ -78,7 +97,7 @@ class TestInfluencingGovernanceProposals:
                 'logs': [proposal_created(150, 250, 1)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert len(findings) == 1
 
         tx_event = create_transaction_event({
@@ -94,7 +113,7 @@ class TestInfluencingGovernanceProposals:
                 'logs': [vote_cast(1, 10300)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         finding = next((x for x in findings if x.alert_id == 'UNI-GOV-INC'), None)
         assert finding
 
@@ -114,7 +133,7 @@ class TestInfluencingGovernanceProposals:
             'receipt': {
                 'logs': [proposal_created(150, 250, 1)]}
         })
-        provide_handle_transaction(w3, test=True)(tx_event)
+        provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
 
         tx_event = create_transaction_event({
             'transaction': {
@@ -129,7 +148,7 @@ class TestInfluencingGovernanceProposals:
                 'logs': [vote_cast(1, 10300)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert not findings
 
     def test_returns_decreasing_influencing_after_finding(self):
@@ -150,9 +169,12 @@ class TestInfluencingGovernanceProposals:
                 'logs': [delegate_votes_changed(10300, 100)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         finding = next((x for x in findings if x.alert_id == 'UNI-GOV-DEC'), None)
         assert finding
+        # the values of the stored vote keep the string format of the alert payload
+        assert [type(finding.metadata[x]) for x in ['proposalId', 'support', 'votes', 'difference']] == [
+            str, str, str, int]
 
     def test_returns_full_influencing_after_finding(self):
         reset_inited()
@@ -172,9 +194,12 @@ class TestInfluencingGovernanceProposals:
                 'logs': [delegate_votes_changed(10300, 100)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         finding = next((x for x in findings if x.alert_id == 'UNI-GOV-FULL'), None)
         assert finding
+        # the values of the stored vote keep the string format of the alert payload
+        assert [type(finding.metadata[x]) for x in ['proposalId', 'support', 'votes', 'difference']] == [
+            str, str, str, int]
 
     def test_returns_zero_findings_if_voting_power_was_not_decreased_after_and_increased_before(self):
         reset_inited()
@@ -194,7 +219,7 @@ class TestInfluencingGovernanceProposals:
             'receipt': {
                 'logs': [delegate_votes_changed(10300, 10250)]}
         })
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert not findings
 
     def test_returns_zero_findings_if_address_is_wrong(self):
@@ -214,7 +239,7 @@ class TestInfluencingGovernanceProposals:
                 'logs': [proposal_created(150, 250, 1, address_="0x12345123451234512345")]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert not findings
 
         tx_event = create_transaction_event({
@@ -230,7 +255,7 @@ class TestInfluencingGovernanceProposals:
                 'logs': [vote_cast(1, 10300, address_="0x12345123451234512345")]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert not findings
 
     def test_returns_zero_findings_if_changes_are_out_of_the_check_range(self):
@@ -250,7 +275,7 @@ class TestInfluencingGovernanceProposals:
                 'logs': [proposal_created(290, 310, 1)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert len(findings) == 1
 
         tx_event = create_transaction_event({
@@ -266,7 +291,7 @@ class TestInfluencingGovernanceProposals:
                 'logs': [vote_cast(1, 10300)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert not findings
 
         checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300), (300, 10300), (450, 100)]
@@ -284,5 +309,347 @@ class TestInfluencingGovernanceProposals:
                 'logs': [delegate_votes_changed(10300, 100)]}
         })
 
-        findings = provide_handle_transaction(w3, test=True)(tx_event)
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
         assert not findings
+
+    def test_reuses_event_loop_and_engine_between_transactions(self):
+        reset_inited()
+        w3 = Web3Mock([(100, 100)])
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': PROPOSER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 150
+            },
+            'receipt': {
+                'logs': [proposal_created(150, 250, 1)]}
+        })
+
+        provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+        engine = config.engine
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': PROPOSER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 151
+            },
+            'receipt': {
+                'logs': [proposal_created(151, 251, 2)]}
+        })
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+        assert len(findings) == 1
+        assert config.engine is engine
+
+    def test_returns_influencing_before_finding_from_ledger(self):
+        reset_inited()
+        w3 = Web3Mock([])
+        for block, logs in [(10, []), (60, [delegate_votes_changed(0, 100)]), (100, [proposal_created(150, 250, 1)]),
+                            (120, [delegate_votes_changed(100, 10300)])]:
+            provide_handle_transaction(Web3RpcClient(w3), test=True)(create_transaction_event({
+                'transaction': {
+                    'from': VOTER,
+                    'to': UNISWAP_CONTRACT_ADDRESS,
+                    'hash': "0"
+                },
+                'block': {
+                    'number': block
+                },
+                'receipt': {
+                    'logs': logs}
+            }))
+
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': VOTER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 160
+            },
+            'receipt': {
+                'logs': [vote_cast(1, 10300)]}
+        })
+
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+        finding = next((x for x in findings if x.alert_id == 'UNI-GOV-INC'), None)
+        assert finding
+        assert finding.metadata['difference'] == 10200
+        assert not w3.calls  # the agent has seen the whole window, so no rpc calls are needed
+
+    def test_voter_index_follows_stored_votes(self):
+        reset_inited()
+        self.test_returns_zero_findings_if_voting_power_was_not_increased_before()
+        assert len(config.get_votes().get_indexed_rows(VOTER)) == 1
+
+        w3 = Web3Mock([])
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': PROPOSER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 300
+            },
+            'receipt': {
+                'logs': []}
+        })
+        provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+        assert not config.get_votes().get_indexed_rows(VOTER)
+
+    def test_commits_once_per_transaction(self):
+        reset_inited()
+        checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300)]
+        w3 = Web3Mock(checkpoints)
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': PROPOSER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 150
+            },
+            'receipt': {
+                'logs': [proposal_created(150, 250, 1), proposal_created(150, 250, 2)]}
+        })
+        provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+
+        commits = []
+        event.listen(config.engine.sync_engine, 'commit', lambda conn: commits.append(conn))
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': VOTER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 160
+            },
+            'receipt': {
+                'logs': [vote_cast(1, 10300), vote_cast(2, 10300)]}
+        })
+        findings = provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+        assert len([x for x in findings if x.alert_id == 'UNI-GOV-INC']) == 2
+        assert len(commits) == 1
+
+    def test_sweeps_retention_once_per_block(self):
+        reset_inited()
+        self.test_returns_zero_findings_if_voting_power_was_not_increased_before()
+
+        w3 = Web3Mock([])
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': PROPOSER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 400
+            },
+            'receipt': {
+                'logs': []}
+        })
+        provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+        assert retention.last_sweep == {'votes': 1, 'proposals': 1}
+
+        retention.last_sweep = {}
+        provide_handle_transaction(Web3RpcClient(w3), test=True)(tx_event)
+        assert retention.last_sweep == {}  # the second transaction of the block does not sweep again
+
+    def test_dispatcher_decodes_events_like_filter_log(self):
+        tx_event = create_transaction_event({
+            'transaction': {
+                'from': VOTER,
+                'to': UNISWAP_CONTRACT_ADDRESS,
+                'hash': "0"
+            },
+            'block': {
+                'number': 160
+            },
+            'receipt': {
+                'logs': [proposal_created(150, 250, 1), vote_cast(1, 10300), delegate_votes_changed(10300, 100),
+                         vote_cast(1, 10300, address_="0x12345123451234512345")]}
+        })
+
+        events = dispatcher.dispatch(tx_event.logs)
+        for name, abi, address in [('ProposalCreated', proposal_created_abi, GOVERNOR_BRAVO_CONTRACT_ADDRESS),
+                                   ('VoteCast', vote_cast_abi, GOVERNOR_BRAVO_CONTRACT_ADDRESS),
+                                   ('DelegateVotesChanged', delegate_votes_changed_abi, UNISWAP_CONTRACT_ADDRESS)]:
+            expected = [dict(event['args']) for event in tx_event.filter_log(json.dumps(abi), address)]
+            assert [event['args'] for event in events[name]] == expected
+        assert len(events['VoteCast']) == 1
+
+        tx_event = create_transaction_event({'block': {'number': 160}, 'receipt': {'logs': [
+            vote_cast(1, 10300, address_=UNISWAP_CONTRACT_ADDRESS)]}})
+        assert dispatcher.dispatch(tx_event.logs) == {}
+        # the precompiled artifact is regenerated with the full ABI files (python -m src.signatures)
+        assert signatures == build()
+
+    def test_block_batch_returns_same_findings_as_transactions(self):
+        checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300)]
+        blocks = [(150, [[proposal_created(150, 250, 1), proposal_created(150, 250, 2)]]),
+                  (160, [[vote_cast(1, 10300)], [vote_cast(2, 10300)]]),
+                  (180, [[delegate_votes_changed(10300, 100)], [delegate_votes_changed(100, 50)]])]
+
+        reset_inited()
+        w3_transactions = Web3Mock(checkpoints)
+        handle_transaction = provide_handle_transaction(Web3RpcClient(w3_transactions), test=True)
+        expected = [handle_transaction(transaction_event(block, logs)) for block, transactions in blocks
+                    for logs in transactions]
+        expected = [(x.alert_id, x.metadata) for findings in expected for x in findings]
+
+        reset_inited()
+        w3_batch = Web3Mock(checkpoints)
+        handle_transactions = provide_handle_transactions(Web3RpcClient(w3_batch), test=True)
+        findings = [handle_transactions([transaction_event(block, logs) for logs in transactions], block)
+                    for block, transactions in blocks]
+        assert [(x.alert_id, x.metadata) for x in sum(findings, [])] == expected
+        # the window of the second vote is answered by the rpc cache in the per-transaction mode
+        assert w3_batch.calls['aggregate'] <= w3_transactions.calls['aggregate']
+
+        reset_inited()
+        logs = [log | {'blockNumber': block, 'transactionHash': f"0x{block:x}{i}", 'logIndex': i * 10 + j}
+                for block, transactions in blocks for i, logs in enumerate(transactions) for j, log in enumerate(logs)]
+        handle_block = provide_handle_block(Web3RpcClient(Web3Mock(checkpoints, logs)), test=True)
+        findings = [handle_block(create_block_event({'block': {'number': block}})) for block, _ in blocks]
+        assert [(x.alert_id, x.metadata) for x in sum(findings, [])] == expected
+
+    def test_checks_every_open_vote_of_delegate(self):
+        reset_inited()
+        handle_transaction = provide_handle_transaction(
+            Web3RpcClient(Web3Mock([(100, 100), (120, 100), (140, 10300), (160, 10300)])), test=True)
+        handle_transaction(transaction_event(150, [proposal_created(150, 250, 1), proposal_created(150, 250, 2)]))
+        handle_transaction(transaction_event(160, [vote_cast(1, 10300), vote_cast(2, 10300)]))
+        findings = handle_transaction(transaction_event(180, [delegate_votes_changed(10300, 100)]))
+        assert [(x.alert_id, x.metadata['proposalId']) for x in findings] == [('UNI-GOV-FULL', '1'),
+                                                                               ('UNI-GOV-FULL', '2')]
+
+    def test_prunes_ledger_before_window_of_active_proposals(self):
+        reset_inited()
+        handle_transaction = provide_handle_transaction(Web3RpcClient(Web3Mock([(100, 100)])), test=True)
+        handle_transaction(transaction_event(150, [proposal_created(150, 250, 1)]))
+        handle_transaction(transaction_event(160, [delegate_votes_changed(100, 10300)]))
+        handle_transaction(transaction_event(240, [delegate_votes_changed(10300, 100)]))
+        assert ledger.get_window(VOTER, 60) == (100, [(240, 100), (160, 10300)])  # the window of the active proposal
+
+        # the proposal has ended, so the checkpoints before the window of the proposals created from now on are dropped
+        handle_transaction(transaction_event(400, [delegate_votes_changed(100, 200)]))
+        assert ledger.get_window(VOTER, 300) == (200, [(400, 200)])
+        assert not ledger.covers(299) and ledger.covers(300)
+
+    def test_answers_votes_from_prefetched_snapshots(self):
+        reset_inited()
+        w3 = Web3Mock([(40, 100), (60, 100), (100, 10300)])
+        handle_transaction = provide_handle_transaction(Web3RpcClient(w3), test=True)
+        handle_transaction(transaction_event(100, [delegate_votes_changed(100, 10300)]))
+        # the window starts at block 50 before the ledger, so it is requested in the background at block 150
+        handle_transaction(transaction_event(150, [proposal_created(150, 250, 1)]))
+        runtime.run(registry.default.snapshots.join())
+        calls = w3.calls['aggregate']
+        assert calls > 0
+
+        findings = handle_transaction(transaction_event(160, [vote_cast(1, 10300)]))
+        assert [x.alert_id for x in findings] == ['UNI-GOV-INC']
+        assert w3.calls['aggregate'] == calls  # the vote is answered by the snapshot and the ledger
+
+    def test_prefetches_snapshots_of_stored_proposals_after_restart(self, monkeypatch):
+        reset_inited()
+        w3 = Web3Mock([(900, 100), (14050, 100), (14100, 10300)])
+        handle_transaction = provide_handle_transaction(Web3RpcClient(w3), test=True)
+        # the voting delay of Uniswap: the window starts after the creation, the ledger covers it
+        handle_transaction(transaction_event(1000, [proposal_created(1000 + 13140, 1000 + 13140 + 40320, 1)]))
+        handle_transaction(transaction_event(14100, [delegate_votes_changed(100, 10300)]))
+        handle_transaction(transaction_event(14150, [vote_cast(1, 10300)]))
+        runtime.run(registry.default.snapshots.join())
+        assert registry.default.snapshots.snapshots == {}
+        assert w3.calls['aggregate'] == 0
+
+        # after the restart the window starts before the ledger, it is requested at the first handled block
+        reset_inited()
+        monkeypatch.setattr(agent, 'inited', True)  # the tables are kept
+        handle_transaction(transaction_event(14200, [delegate_votes_changed(10300, 10300)]))
+        runtime.run(registry.default.snapshots.join())
+        calls = w3.calls['aggregate']
+        assert calls > 0
+
+        findings = handle_transaction(transaction_event(14210, [vote_cast(1, 10300)]))
+        assert [x.alert_id for x in findings] == ['UNI-GOV-INC']
+        assert w3.calls['aggregate'] == calls  # the vote is answered by the snapshot and the ledger
+
+    def test_defers_deep_lookups_past_budget_of_transaction(self, monkeypatch):
+        reset_inited()
+        w3 = Web3Mock([(100, 100), (120, 100), (140, 10300), (160, 10300)], latency=0.2)
+        handle_transaction = provide_handle_transaction(Web3RpcClient(w3), test=True)
+        handle_transaction(transaction_event(150, [proposal_created(150, 250, 1)]))
+
+        # the lookup of the window takes several slow calls, the vote is checked in the background
+        monkeypatch.setattr(deferred, 'budget', 0.05)
+        processed = []
+        monkeypatch.setattr(config, 'block_processed', lambda block, complete=False: processed.append(block))
+        assert handle_transaction(transaction_event(160, [vote_cast(1, 10300)])) == []
+        assert deferred.stats()['depth'] == 1
+        assert deferred.stats()['deferred'] == {'detect_cast_vote': 1}
+        assert processed == []  # the block is held until its deferred check stores the vote
+
+        # the finding of the deferred check is emitted by the next invocation and the vote is stored
+        runtime.run(deferred.join())
+        assert processed == [160]
+        findings = handle_transaction(transaction_event(161, []))
+        assert [x.alert_id for x in findings] == ['UNI-GOV-INC']
+        assert runtime.run(config.get_votes().count_rows()) == 1
+        assert deferred.stats()['depth'] == 0
+        assert processed == [160, 161]
+
+    def test_warns_about_blocks_skipped_by_resume(self, monkeypatch, caplog):
+        reset_inited()
+        monkeypatch.setattr(config, 'last_processed_block', lambda: 100)
+        handle_transaction = provide_handle_transaction(Web3RpcClient(Web3Mock([], [])), test=True)
+        with caplog.at_level(logging.WARNING):
+            handle_transaction(transaction_event(1200, []))
+        assert 'resume skips the blocks 101-199' in caplog.text
+
+    def test_routes_events_of_several_daos_to_their_own_tables(self, monkeypatch):
+        governor, token = "0x3333333333333333333333333333333333333333", "0x4444444444444444444444444444444444444444"
+        compound = Dao('compound', governor, token, title='Compound', symbol='COMP', th_low=20000)
+
+        register_dao(compound)
+        try:
+            reset_inited()
+            handle_transaction = provide_handle_transaction(
+                Web3RpcClient(Web3Mock([(100, 100), (120, 100), (140, 10300), (160, 10300)])), test=True)
+            findings = handle_transaction(transaction_event(150, [proposal_created(150, 250, 1),
+                                                                  proposal_created(150, 250, 1, address_=governor)]))
+            assert [x.alert_id for x in findings] == ['UNI-GOV-INFO', 'COMP-GOV-INFO']
+            assert findings[1].name == 'Compound Proposal Created'
+
+            # the difference is above the threshold of Uniswap, but below the threshold of Compound
+            findings = handle_transaction(transaction_event(160, [vote_cast(1, 10300), vote_cast(1, 10300, governor)]))
+            assert [x.alert_id for x in findings] == ['UNI-GOV-INC']
+
+            handle_transaction(transaction_event(170, [delegate_votes_changed(10300, 100, token)]))
+            assert compound.ledger.get_window(VOTER, 170) == (100, [(170, 100)])
+            # the next transactions of the block visit only the DAOs whose contracts emitted the events
+            processed = []
+            monkeypatch.setattr(config, 'block_processed', lambda block, complete=False: processed.append(block))
+            handle_transaction(transaction_event(170, [delegate_votes_changed(100, 100, token)]))
+            assert handle_transaction(transaction_event(170, [])) == []
+            assert processed == []
+            assert ledger.get_window(VOTER, 170) is None
+            assert runtime.run(compound.db.get_votes().count_rows()) == 1
+            assert runtime.run(config.get_votes().count_rows()) == 1
+            assert os.path.exists('./test_compound.db')
+        finally:
+            unregister_dao(compound)
+            if compound.db.engine is not None:
+                runtime.run(compound.db.engine.dispose())
+            if os.path.exists('./test_compound.db'):
+                os.remove('./test_compound.db')
+        assert dispatcher.dispatch(transaction_event(160, [vote_cast(1, 10300, governor)]).logs) == {}
@@ -0,0 +1,227 @@
+"""
+Synthetic-load benchmark of the agent with RPC and db statement accounting:
+
+    python -m src.test.benchmark --proposals 3 --voters 100 --checkpoints 300 --changes-per-tx 20 --transactions 1000
+
+The cold start (the import of the agent, the warm-up of initialize and the first transactions) is measured in a fresh
+interpreter:
+
+    python -m src.test.benchmark --cold-start
+
+The report is printed as json, so it can be compared between the revisions
+"""
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import eth_abi
+from eth_utils import keccak, encode_hex
+from forta_agent import create_transaction_event
+from sqlalchemy import event
+
+from src.agent import provide_handle_transaction, reset_inited, init, warm_up
+from src.const import GOVERNOR_BRAVO_CONTRACT_ADDRESS, UNISWAP_CONTRACT_ADDRESS
+from src.db.config import config
+from src.deferred import deferred
+from src.rpc import Web3RpcClient
+from src.rpc_cache import rpc_cache
+from src.runtime import runtime
+from src.test.web3_mock import Web3Mock
+
+VOTE_CAST = keccak(text="VoteCast(address,uint256,uint8,uint256,string)")
+PROPOSAL_CREATED = keccak(
+    text="ProposalCreated(uint256,address,address[],uint256[],string[],bytes[],uint256,uint256,string)")
+DELEGATE_VOTES_CHANGED = keccak(text="DelegateVotesChanged(address,uint256,uint256)")
+PROPOSER = "0x2222222222222222222222222222222222222222"
+
+CREATION_BLOCK = 100000
+VOTING_DELAY = 50  # the window of the proposals starts before the agent, so the votes go to the RPC lookup
+
+# targets of the cold start, the import of forta_agent itself (it loads web3) is reported, but not targeted
+IMPORT_TARGET_SECONDS = 0.1
+WARM_UP_TARGET_SECONDS = 0.5
+FIRST_TX_TARGET_SECONDS = 0.05
+# the script of the fresh interpreter, the benchmark module is imported after the agent, so it does not skew the import
+COLD_START_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import forta_agent
+sdk_imported = time.perf_counter()
+import src.agent
+imported = time.perf_counter()
+db_imported = 'sqlalchemy' in sys.modules
+from src.test.benchmark import measure_first_transactions
+print(json.dumps({'import_seconds': {'forta_agent': sdk_imported - started, 'agent': imported - sdk_imported},
+                  'db_imported_by_agent': db_imported} | measure_first_transactions()))
+"""
+
+
+def topic(address: str) -> str:
+    return encode_hex(eth_abi.encode_abi(["address"], [address]))
+
+
+def proposal_created(proposal_id: int, start: int, end: int) -> dict:
+    data = eth_abi.encode_abi(
+        ["uint256", "address", "address[]", "uint256[]", "string[]", "bytes[]", "uint256", "uint256", "string"],
+        [proposal_id, PROPOSER, [], [], [], [], start, end, "description"])
+    return {'topics': [PROPOSAL_CREATED], 'data': encode_hex(data), 'address': GOVERNOR_BRAVO_CONTRACT_ADDRESS}
+
+
+def vote_cast(voter: str, proposal_id: int, votes: int) -> dict:
+    data = eth_abi.encode_abi(["uint256", "uint8", "uint256", "string"], [proposal_id, 1, votes, ""])
+    return {'topics': [VOTE_CAST, topic(voter)], 'data': encode_hex(data), 'address': GOVERNOR_BRAVO_CONTRACT_ADDRESS}
+
+
+def delegate_votes_changed(delegate: str, old_power: int, new_power: int) -> dict:
+    data = eth_abi.encode_abi(["uint256", "uint256"], [old_power, new_power])
+    return {'topics': [DELEGATE_VOTES_CHANGED, topic(delegate)], 'data': encode_hex(data),
+            'address': UNISWAP_CONTRACT_ADDRESS}
+
+
+def transaction(block: int, logs: list):
+    return create_transaction_event({'transaction': {'from': PROPOSER, 'to': UNISWAP_CONTRACT_ADDRESS, 'hash': "0"},
+                                     'block': {'number': block}, 'receipt': {'logs': logs}})
+
+
+def generate_workload(proposals: int, voters: int, checkpoints: int, changes_per_tx: int, transactions: int,
+                      seed: int = 0) -> tuple:
+    """
+    This function generates the checkpoints of the voters and the transactions: the creation of the proposals, then
+    the VoteCast transactions interleaved with the transactions with changes_per_tx DelegateVotesChanged events
+    :return: (lowercase voter -> list of checkpoints, list of transaction events)
+    """
+    rng = random.Random(seed)
+    start = CREATION_BLOCK + VOTING_DELAY
+    addresses = [f"0x{i + 1:040x}" for i in range(voters)]
+    history = {}
+    for address in addresses:
+        # the checkpoints are spread over the blocks before the creation and the window of the proposals
+        blocks = sorted(rng.sample(range(start - 10 * checkpoints, start), checkpoints))
+        history[address] = [(block, rng.randint(0, 10 ** 22)) for block in blocks]
+
+    events = [transaction(CREATION_BLOCK, [proposal_created(i + 1, start, start + 10 ** 6) for i in range(proposals)])]
+    votes = [(address, proposal_id + 1) for proposal_id in range(proposals) for address in addresses]
+    block = start
+    for i in range(transactions - 1):
+        block += i % 2
+        if i % 2 == 0 and votes:
+            address, proposal_id = votes.pop(0)
+            events.append(transaction(block, [vote_cast(address, proposal_id, history[address][-1][1])]))
+        else:
+            events.append(transaction(block, [delegate_votes_changed(rng.choice(addresses), 10 ** 22, rng.randint(
+                0, 10 ** 22)) for _ in range(changes_per_tx)]))
+    return history, events
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def run(proposals: int = 3, voters: int = 50, checkpoints: int = 100, changes_per_tx: int = 10,
+        transactions: int = 200, latency: float = 0.0, seed: int = 0, budget: float = 0.0) -> dict:
+    """
+    This function runs the generated workload through handle_transaction
+    :param budget: time budget of the invocation in seconds, 0 disables the deferred checks
+    :return: report: dict
+    """
+    history, events = generate_workload(proposals, voters, checkpoints, changes_per_tx, transactions, seed)
+    w3 = Web3Mock(history, latency=latency)
+    handle_transaction = provide_handle_transaction(Web3RpcClient(w3), test=True)
+
+    reset_inited()
+    deferred.budget = budget
+    runtime.run(init(True))
+    statements = []
+    if config.engine is not None:  # the in-memory storage backend runs no statements
+        event.listen(config.engine.sync_engine, 'before_cursor_execute', lambda *args: statements.append(1))
+
+    latencies = []
+    findings = Counter()
+    started = time.perf_counter()
+    for transaction_event in events:
+        start = time.perf_counter()
+        findings.update(finding.alert_id for finding in handle_transaction(transaction_event))
+        latencies.append(time.perf_counter() - start)
+    seconds = time.perf_counter() - started
+    runtime.run(deferred.join())  # the findings of the deferred checks are counted, but not timed
+    findings.update(finding.alert_id for finding in deferred.drain())
+
+    vote_casts = sum(1 for transaction_event in events for log in transaction_event.logs if log.topics[0] == VOTE_CAST)
+    return {
+        'workload': {'proposals': proposals, 'voters': voters, 'checkpoints': checkpoints,
+                     'changes_per_tx': changes_per_tx, 'transactions': len(events), 'latency': latency},
+        'seconds': seconds,
+        'tx_per_second': len(events) / seconds if seconds else 0.0,
+        'latency_ms': {'p50': percentile(latencies, 0.5) * 1000, 'p99': percentile(latencies, 0.99) * 1000},
+        'rpc_calls': dict(w3.calls),
+        'rpc_calls_per_vote_cast': sum(w3.calls.values()) / vote_casts if vote_casts else 0.0,
+        'checkpoint_reads_per_vote_cast':
+            w3.eth.contract.functions.checkpoint_reads / vote_casts if vote_casts else 0.0,
+        'rpc_cache': rpc_cache.stats(),
+        'db_statements_per_tx': len(statements) / len(events),
+        'deferred': deferred.stats(),
+        'findings': dict(findings),
+    }
+
+
+def measure_first_transactions(transactions: int = 5) -> dict:
+    """
+    This function times the warm-up and the first transactions of the small workload, it is run by the fresh
+    interpreter of cold_start
+    :return: report: dict
+    """
+    history, events = generate_workload(1, 5, 20, 2, transactions)
+    client = Web3RpcClient(Web3Mock(history))
+    handle_transaction = provide_handle_transaction(client, test=True)
+    started = time.perf_counter()
+    runtime.run(warm_up(client, test=True))
+    warm_up_seconds = time.perf_counter() - started
+    latencies = []
+    for transaction_event in events:
+        start = time.perf_counter()
+        handle_transaction(transaction_event)
+        latencies.append(time.perf_counter() - start)
+    return {'warm_up_seconds': warm_up_seconds, 'first_tx_ms': [x * 1000 for x in latencies]}
+
+
+def cold_start() -> dict:
+    """
+    This function measures the cold start of the agent in the fresh interpreter and compares it with the targets
+    :return: report: dict
+    """
+    output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], capture_output=True, text=True, check=True)
+    report = json.loads(output.stdout.strip().splitlines()[-1])
+    report['within_targets'] = {
+        'import': report['import_seconds']['agent'] <= IMPORT_TARGET_SECONDS,
+        'warm_up': report['warm_up_seconds'] <= WARM_UP_TARGET_SECONDS,
+        'first_tx': report['first_tx_ms'][0] / 1000 <= FIRST_TX_TARGET_SECONDS,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the synthetic workload through the agent')
+    parser.add_argument('--proposals', type=int, default=3)
+    parser.add_argument('--voters', type=int, default=50)
+    parser.add_argument('--checkpoints', type=int, default=100, help='checkpoints per voter')
+    parser.add_argument('--changes-per-tx', type=int, default=10, help='DelegateVotesChanged events per tx')
+    parser.add_argument('--transactions', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency of every RPC call')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--budget-ms', type=float, default=0.0, help='time budget of the invocation, 0 disables it')
+    parser.add_argument('--cold-start', action='store_true', help='measure the import and the first transactions')
+    args = parser.parse_args()
+    if args.cold_start:
+        print(json.dumps(cold_start(), indent=2))
+        return
+    print(json.dumps(run(args.proposals, args.voters, args.checkpoints, args.changes_per_tx, args.transactions,
+                         args.latency_ms / 1000, args.seed, args.budget_ms / 1000), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+from src.test.benchmark import run, cold_start
+
+
+class TestBenchmark:
+    def test_reports_bounded_rpc_calls_per_vote_cast(self):
+        report = run(proposals=2, voters=5, checkpoints=200, changes_per_tx=3, transactions=20)
+
+        assert set(report) >= {'tx_per_second', 'latency_ms', 'rpc_calls', 'rpc_calls_per_vote_cast',
+                               'db_statements_per_tx', 'findings'}
+        assert report['findings']['UNI-GOV-INFO'] == 2
+        # the k-ary search costs O(log n) aggregate calls per vote instead of one call per checkpoint
+        assert set(report['rpc_calls']) == {'aggregate'}
+        assert report['rpc_calls_per_vote_cast'] <= 5
+        assert report['checkpoint_reads_per_vote_cast'] < 200
+
+    def test_cold_start_leaves_db_layer_to_warm_up(self):
+        report = cold_start()
+
+        # sqlalchemy is loaded by initialize, so the import of the agent costs only its own modules
+        assert report['db_imported_by_agent'] is False
+        # the timings depend on the load of the machine, they are reported and not asserted
+        assert set(report['within_targets']) == {'import', 'warm_up', 'first_tx'}
+        assert len(report['first_tx_ms']) == 5
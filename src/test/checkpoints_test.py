@@ -0,0 +1,110 @@
+import asyncio
+import random
+import threading
+
+from src.checkpoints import CheckpointLookup
+from src.rpc import Web3RpcClient
+from src.rpc_cache import RpcCache
+from src.test.web3_mock import Web3Mock
+
+VOTER = "0x1111111111111111111111111111111111111111"
+
+
+def linear_window(checkpoints, target_block):
+    # walk the checkpoints backwards one by one
+    if checkpoints[-1][0] < target_block:
+        return None
+    window = []
+    for i in range(len(checkpoints) - 1, -1, -1):
+        if checkpoints[i][0] < target_block:
+            break
+        window.append(checkpoints[i])
+    return checkpoints[-1][1], window
+
+
+def generate_checkpoints(amount):
+    block = 0
+    checkpoints = []
+    for _ in range(amount):
+        block += random.randint(1, 20)
+        checkpoints.append((block, random.randint(0, 10 ** 24)))
+    return checkpoints
+
+
+class TestCheckpointLookup:
+    def test_returns_same_window_as_linear_scan(self):
+        random.seed(0)
+        for amount in [1, 2, 3, 17, 18, 100, 500]:
+            checkpoints = generate_checkpoints(amount)
+            for target_block in [0, checkpoints[0][0], checkpoints[amount // 2][0], checkpoints[-1][0],
+                                 checkpoints[-1][0] + 1, random.randint(0, checkpoints[-1][0])]:
+                lookup = CheckpointLookup(Web3RpcClient(Web3Mock(checkpoints)))
+                window = asyncio.run(lookup.get_window(VOTER, target_block, checkpoints[-1][0]))
+                assert window == linear_window(checkpoints, target_block)
+
+    def test_costs_logarithmic_amount_of_calls(self):
+        random.seed(1)
+        checkpoints = generate_checkpoints(1000)
+        w3 = Web3Mock(checkpoints)
+        lookup = CheckpointLookup(Web3RpcClient(w3))
+        target_block = checkpoints[-5][0]
+
+        window = asyncio.run(lookup.get_window(VOTER, target_block, checkpoints[-1][0]))
+
+        assert window == linear_window(checkpoints, target_block)
+        assert w3.calls['aggregate'] <= 5
+        assert w3.eth.contract.functions.checkpoint_reads <= 4 * lookup.fanout + 1
+
+    def test_batches_windows_of_several_accounts(self):
+        random.seed(2)
+        checkpoints = generate_checkpoints(300)
+        w3 = Web3Mock(checkpoints)
+        lookup = CheckpointLookup(Web3RpcClient(w3), chunk_size=10 ** 4)  # one aggregate call per round
+        requests = [(f"0x{i:040x}", checkpoints[i * 20][0]) for i in range(1, 10)]
+
+        windows = asyncio.run(lookup.get_windows(requests + requests[:3], checkpoints[-1][0]))
+
+        assert windows == {request: linear_window(checkpoints, request[1]) for request in requests}
+        assert w3.calls['aggregate'] <= 5  # the searches of all the accounts share the round-trips
+
+    def test_caches_block_pinned_calls(self, tmp_path):
+        random.seed(3)
+        checkpoints = generate_checkpoints(300)
+        w3 = Web3Mock(checkpoints)
+        cache = RpcCache(size=10 ** 4, path=str(tmp_path / 'rpc_cache.db'))
+        target_block, block = checkpoints[-20][0], checkpoints[-1][0]
+        expected = linear_window(checkpoints, target_block)
+
+        assert asyncio.run(CheckpointLookup(Web3RpcClient(w3), cache=cache).get_window(VOTER, target_block,
+                                                                                        block)) == expected
+        calls = w3.calls['aggregate']
+        assert asyncio.run(CheckpointLookup(Web3RpcClient(w3), cache=cache).get_window(VOTER, target_block,
+                                                                                        block)) == expected
+        assert w3.calls['aggregate'] == calls and cache.hits > 0
+
+        # the disk tier survives the restart, the checkpoints below the last one are reused at the later blocks
+        cache.close()
+        restarted = RpcCache(size=10 ** 4, path=str(tmp_path / 'rpc_cache.db'))
+        disk_reads = []  # (thread, amount of the keys) of every disk query
+        read = restarted.read
+        restarted.read = lambda keys: disk_reads.append((threading.current_thread().name, len(keys))) or read(keys)
+        lookup = CheckpointLookup(Web3RpcClient(w3), cache=restarted)
+        assert asyncio.run(lookup.get_window(VOTER, target_block, block)) == expected
+        assert w3.calls['aggregate'] == calls and restarted.disk_hits > 0
+        # the keys of an aggregate call are read at once by the thread of the cache, not by the event loop
+        assert {thread for thread, _ in disk_reads} == {'agent-rpc-cache_0'}
+        assert len(disk_reads) <= calls and sum(amount for _, amount in disk_reads) == restarted.disk_hits
+        reads = w3.eth.contract.functions.checkpoint_reads
+        assert asyncio.run(lookup.get_window(VOTER, target_block, block + 1)) == expected
+        assert w3.eth.contract.functions.checkpoint_reads == reads + 1  # only the last checkpoint is requested again
+        restarted.close()
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = RpcCache(size=2)
+        asyncio.run(cache.put_many([(("0x1", b"a", 1), b"1"), (("0x1", b"b", 1), b"2")]))
+        assert asyncio.run(cache.get_many([("0x1", b"a", 1)])) == [b"1"]
+        asyncio.run(cache.put_many([(("0x1", b"c", None), b"3")]))
+
+        assert asyncio.run(cache.get_many([("0x1", b"b", 1), ("0x1", b"a", 1), ("0x1", b"c", None)])) == [
+            None, b"1", b"3"]
+        assert cache.stats() == {'hits': 3, 'misses': 1, 'disk_hits': 0, 'entries': 2}
@@ -0,0 +1,258 @@
+import os
+import sqlite3
+
+from src import agent
+from src.db import controller
+from src.db.controller import init_async_db
+from src.db.config import config
+from src.db.memory import MemoryMethods
+from src.db.methods import create_index
+from src.db.records import VoteRecord
+from src.rpc import Web3RpcClient, RpcError
+from src.runtime import runtime
+from src.test.agent_test import proposal_created, vote_cast, delegate_votes_changed, transaction_event
+from src.test.web3_mock import Web3Mock
+
+VOTER = "0x1111111111111111111111111111111111111111"
+NAME = "migration_test"
+
+
+class TestDatabase:
+    def test_migrates_legacy_schema(self):
+        path = f'./{NAME}.db'
+        if os.path.exists(path):
+            os.remove(path)
+        with sqlite3.connect(path) as conn:  # the schema of the previous versions of the agent
+            conn.execute('CREATE TABLE proposals (id INTEGER NOT NULL, proposal_id VARCHAR, start_block INTEGER, '
+                         'end_block INTEGER, PRIMARY KEY (id), UNIQUE (proposal_id))')
+            conn.execute('CREATE TABLE votes (id INTEGER NOT NULL, proposal_id VARCHAR, voter VARCHAR, '
+                         'support VARCHAR, block_number INTEGER, votes VARCHAR, reason VARCHAR, influencing BOOLEAN, '
+                         'PRIMARY KEY (id))')
+            conn.execute("INSERT INTO proposals (proposal_id, start_block, end_block) VALUES ('1', 150, 250)")
+            conn.execute("INSERT INTO votes (proposal_id, voter, support, block_number, votes, reason, influencing) "
+                         f"VALUES ('1', '{VOTER}', '1', 160, '{10 ** 24}', '', 0)")
+
+        try:
+            proposals, votes = runtime.run(init_async_db(name=NAME))
+            proposal = runtime.run(proposals.get_row_by_criteria({'proposal_id': 1}))
+            assert (proposal.start_block, proposal.end_block) == (150, 250)
+            vote = runtime.run(votes.get_row_by_criteria({'voter': VOTER}))
+            assert (vote.proposal_id, vote.support, vote.votes) == (1, 1, 10 ** 24)
+            assert votes.get_indexed_rows(VOTER)
+
+            # the second start finds the current schema and keeps the rows
+            proposals, votes = runtime.run(init_async_db(name=NAME))
+            assert len(runtime.run(votes.get_all_rows())) == 1
+
+            with sqlite3.connect(path) as conn:
+                indexes = {row[1] for row in conn.execute("PRAGMA index_list('votes')")}
+            assert {'ix_votes_voter', 'ix_votes_block_number', 'ix_votes_proposal_id'} <= indexes
+        finally:
+            runtime.run(init_async_db(test=True))  # release the migrated db
+            os.remove(path)
+
+    def test_migrates_indexed_schema(self):
+        path = f'./{NAME}.db'
+        if os.path.exists(path):
+            os.remove(path)
+        with sqlite3.connect(path) as conn:  # the indexed schema without the log of the vote
+            conn.execute('CREATE TABLE votes (id INTEGER NOT NULL, proposal_id INTEGER, voter VARCHAR, '
+                         'support INTEGER, block_number INTEGER, votes VARCHAR(78), reason VARCHAR, '
+                         'influencing BOOLEAN, PRIMARY KEY (id))')
+            for column in ['proposal_id', 'voter', 'block_number']:
+                conn.execute(f'CREATE INDEX ix_votes_{column} ON votes ({column})')
+            conn.execute("INSERT INTO votes (proposal_id, voter, support, block_number, votes, reason, influencing) "
+                         f"VALUES (1, '{VOTER}', 1, 160, '{10 ** 24:078d}', '', 0)")
+
+        try:
+            _, votes = runtime.run(init_async_db(name=NAME))
+            vote = runtime.run(votes.get_row_by_criteria({'voter': VOTER}))
+            assert (vote.proposal_id, vote.votes, vote.transaction_hash) == (1, 10 ** 24, None)
+
+            with sqlite3.connect(path) as conn:
+                tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                indexes = {row[1] for row in conn.execute("PRAGMA index_list('votes')")}
+            assert 'votes_legacy' not in tables
+            assert {'ix_votes_voter', 'ix_votes_block_number', 'ix_votes_proposal_id'} <= indexes
+        finally:
+            runtime.run(init_async_db(test=True))  # release the migrated db
+            os.remove(path)
+
+    def test_rolls_back_index_with_failed_transaction(self):
+        class FailingWeb3:
+            def __init__(self):
+                self.eth = self
+
+            def call(self, *_):
+                raise RpcError('rpc is down')
+
+        agent.reset_inited()
+        handle_transaction = agent.provide_handle_transaction(Web3RpcClient(FailingWeb3(), retries=0), test=True)
+        handle_transaction(transaction_event(150, [proposal_created(150, 250, 1)]))
+        failed = transaction_event(160, [proposal_created(160, 260, 2), vote_cast(1, 10300)])
+        try:
+            handle_transaction(failed)
+            assert False, 'the lookup of the vote has to fail'
+        except RpcError:
+            pass
+
+        # the proposal of the rolled back transaction is neither in the db nor in the index
+        assert config.get_proposals().get_proposal(2) is None
+        assert runtime.run(config.get_proposals().count_rows()) == 1
+
+        handle_transaction = agent.provide_handle_transaction(
+            Web3RpcClient(Web3Mock([(100, 100), (120, 100), (140, 10300), (160, 10300)])), test=True)
+        assert [x.alert_id for x in handle_transaction(failed)] == ['UNI-GOV-INFO', 'UNI-GOV-INC']
+        assert config.get_proposals().get_proposal(2) is not None
+
+    def test_memory_backend_returns_same_findings_as_sqlite(self, monkeypatch):
+        checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300)]
+        transactions = [(150, [proposal_created(150, 250, 1)]), (160, [vote_cast(1, 10300)]),
+                        (170, [delegate_votes_changed(10300, 100)]), (400, [])]
+
+        def run():
+            agent.reset_inited()
+            handle_transaction = agent.provide_handle_transaction(Web3RpcClient(Web3Mock(checkpoints)), test=True)
+            return [(x.alert_id, x.metadata) for block, logs in transactions
+                    for x in handle_transaction(transaction_event(block, logs))]
+
+        expected = run()
+        monkeypatch.setattr(controller, 'STORAGE_BACKEND', 'memory')
+        try:
+            assert run() == expected
+            assert [x[0] for x in expected] == ['UNI-GOV-INFO', 'UNI-GOV-INC', 'UNI-GOV-FULL']
+            assert runtime.run(config.get_votes().count_rows()) == 0  # removed by the retention at block 400
+        finally:
+            if os.path.exists('./test.snapshot.json'):
+                os.remove('./test.snapshot.json')
+            agent.reset_inited()
+
+    def test_restores_memory_backend_from_snapshot(self):
+        path = f'./{NAME}.snapshot.json'
+        try:
+            proposals, votes = runtime.run(init_async_db(test=True, name=NAME, backend='memory'))
+            runtime.run(proposals.paste_rows([{'proposal_id': 1, 'start_block': 150, 'end_block': 250}]))
+            runtime.run(votes.paste_rows([{'proposal_id': 1, 'voter': VOTER, 'support': 1, 'block_number': 160,
+                                           'votes': 10 ** 24, 'reason': '', 'influencing': True}]))
+            config.block_processed(160)
+
+            proposals, votes = runtime.run(init_async_db(name=NAME, backend='memory'))
+            proposal = runtime.run(proposals.get_row_by_criteria({'proposal_id': 1}))
+            assert (proposal.start_block, proposal.end_block) == (150, 250)
+            vote, = votes.get_indexed_rows(VOTER)
+            assert (vote.proposal_id, vote.votes, vote.influencing) == (1, 10 ** 24, True)
+        finally:
+            runtime.run(init_async_db(test=True))
+            os.remove(path)
+
+    def test_write_behind_resumes_from_last_processed_block(self, monkeypatch):
+        checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300)]
+        logs = [(160, vote_cast(1, 10300)), (170, delegate_votes_changed(10300, 100))]
+        logs = [log | {'blockNumber': block, 'transactionHash': f'0x{block:x}', 'logIndex': 0} for block, log in logs]
+        rpc_client = Web3RpcClient(Web3Mock(checkpoints, logs))
+        handle_transaction = agent.provide_handle_transaction(rpc_client, test=False)
+        monkeypatch.setattr(controller, 'STORAGE_BACKEND', 'write_behind')
+
+        try:
+            agent.reset_inited()
+            runtime.run(agent.init(True, NAME))
+            handle_transaction(transaction_event(150, [proposal_created(150, 250, 1)], hex(150)))
+            findings = handle_transaction(transaction_event(160, [vote_cast(1, 10300)], hex(160)))
+            assert [x.alert_id for x in findings] == ['UNI-GOV-INC']
+            storage = config.storage
+            runtime.run(storage.flush())  # the block 150 is finished, the block 160 is not
+            with sqlite3.connect(f'./{NAME}.db') as conn:
+                assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+                assert conn.execute('SELECT proposal_id FROM proposals').fetchall() == [(1,)]
+                assert conn.execute('SELECT count(*) FROM votes').fetchone()[0] == 0
+                assert conn.execute('SELECT value FROM agent_state').fetchall() == [(159,)]
+
+            # the agent crashes before the next flush and resumes from the block 160 after the restart
+            runtime.loop.call_soon_threadsafe(storage.task.cancel)
+            config.set_storage(None)
+            agent.reset_inited()
+            runtime.run(agent.init(False, NAME))
+            findings = handle_transaction(transaction_event(180, [], hex(180)))
+            assert [x.alert_id for x in findings] == ['UNI-GOV-INC', 'UNI-GOV-FULL']
+            assert config.last_processed_block() == 159
+            runtime.run(config.storage.flush())
+            assert config.last_processed_block() == 179
+        finally:
+            agent.reset_inited()
+            runtime.run(init_async_db(test=True, backend='sqlite'))
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(f'./{NAME}.db{suffix}'):
+                    os.remove(f'./{NAME}.db{suffix}')
+
+    def test_rescans_are_idempotent(self, monkeypatch):
+        checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300)]
+        transactions = [(150, [proposal_created(150, 250, 1)]), (160, [vote_cast(1, 10300)]),
+                        (160, [vote_cast(1, 10300) | {'logIndex': 1}])]
+        for backend in ['sqlite', 'memory']:
+            monkeypatch.setattr(controller, 'STORAGE_BACKEND', backend)
+            agent.reset_inited()
+            handle_transaction = agent.provide_handle_transaction(Web3RpcClient(Web3Mock(checkpoints)), test=True)
+            try:
+                for _ in range(2):  # the second pass re-scans the same transactions
+                    for block, logs in transactions:
+                        logs = [{'logIndex': 0} | log | {'transactionHash': f'0x{block:x}'} for log in logs]
+                        handle_transaction(transaction_event(block, logs, hex(block)))
+                assert runtime.run(config.get_proposals().count_rows()) == 1
+                assert runtime.run(config.get_votes().count_rows()) == 2
+                assert len(config.get_votes().get_indexed_rows(VOTER)) == 2
+            finally:
+                if os.path.exists('./test.snapshot.json'):
+                    os.remove('./test.snapshot.json')
+        agent.reset_inited()
+
+    def test_memory_retention_deletes_rows_found_by_index(self):
+        class Rows(dict):
+            def values(self):
+                raise AssertionError('the retention scans the table')
+
+        votes = MemoryMethods('votes', create_index('votes'))
+        runtime.run(votes.paste_rows([{'voter': VOTER, 'block_number': block, 'votes': 1} for block in [10, 20, 30]]))
+        votes.rows = Rows(votes.rows)
+        assert runtime.run(votes.delete_old_votes(125, 100)) == 2
+        assert [row.block_number for row in votes.rows.copy().values()] == [30]
+        assert [row.block_number for row in votes.get_indexed_rows(VOTER)] == [30]
+
+    def test_indexes_votes_as_compact_records(self):
+        voter = "0xABaBaBaBABabABabAbAbABAbABabababaBaBABaB"  # checksum address
+        for backend in ['sqlite', 'memory']:
+            try:
+                _, votes = runtime.run(init_async_db(test=True, name=NAME, backend=backend))
+                runtime.run(votes.paste_rows([{'proposal_id': 1, 'voter': voter, 'support': 1, 'block_number': 160,
+                                               'votes': 10 ** 24, 'reason': '', 'influencing': True}]))
+                vote, = votes.get_indexed_rows(voter.lower())  # the addresses are looked up by the 20-byte key
+                assert isinstance(vote, VoteRecord) and not hasattr(vote, '__dict__')
+                assert vote.voter_key == bytes.fromhex('ab' * 20) and vote.voter == voter
+                assert (vote.proposal_id, vote.votes, vote.influencing) == (1, 10 ** 24, True)
+            finally:
+                runtime.run(init_async_db(test=True))
+                for path in [f'./{NAME}.db', f'./{NAME}.snapshot.json']:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def test_answers_proposal_queries_from_interval_index(self):
+        for backend in ['sqlite', 'memory']:
+            try:
+                proposals, _ = runtime.run(init_async_db(test=True, name=NAME, backend=backend))
+                runtime.run(proposals.paste_rows([{'proposal_id': 1, 'start_block': 150, 'end_block': 250},
+                                                  {'proposal_id': 2, 'start_block': 200, 'end_block': 300},
+                                                  {'proposal_id': 3, 'start_block': 400, 'end_block': 500}]))
+                assert proposals.get_proposal(2).start_block == 200 and proposals.get_proposal(4) is None
+                assert [x.proposal_id for x in proposals.get_active_proposals(220)] == [1, 2]
+                assert proposals.get_active_proposals(350) == []
+                assert [x.proposal_id for x in runtime.run(proposals.get_ended_proposals_rows(260))] == [1]
+                assert proposals.get_active_window(260) == (200, 500)
+
+                runtime.run(proposals.delete_old_proposals(410, 100))
+                runtime.run(proposals.paste_rows([{'proposal_id': 3, 'start_block': 400, 'end_block': 600}]))
+                assert proposals.get_proposal(1) is None
+                assert proposals.get_active_window(0) == (400, 600)
+            finally:
+                runtime.run(init_async_db(test=True))
+                for path in [f'./{NAME}.db', f'./{NAME}.snapshot.json']:
+                    if os.path.exists(path):
+                        os.remove(path)
@@ -0,0 +1,37 @@
+from src.agent import provide_handle_transaction, reset_inited
+from src.metrics import metrics, Metrics
+from src.rpc import Web3RpcClient
+from src.test.agent_test import proposal_created, vote_cast, transaction_event
+from src.test.web3_mock import Web3Mock
+
+
+class TestMetrics:
+    def test_exposes_stage_rpc_db_and_findings_metrics(self):
+        reset_inited()
+        metrics.enabled = True
+        metrics.reset()
+        try:
+            handle_transaction = provide_handle_transaction(
+                Web3RpcClient(Web3Mock([(100, 100), (120, 100), (140, 10300), (160, 10300)])), test=True)
+            handle_transaction(transaction_event(150, [proposal_created(150, 250, 1)]))
+            handle_transaction(transaction_event(160, [vote_cast(1, 10300)]))
+            text = metrics.render()
+        finally:
+            metrics.enabled = False
+            metrics.reset()
+
+        assert 'agent_transactions_total 2' in text
+        assert 'agent_findings_total{alert_id="UNI-GOV-INC"} 1' in text
+        assert 'agent_stage_seconds_count{stage="detect_cast_vote"} 2' in text
+        assert 'agent_rpc_request_seconds_count{method="eth_call"}' in text
+        assert 'agent_db_statements_total{operation="paste_rows"}' in text
+        assert 'operation="get_row_by_criteria"' not in text  # the proposals are taken from the interval index
+        assert 'agent_db_operation_seconds_count{operation="paste_rows"} 2' in text
+        assert 'agent_table_rows{table="proposals"} 1' in text
+        assert '# TYPE agent_stage_seconds histogram' in text
+
+    def test_does_nothing_when_disabled(self):
+        disabled = Metrics(enabled=False)
+        with disabled.timer('agent_stage_seconds', stage='dispatch'):
+            disabled.inc('agent_transactions_total')
+        assert disabled.render() == '\n'
@@ -0,0 +1,66 @@
+import json
+import os
+
+from src.agent import register_dao, unregister_dao
+from src.dao import Dao
+from src.replay import RpcStore, ReplayWeb3, replay, remove_dbs
+from src.test import agent_test
+from src.test.web3_mock import Web3Mock
+
+NAME = "replay_test"
+
+
+def transaction(block, logs):
+    logs = [log | {'topics': ['0x' + bytes(x).hex() if isinstance(x, bytes) else x for x in log['topics']]}
+            for log in logs]
+    return {'transaction': {'from': agent_test.VOTER, 'to': agent_test.UNISWAP_CONTRACT_ADDRESS, 'hash': "0"},
+            'block': {'number': block}, 'receipt': {'logs': logs}}
+
+
+class TestReplay:
+    def test_replays_recorded_transactions_offline(self, tmp_path):
+        transactions_path = tmp_path / 'transactions.jsonl'
+        store_path = tmp_path / 'rpc.jsonl'
+        with open(transactions_path, 'w') as file:
+            for block, logs in [(150, [agent_test.proposal_created(150, 250, 1)]),
+                                (155, []),
+                                (160, [agent_test.vote_cast(1, 10300)])]:
+                file.write(json.dumps(transaction(block, logs)) + '\n')
+
+        try:
+            # the first run records the responses of the upstream, the second one works without it
+            store = RpcStore()
+            w3 = ReplayWeb3(store, upstream=Web3Mock([(100, 100), (120, 100), (140, 10300), (160, 10300)]))
+            recorded = replay(transactions_path, w3, NAME)
+            store.save(store_path)
+            offline = replay(transactions_path, ReplayWeb3(RpcStore.load(store_path)), NAME)
+        finally:
+            remove_dbs(NAME)
+
+        assert recorded['findings'] == offline['findings'] == {'UNI-GOV-INFO': 1, 'UNI-GOV-INC': 1}
+        assert offline['transactions'] == 3
+        assert offline['stages']['detect_cast_vote'] > 0
+        assert {'dispatch', 'record_voting_power_changes', 'unit_of_work', 'clear_db'} <= set(offline['stages'])
+
+    def test_replays_events_of_several_daos_to_their_own_tables(self, tmp_path):
+        governor, token = "0x3333333333333333333333333333333333333333", "0x4444444444444444444444444444444444444444"
+        compound = Dao('compound', governor, token, title='Compound', symbol='COMP', th_low=20000)
+        transactions_path = tmp_path / 'transactions.jsonl'
+        with open(transactions_path, 'w') as file:
+            for block, logs in [(150, [agent_test.proposal_created(150, 250, 1),
+                                       agent_test.proposal_created(150, 250, 1, address_=governor)]),
+                                (160, [agent_test.vote_cast(1, 10300), agent_test.vote_cast(1, 10300, governor)])]:
+                file.write(json.dumps(transaction(block, logs)) + '\n')
+
+        register_dao(compound)
+        try:
+            w3 = ReplayWeb3(RpcStore(), upstream=Web3Mock([(100, 100), (120, 100), (140, 10300), (160, 10300)]))
+            report = replay(transactions_path, w3, NAME)
+            assert os.path.exists(f'./{NAME}_compound.db')
+        finally:
+            remove_dbs(NAME)
+            unregister_dao(compound)
+
+        # the difference is above the threshold of Uniswap, but below the threshold of Compound
+        assert report['findings'] == {'UNI-GOV-INFO': 1, 'COMP-GOV-INFO': 1, 'UNI-GOV-INC': 1}
+        assert not os.path.exists(f'./{NAME}_compound.db')
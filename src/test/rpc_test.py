@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+from src.checkpoints import CheckpointLookup
+from src.rpc import Web3RpcClient, HttpRpcClient
+from src.test.web3_mock import Web3Mock
+
+
+class FlakyWeb3Mock(Web3Mock):
+    def __init__(self, checkpoints, failures, latency=0.0):
+        super().__init__(checkpoints, latency=latency)
+        self.failures = failures
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        call = self.eth.call
+
+        def flaky_call(transaction, block_identifier='latest'):
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                fail = self.failures > 0
+                self.failures -= fail
+            try:
+                if fail:
+                    raise ConnectionError('connection reset by peer')
+                return call(transaction, block_identifier)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+        self.eth.call = flaky_call
+
+
+class TestRpcClient:
+    def test_runs_lookups_concurrently_within_in_flight_limit(self):
+        checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300)]
+        w3 = FlakyWeb3Mock(checkpoints, failures=0, latency=0.05)
+        lookup = CheckpointLookup(Web3RpcClient(w3, max_in_flight=4), chunk_size=1)
+        requests = [(f"0x{i:040x}", 130) for i in range(1, 13)]
+
+        start = time.perf_counter()
+        windows = asyncio.run(lookup.get_windows(requests, 160))
+
+        assert windows == {request: (10300, [(160, 10300), (140, 10300)]) for request in requests}
+        assert w3.max_in_flight == 4
+        # every round is split into 12 one-call chunks, which are sent 4 at once
+        assert time.perf_counter() - start < w3.calls['aggregate'] * 0.05 / 2
+
+    def test_retries_http_errors_of_node(self):
+        from aiohttp import web
+
+        statuses = [503, 429]  # the node is overloaded twice, then it answers
+
+        async def handle(request):
+            if statuses:
+                return web.Response(status=statuses.pop(0))
+            return web.json_response({'jsonrpc': '2.0', 'id': (await request.json())['id'], 'result': []})
+
+        async def run():
+            app = web.Application()
+            app.router.add_post('/', handle)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = runner.addresses[0][1]
+            client = HttpRpcClient(f'http://127.0.0.1:{port}', retries=2, backoff=0.01)
+            try:
+                return await client.get_logs({'fromBlock': 1, 'toBlock': 2})
+            finally:
+                await client.close()
+                await runner.cleanup()
+
+        assert asyncio.run(run()) == []
+        assert statuses == []
+
+    def test_retries_failed_calls_with_backoff(self):
+        checkpoints = [(100, 100), (120, 100), (140, 10300), (160, 10300)]
+        w3 = FlakyWeb3Mock(checkpoints, failures=2)
+        lookup = CheckpointLookup(Web3RpcClient(w3, retries=2, backoff=0.01))
+
+        assert asyncio.run(lookup.get_window("0x" + "11" * 20, 130, 160)) == (10300, [(160, 10300), (140, 10300)])
+        assert w3.failures == 0
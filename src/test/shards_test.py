@@ -0,0 +1,41 @@
+import glob
+import os
+from functools import partial
+
+from src.agent import provide_handle_transaction, reset_inited, dispatcher
+from src.rpc import Web3RpcClient
+from src.shards import ShardPool, route, shard_of
+from src.test.benchmark import generate_workload
+from src.test.web3_mock import Web3Mock
+
+
+def mock_client(history: dict) -> Web3RpcClient:
+    return Web3RpcClient(Web3Mock(history))
+
+
+class TestShards:
+    def test_sharded_findings_match_single_process_in_log_order(self):
+        history, events = generate_workload(proposals=2, voters=8, checkpoints=30, changes_per_tx=4, transactions=60)
+        # the proposals go to both shards, the changes of the delegates of one transaction are split between the
+        # shards and keep their order in the logs
+        routed = route(events[:3], [dispatcher.dispatch(x.logs) for x in events[:3]], 2)
+        assert all(shard[0][0] == 0 for shard in routed)
+        assert sorted(order for shard in routed for position, _, items in shard if position == 2
+                      for order, _, _ in items['uniswap']) == [0, 1, 2, 3]
+        assert {shard_of(address, 2) for address in history} == {0, 1}
+
+        reset_inited()
+        handle_transaction = provide_handle_transaction(mock_client(history), test=True)
+        expected = [finding for transaction_event in events for finding in handle_transaction(transaction_event)]
+
+        pool = ShardPool(2, partial(mock_client, history), test=True)
+        try:
+            sharded = [finding for transaction_event in events
+                       for finding in pool.run([transaction_event], transaction_event.block_number)]
+        finally:
+            pool.close()
+            for path in glob.glob('./test_shard*.db'):
+                os.remove(path)
+
+        assert {finding.alert_id for finding in expected} > {'UNI-GOV-INFO'}
+        assert [(x.alert_id, x.metadata) for x in sharded] == [(x.alert_id, x.metadata) for x in expected]
@@ -1,33 +1,96 @@
+import threading
+import time
+from collections import Counter
+
+import eth_abi
+from web3 import Web3
+
+CHECKPOINTS_SELECTOR = Web3.keccak(text="checkpoints(address,uint32)")[:4]
+AGGREGATE_SELECTOR = Web3.keccak(text="aggregate((address,bytes)[])")[:4]
+
+
 class Web3Mock:
-    def __init__(self, checkpoints):
-        self.eth = EthMock(checkpoints)
+    def __init__(self, checkpoints, logs=None, latency=0.0):
+        """
+        :param checkpoints: list of the checkpoints of every account or dict lowercase account -> list of checkpoints
+        :param logs: list of the logs returned by get_logs
+        :param latency: seconds added to every call
+        """
+        self.eth = EthMock(checkpoints, logs, latency)
+
+    @property
+    def calls(self) -> Counter:
+        """
+        eth_call count by method
+        """
+        return self.eth.contract.functions.calls
 
 
 class EthMock:
-    def __init__(self, checkpoints):
-        self.contract = ContractMock(checkpoints)
+    def __init__(self, checkpoints, logs=None, latency=0.0):
+        self.contract = ContractMock(checkpoints, latency)
+        self.logs = logs or []
+
+    def call(self, transaction, block_identifier='latest'):
+        # only the Multicall aggregate calls are sent by the agent
+        assert transaction['data'][:4] == AGGREGATE_SELECTOR
+        calls, = eth_abi.decode_abi(['(address,bytes)[]'], transaction['data'][4:])
+        return eth_abi.encode_abi(['uint256', 'bytes[]'], self.contract.functions.aggregate(calls).call())
+
+    def get_logs(self, filter_params):
+        self.contract.functions.count('get_logs')
+        return [log for log in self.logs if filter_params['fromBlock'] <= log['blockNumber'] <= filter_params['toBlock']
+                and log['address'].lower() in [address.lower() for address in filter_params['address']]]
 
 
 class ContractMock:
-    def __init__(self, checkpoints):
-        self.functions = FunctionsMock(checkpoints)
+    def __init__(self, checkpoints, latency=0.0):
+        self.functions = FunctionsMock(checkpoints, latency)
 
     def __call__(self, address, *args, **kwargs):
         return self
 
 
 class FunctionsMock:
-    def __init__(self, checkpoints):
+    def __init__(self, checkpoints, latency=0.0):
         self.checkpoints_list = checkpoints
-        self.return_value = None
+        self.latency = latency
+        self.lock = threading.Lock()  # the rpc client calls the mock from the executor threads
+        self.calls = Counter()  # eth_call count by method
+        self.checkpoint_reads = 0  # amount of checkpoints read by all the calls, including the aggregated ones
 
-    def checkpoints(self, account, index):
-        self.return_value = self.checkpoints_list[index]
-        return self
+    def get_checkpoints(self, account) -> list:
+        if isinstance(self.checkpoints_list, dict):
+            return self.checkpoints_list.get(account.lower(), [])
+        return self.checkpoints_list
 
-    def numCheckpoints(self, *_, **__):
-        self.return_value = len(self.checkpoints_list)
-        return self
+    def count(self, method):
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def aggregate(self, calls):
+        # the aggregated calls are "checkpoints(address,uint32)" or "numCheckpoints(address)"
+        return_data = []
+        for _, call_data in calls:
+            if call_data[:4] != CHECKPOINTS_SELECTOR:
+                account, = eth_abi.decode_abi(['address'], call_data[4:])
+                return_data.append(eth_abi.encode_abi(['uint32'], [len(self.get_checkpoints(account))]))
+                continue
+            account, index = eth_abi.decode_abi(['address', 'uint32'], call_data[4:])
+            return_data.append(eth_abi.encode_abi(['uint32', 'uint96'], self.get_checkpoints(account)[index]))
+            with self.lock:
+                self.checkpoint_reads += 1
+        return CallMock(self, 'aggregate', (0, return_data))
+
+
+class CallMock:
+    def __init__(self, functions: FunctionsMock, method: str, return_value):
+        self.functions = functions
+        self.method = method
+        self.return_value = return_value
 
     def call(self, *_, **__):
+        self.functions.count(self.method)
         return self.return_value